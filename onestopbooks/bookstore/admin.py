@@ -15,9 +15,15 @@ class CustomerAdmin(admin.ModelAdmin):
     
     search_fields = ('first_name', 'last_name', 'email', 'phone_number',)
 
+class CartLineAdmin(admin.ModelAdmin):
+    """ Buy and rent lines of every cart, filterable by line type """
+
+    list_display = ('order', 'product', 'line_type', 'quantity', 'date_added',)
+    list_filter = ('line_type',)
+    raw_id_fields = ('order', 'product',)
+
 admin.site.register(Customer, CustomerAdmin)
 admin.site.register(Book, BookAdmin)
 admin.site.register(Order)
-admin.site.register(OrderItem)
-admin.site.register(RentItem)
+admin.site.register(CartLine, CartLineAdmin)
 admin.site.register(ReviewRating)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class BookstoreConfig(AppConfig):
     name = 'bookstore'
+
+    def ready(self):
+        # connect the model signal receivers
+        from . import signals
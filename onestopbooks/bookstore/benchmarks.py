@@ -0,0 +1,201 @@
+""" View latency benchmarks at catalog scale, run by `manage.py bench_views`.
+
+seed_catalog() fills an empty database with a synthetic catalog of any size, a batch
+at a time, and run_scenarios() sends a fixed mix of requests for every public page
+through the test client, recording latency percentiles and query counts. Results are
+plain dicts, so they can be saved as JSON and checked against an earlier run with
+compare().
+"""
+import json
+import random
+import time
+from contextlib import contextmanager
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.test import override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from .models import Book, CartLine, Customer, Order, ReviewRating
+from .catalog import books_added_or_removed
+from .pagination import encode_cursor
+from . import facets, page_cache, search
+
+WORDS = ["river", "night", "garden", "empire", "silent", "winter", "stone", "secret", "journey", "shadow",
+         "ocean", "fire", "letters", "kingdom", "summer", "glass", "forest", "memory", "storm", "golden"]
+PUBLISHERS = ["Penguin", "Vintage", "HarperCollins", "Oxford University Press", "Scholastic", "Bantam",
+              "Ballantine Books", "Simon & Schuster"]
+RATES = [1, 2, 3, 3.5, 4, 4, 4.5, 5, 5]
+REVIEWERS = 1000 # users the synthetic reviews are spread over
+COVER_URL = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg"
+BENCH_USERNAME = "bench"
+SAMPLE_SIZE = 1000 # books the product and cart requests pick from
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+@contextmanager
+def benchmark_database(name, keepdb = False):
+    """ Point the default connection at database `name`, created and migrated the way the
+    test runner does it, so a benchmark never touches the site's own data. Dropped afterwards
+    unless `keepdb` """
+    connection = connections[DEFAULT_DB_ALIAS]
+    old_name = connection.settings_dict['NAME']
+    connection.settings_dict['TEST']['NAME'] = name
+    setup_test_environment()
+    try:
+        connection.creation.create_test_db(verbosity = 0, autoclobber = True, keepdb = keepdb)
+        with override_settings(REPLICA_ALIAS = None):
+            yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity = 0, keepdb = keepdb)
+        teardown_test_environment()
+
+
+def synthetic_book(number, rng, rates):
+    """ Book number `number`, with rating totals matching the given review rates """
+    return Book(
+        isbn = "B%09d" % number,
+        title = " ".join(rng.choice(WORDS) for i in range(rng.randint(2, 4))).title(),
+        authors = "%s %s" % (rng.choice(WORDS).title(), rng.choice(WORDS).title()),
+        year_public = rng.randint(1950, 2023),
+        publisher = rng.choice(PUBLISHERS),
+        image_url = COVER_URL,
+        price = rng.randint(3, 40),
+        quantity = rng.randint(0, 50),
+        rating_count = len(rates),
+        rating_sum = sum(rates),
+        rating_average = sum(rates) / len(rates) if rates else 0,
+    )
+
+
+def seed_catalog(books, reviews_per_book = 2, cart_lines = 10, batch_size = 5000, seed = 0):
+    """ Fill an empty database with `books` synthetic books and about `reviews_per_book`
+    reviews each, and give the bench user a cart of `cart_lines` lines. Returns the bench user """
+    rng = random.Random(seed)
+    User.objects.bulk_create([User(username = "reviewer%d" % i, password = "!") for i in range(REVIEWERS)])
+    reviewer_ids = list(User.objects.filter(username__startswith = "reviewer").values_list('id', flat = True))
+
+    # books and their reviews are built and saved a batch at a time, so memory doesn't grow with the catalog
+    for start in range(0, books, batch_size):
+        batch, reviews = [], []
+        for number in range(start, min(books, start + batch_size)):
+            rates = [rng.choice(RATES) for i in range(rng.randint(0, 2 * reviews_per_book))]
+            book = synthetic_book(number, rng, rates)
+            batch.append(book)
+            reviews += [ReviewRating(book_id = book.isbn, user_id = rng.choice(reviewer_ids), subject = "Review",
+                                     review = " ".join(rng.choice(WORDS) for i in range(12)), rate = rate) for rate in rates]
+        with transaction.atomic():
+            Book.objects.bulk_create(batch)
+            ReviewRating.objects.bulk_create(reviews)
+
+    # bulk_create skips the post_save signals that keep these up to date
+    search.rebuild_index()
+    facets.books_changed()
+    books_added_or_removed()
+    page_cache.catalog_changed()
+
+    user = User.objects.create_user(BENCH_USERNAME)
+    customer = Customer.objects.create(user = user, first_name = "Bench", last_name = "User", email = "bench@example.com",
+                                       address_1 = "123 S. Denver", city = "Denver", state = "Colorado", zip_code = "80123")
+    order = Order.objects.create(customer = customer, complete = False)
+    isbns = rng.sample(range(books), min(books, cart_lines))
+    CartLine.objects.bulk_create([
+        CartLine(order = order, product_id = "B%09d" % number, line_type = CartLine.RENT if i % 2 else CartLine.BUY, quantity = 1)
+        for i, number in enumerate(isbns)
+    ])
+    return user
+
+
+def book_sample(rng):
+    isbns = list(Book.objects.values_list('isbn', flat = True).order_by('random_key')[:SAMPLE_SIZE])
+    rng.shuffle(isbns)
+    return isbns
+
+
+# name: (logged in, method, request maker). Makers return the client call's keyword arguments.
+# Left out: the admin, logout, and successcheckout, which would empty the bench cart.
+SCENARIOS = {
+    'home': (False, 'get', lambda rng, isbns: {'path': reverse('home')}),
+    'aboutus': (False, 'get', lambda rng, isbns: {'path': reverse('aboutus')}),
+    'books': (False, 'get', lambda rng, isbns: {'path': reverse('books')}),
+    'books_sorted': (False, 'get', lambda rng, isbns: {
+        'path': reverse('books'), 'data': {'sort': rng.choice(['titles_az', 'authors_az', 'price_lh', 'price_hl'])}}),
+    'books_last_page': (False, 'get', lambda rng, isbns: {
+        'path': reverse('books'), 'data': {'cursor': encode_cursor('last', ('isbn',), [], 0)}}), # the featured order
+    'newestbooks': (False, 'get', lambda rng, isbns: {'path': reverse('newestbooks')}),
+    'booksunder': (False, 'get', lambda rng, isbns: {'path': reverse('booksunder')}),
+    'randombooks': (False, 'get', lambda rng, isbns: {'path': reverse('randombooks')}),
+    'product': (False, 'get', lambda rng, isbns: {'path': reverse('product', args = [rng.choice(isbns)])}),
+    'search': (False, 'get', lambda rng, isbns: {'path': reverse('search'), 'data': {'searched': rng.choice(WORDS)}}),
+    'login': (False, 'get', lambda rng, isbns: {'path': reverse('login')}),
+    'signup': (False, 'get', lambda rng, isbns: {'path': reverse('signup')}),
+    'product_logged_in': (True, 'get', lambda rng, isbns: {'path': reverse('product', args = [rng.choice(isbns)])}),
+    'cart': (True, 'get', lambda rng, isbns: {'path': reverse('cart')}),
+    'checkout': (True, 'get', lambda rng, isbns: {'path': reverse('checkout')}),
+    'update_item': (True, 'post', lambda rng, isbns: update_item_request(rng.choice(isbns))),
+    'submit_review': (True, 'post', lambda rng, isbns: {
+        'path': reverse('submit_review', args = [rng.choice(isbns)]),
+        'data': {'subject': "Review", 'review': "Benchmark review", 'rate': 4}, 'HTTP_REFERER': reverse('home')}),
+}
+
+
+def update_item_request(isbn):
+    # adds a copy and takes it away again in one batch, so the cart stays the same size
+    operations = [{'bookIsbn': isbn, 'action': 'add'}, {'bookIsbn': isbn, 'action': 'remove'}]
+    return {'path': reverse('update_item'), 'data': json.dumps({'operations': operations}), 'content_type': 'application/json'}
+
+
+def run_scenarios(anonymous_client, user_client, requests, seed = 0, names = None):
+    """ Send `requests` requests for each scenario, returns {name: latency and query stats} """
+    rng = random.Random(seed)
+    random.seed(seed) # random_books() uses the global generator, this keeps its query counts the same run to run
+    isbns = book_sample(rng)
+    results = {}
+    for name, (logged_in, method, make_request) in SCENARIOS.items():
+        if names and name not in names:
+            continue
+        client = user_client if logged_in else anonymous_client
+        send = getattr(client, method)
+        send(**make_request(rng, isbns)) # warm up templates and connections
+
+        latencies, queries, errors = [], [], 0
+        for i in range(requests):
+            kwargs = make_request(rng, isbns)
+            started = time.perf_counter()
+            response = send(**kwargs)
+            latencies.append((time.perf_counter() - started) * 1000)
+            queries.append(response.wsgi_request.query_stats.count)
+            if response.status_code >= 400:
+                errors += 1
+        results[name] = {
+            'requests': requests,
+            'errors': errors,
+            'p50_ms': round(percentile(latencies, 0.50), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'queries': max(queries),
+        }
+    return results
+
+
+def compare(results, baseline, tolerance = 0.25, min_ms = 1.0):
+    """ Regressions against a baseline run, as messages.
+
+    A view regresses when it runs more queries than before, or when its p50 or p95 is
+    more than `tolerance` slower and also more than `min_ms` slower, so sub-millisecond
+    noise on fast pages isn't flagged.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result['queries'] > before['queries']:
+            regressions.append("%s: %d queries, baseline %d" % (name, result['queries'], before['queries']))
+        for metric in ('p50_ms', 'p95_ms'):
+            if result[metric] > before[metric] * (1 + tolerance) and result[metric] - before[metric] > min_ms:
+                regressions.append("%s: %s %.2f, baseline %.2f" % (name, metric, result[metric], before[metric]))
+    return regressions
@@ -0,0 +1,115 @@
+""" Changing the contents of a cart.
+
+A batch of operations from the cart buttons is applied in one transaction. Only the
+lines the batch names are read and written, and lines that end up empty are deleted
+rather than kept at zero.
+
+The transaction starts with a write to the customer's row. SQLite then takes its write
+lock before anything is read, so concurrent updates queue on the busy timeout instead of
+failing to upgrade a read lock, and other databases hold the customer's row, so two first
+adds can't each create an open cart.
+"""
+from django.db import transaction
+from django.db.models import F
+from .models import Book, CartLine, Customer, Order
+
+BUY = CartLine.BUY
+RENT = CartLine.RENT
+
+# action sent by the cart buttons -> (line type, change), None empties the line
+CART_ACTIONS = {
+    'purchase': (BUY, 1),
+    'add': (BUY, 1),
+    'remove': (BUY, -1),
+    'delete': (BUY, None),
+    'rent': (RENT, 1),
+    'deleteRent': (RENT, None),
+}
+
+MAX_OPERATIONS = 100
+
+
+class InvalidCartOperation(ValueError):
+    """ Raised for a batch that can't be applied, nothing is changed """
+
+
+def parse_operations(operations):
+    """ Check a list of {bookIsbn, action} dicts, returns [(isbn, line type, change)] """
+    if not isinstance(operations, list) or not operations:
+        raise InvalidCartOperation("operations must be a non-empty list")
+    if len(operations) > MAX_OPERATIONS:
+        raise InvalidCartOperation("at most %d operations per request" % MAX_OPERATIONS)
+    parsed = []
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise InvalidCartOperation("every operation must be an object")
+        isbn, action = operation.get('bookIsbn'), operation.get('action')
+        if not isinstance(isbn, str) or not isbn:
+            raise InvalidCartOperation("missing bookIsbn")
+        if action not in CART_ACTIONS:
+            raise InvalidCartOperation("unknown action: %s" % action)
+        parsed.append((isbn,) + CART_ACTIONS[action])
+    return parsed
+
+
+def line_quantities(order, isbns):
+    """ Current {(isbn, line type): (line id, quantity)} for the named books in the order """
+    if order is None:
+        return {}
+    lines = CartLine.objects.filter(order = order, product__in = isbns).values_list('pk', 'product', 'line_type', 'quantity')
+    return {(isbn, line_type): (pk, quantity or 0) for pk, isbn, line_type, quantity in lines}
+
+
+def update_cart(customer, operations):
+    """ Apply a batch of cart operations for a customer and return the changed lines and cart totals.
+
+    The result is {'lines': [{bookIsbn, type, quantity, total}], 'cartItems': n, 'cartTotal': n}
+    with one entry per line the batch touched; quantity 0 means the line is gone.
+    """
+    parsed = parse_operations(operations)
+    isbns = sorted({isbn for isbn, line_type, change in parsed})
+    prices = dict(Book.objects.filter(isbn__in = isbns).values_list('isbn', 'price'))
+    missing = [isbn for isbn in isbns if isbn not in prices]
+    if missing:
+        raise InvalidCartOperation("unknown book: %s" % ", ".join(missing))
+
+    with transaction.atomic():
+        Customer.objects.filter(pk = customer.pk).update(zip_code = F('zip_code')) # a no-op write, for the lock
+        order = Order.objects.filter(customer = customer, complete = False).order_by('-id').first()
+        current = line_quantities(order, isbns)
+
+        # play the batch through in order, so "delete then rent" ends up with one copy
+        quantities = {key: quantity for key, (pk, quantity) in current.items()}
+        for isbn, line_type, change in parsed:
+            key = (isbn, line_type)
+            quantity = 0 if change is None else max(quantities.get(key, 0) + change, 0)
+            quantities[key] = quantity
+
+        if order is None and any(quantities.values()):
+            order = Order.objects.create(customer = customer, complete = False)
+
+        new_lines, gone_lines = [], []
+        for (isbn, line_type), quantity in quantities.items():
+            pk, old_quantity = current.get((isbn, line_type), (None, 0))
+            if pk is None:
+                if quantity:
+                    new_lines.append(CartLine(order = order, product_id = isbn, line_type = line_type, quantity = quantity))
+            elif not quantity:
+                gone_lines.append(pk)
+            elif quantity != old_quantity:
+                CartLine.objects.filter(pk = pk).update(quantity = quantity)
+
+        if new_lines:
+            CartLine.objects.bulk_create(new_lines)
+        if gone_lines:
+            CartLine.objects.filter(pk__in = gone_lines).delete()
+
+    cart_items, cart_total = order.cart_summary() if order is not None else (0, 0)
+    return {
+        'lines': [
+            {'bookIsbn': isbn, 'type': line_type, 'quantity': quantity, 'total': quantity * prices[isbn]}
+            for (isbn, line_type), quantity in sorted(quantities.items())
+        ],
+        'cartItems': cart_items,
+        'cartTotal': cart_total,
+    }
@@ -0,0 +1,62 @@
+""" Cached catalog-wide lookups shared by the listing views.
+
+The values live in the default cache, which every process shares (CACHES in settings),
+so a management command that adds or removes books clears them for the web processes too.
+"""
+import random
+from django.core.cache import cache
+from .models import Book
+
+BOOK_COUNT_KEY = "bookstore:book_count"
+BOOK_COUNT_TIMEOUT = 300 # seconds, the count is only used for page numbers so a little staleness is fine
+NEWEST_KEY = "bookstore:newest_isbns"
+NEWEST_SIZE = 20
+NEWEST_TIMEOUT = 60 * 60 * 24 # seconds, the list is dropped whenever a book is added anyway
+
+
+def book_count():
+    """ Approximate number of books, cached so listing pages don't run COUNT(*) every time """
+    count = cache.get(BOOK_COUNT_KEY)
+    if count is None:
+        count = Book.objects.count()
+        cache.set(BOOK_COUNT_KEY, count, BOOK_COUNT_TIMEOUT)
+    return count
+
+
+def books_added_or_removed():
+    """ Forget the cached count and newest arrivals, called when books are added or removed """
+    cache.delete_many([BOOK_COUNT_KEY, NEWEST_KEY])
+
+
+def newest_books(number = NEWEST_SIZE):
+    """ The most recently added books, newest first.
+
+    Only the isbns are cached, the books themselves are re-read by primary key so
+    price and stock changes show up straight away.
+    """
+    isbns = cache.get(NEWEST_KEY)
+    if isbns is None:
+        isbns = list(Book.objects.order_by('-date_added', '-isbn').values_list('isbn', flat=True)[:NEWEST_SIZE])
+        cache.set(NEWEST_KEY, isbns, NEWEST_TIMEOUT)
+    isbns = isbns[:number]
+    books = Book.objects.in_bulk(isbns)
+    return [books[isbn] for isbn in isbns if isbn in books]
+
+
+def random_books(number):
+    """ Pick `number` distinct random books without scanning the catalog.
+
+    Every book gets a uniform random_key when it's created, so the random_key order is a
+    random shuffle of the catalog. A sample is the `number` books at or after a random
+    point on that order, wrapping around past the end onto a second query, so it costs
+    one or two index range reads. Seen as a circle there's no special first or last book:
+    a book is picked when the point lands in one of the `number` gaps before it, which is
+    `number`/total on average and evens out quickly as `number` grows. Added books are
+    sampled as soon as they exist and deleted ones simply stop matching.
+    """
+    point = random.random()
+    books = list(Book.objects.filter(random_key__gte = point).order_by('random_key')[:number])
+    if len(books) < number:
+        books += Book.objects.filter(random_key__lt = point).order_by('random_key')[:number - len(books)]
+    random.shuffle(books)
+    return books
@@ -0,0 +1,74 @@
+""" Placing an order: stock decrements and completing the cart in one transaction """
+import uuid
+from collections import Counter
+from django.db import transaction
+from django.db.models import Case, Exists, F, IntegerField, Q, Subquery, When
+from .models import Book, Order
+
+
+class OutOfStock(Exception):
+    """ Raised when a cart asks for more copies than are in stock, nothing is changed """
+
+    def __init__(self, titles):
+        super().__init__("Not enough stock for: " + ", ".join(titles))
+        self.titles = titles
+
+
+def short_titles(wanted):
+    """ Titles of the books that have fewer copies than `wanted` asks for """
+    books = Book.objects.filter(isbn__in = list(wanted)).values_list('isbn', 'title', 'quantity')
+    return [title for isbn, title, quantity in books if quantity < wanted[isbn]]
+
+
+def new_idempotency_key():
+    """ Key the checkout form submits with, so a resubmitted form places the order only once """
+    return uuid.uuid4().hex
+
+
+def place_order(user, idempotency_key):
+    """ Check out the user's open cart and return the completed order (None if there was no cart).
+
+    The newest open cart is claimed with a conditional UPDATE that is the transaction's first
+    statement, so SQLite takes its write lock up front and a concurrent checkout waits for
+    it instead of failing to upgrade a read lock. The claim only matches while no order was
+    completed under the same key, so a retried or concurrent submit loses the claim, changes
+    nothing and gets the order placed under its key, if any. Stock for every line is then
+    taken in a single UPDATE that only matches books with enough copies; if any book is
+    short the whole transaction rolls back. The key has to come from the caller, so that a
+    retry can send the same one again.
+    """
+    if not idempotency_key:
+        raise ValueError("place_order needs an idempotency key")
+    key = idempotency_key
+    short = None
+    with transaction.atomic():
+        placed = Order.objects.filter(customer__user = user, transaction_id = key, complete = True)
+        claimed = (Order.objects.filter(pk = Subquery(Order.objects.open_for(user).values('pk')[:1]), complete = False)
+                   .filter(~Exists(placed)).update(complete = True, transaction_id = key))
+        if not claimed:
+            # a retry of a checkout that already went through, or no open cart, or another request completed it first
+            return placed.order_by('-id').first()
+        order = placed.order_by('-id').first()
+
+        # the same book can be both bought and rented
+        wanted = Counter()
+        for isbn, quantity in order.lines.values_list('product_id', 'quantity'):
+            wanted[isbn] += quantity or 0
+        wanted = {isbn: quantity for isbn, quantity in wanted.items() if isbn is not None and quantity > 0}
+
+        if wanted:
+            in_stock = Q()
+            for isbn, quantity in wanted.items():
+                in_stock |= Q(isbn = isbn, quantity__gte = quantity)
+            new_quantity = Case(
+                *[When(isbn = isbn, then = F('quantity') - quantity) for isbn, quantity in wanted.items()],
+                output_field = IntegerField(),
+            )
+            if Book.objects.filter(in_stock).update(quantity = new_quantity) != len(wanted):
+                # undo the claim and any decrements, then report once the rollback is done
+                transaction.set_rollback(True)
+                short = wanted
+
+    if short is not None:
+        raise OutOfStock(short_titles(short))
+    return order
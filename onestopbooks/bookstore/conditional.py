@@ -0,0 +1,112 @@
+""" Conditional GET for the product and listing pages.
+
+A product page is stamped with its book's version, which moves on every save of the
+book and every review written for it. Listing pages are stamped with the catalog
+generation that also retires cached pages (page_cache.py). The stamp is looked up
+before the view runs, so a browser revalidating a page it already has gets a 304
+without any rendering or review query.
+
+Only anonymous visitors get validators, a logged in visitor's pages show their cart
+and the stamps don't cover it. Every page carries a CSRF token, so the visitor's CSRF
+cookie is part of the ETag: a page whose token no longer matches the cookie is never
+revalidated. Last-Modified is the second of the last catalog change, later than or
+equal to the last change of any one page. HTTP dates have no fraction, so pages served
+in the same second as a change get no Last-Modified: a second change within that second
+wouldn't move it, and If-Modified-Since would answer 304 for a page that changed.
+"""
+import asyncio
+import functools
+import hashlib
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from .models import Book
+from . import page_cache
+
+
+def book_stamp(request, isbn, *args, **kwargs):
+    """ The book's version, None for a book that doesn't exist so the view can answer that.
+
+    Versions are cached under the catalog generation, which moves with every book or
+    review change, so a page cache hit doesn't gain a query just to be revalidated.
+    """
+    cache = page_cache.page_cache()
+    key = "book_version:%s:%s" % (page_cache.catalog_generation(), hashlib.md5(isbn.encode()).hexdigest())
+    version = cache.get(key)
+    if version is None:
+        version = Book.objects.filter(isbn = isbn).values_list('version', flat = True).first()
+        if version is not None:
+            cache.set(key, version, settings.PAGE_CACHE_TIMEOUT)
+    return version
+
+
+def catalog_stamp(request, *args, **kwargs):
+    return page_cache.catalog_generation()
+
+
+def last_modified():
+    """ Whole unix second of the last catalog change, None while that second is still going """
+    changed = int(page_cache.catalog_changed_at())
+    return changed if changed < int(time.time()) else None
+
+
+def page_validators(request, stamp, args, kwargs):
+    """ (etag, last modified unix time or None) for this visitor's copy of the page, None if it has no stamp """
+    version = stamp(request, *args, **kwargs)
+    if version is None:
+        return None
+    token = request.COOKIES.get(settings.CSRF_COOKIE_NAME, '')
+    etag = quote_etag(hashlib.md5(("%s:%s" % (version, token)).encode()).hexdigest())
+    return etag, last_modified()
+
+
+def add_validators(response, validators):
+    if response.status_code in (200, 304) and not response.has_header('ETag'):
+        etag, last_modified = validators
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        # the browser may keep the page but has to ask before showing it again
+        patch_cache_control(response, no_cache = True)
+    return response
+
+
+def conditional_page(stamp):
+    """ Decorator answering an anonymous visitor's If-None-Match / If-Modified-Since with
+    a 304 before the view runs. `stamp(request, *args, **kwargs)` returns a version that
+    changes whenever the page would, or None to leave the request alone """
+    def decorator(view):
+
+        if asyncio.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if not await page_cache.acacheable(request):
+                    return await view(request, *args, **kwargs)
+                validators = await sync_to_async(page_validators)(request, stamp, args, kwargs)
+                if validators is None:
+                    return await view(request, *args, **kwargs)
+                etag, last_modified = validators
+                response = get_conditional_response(request, etag = etag, last_modified = last_modified)
+                if response is None:
+                    response = await view(request, *args, **kwargs)
+                return add_validators(response, validators)
+
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not page_cache.cacheable(request):
+                return view(request, *args, **kwargs)
+            validators = page_validators(request, stamp, args, kwargs)
+            if validators is None:
+                return view(request, *args, **kwargs)
+            etag, last_modified = validators
+            response = get_conditional_response(request, etag = etag, last_modified = last_modified)
+            if response is None:
+                response = view(request, *args, **kwargs)
+            return add_validators(response, validators)
+
+        return wrapper
+    return decorator
@@ -0,0 +1,19 @@
+from django.utils.functional import SimpleLazyObject
+from .models import Order
+
+EMPTY_CART = {'order': None, 'cart_items': 0, 'cart_total': 0}
+
+
+def cart_summary(user):
+    """ Item count and total of the user's open cart, in a single query. Never creates a cart """
+    if not user.is_authenticated:
+        return EMPTY_CART
+    order = Order.objects.open_for(user).with_cart_summary().first()
+    if order is None:
+        return EMPTY_CART
+    return {'order': order, 'cart_items': order.cart_items, 'cart_total': order.cart_total}
+
+
+def cart(request):
+    """ Adds `cart_summary` to every template. It's lazy, so pages that don't show the cart don't query it """
+    return {'cart_summary': SimpleLazyObject(lambda: cart_summary(request.user))}
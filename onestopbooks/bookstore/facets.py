@@ -0,0 +1,350 @@
+""" In-memory facet index for filtering the catalog by publisher, decade and price band.
+
+Every book gets a bit position, and every facet value keeps a bitmap (a Python int)
+of the books that have it. A filter ORs the chosen values of a facet together and ANDs
+the facets, so any combination is a handful of bitwise operations, and the sidebar
+counts are popcounts of the same intersections. Bitmaps are stored shifted down to
+their lowest bit, and a rebuild hands bits out in publisher order, so each of the
+thousands of publishers costs a short run of bits rather than one per book.
+
+The index lives in each process. Saving or deleting a book updates it in place
+(signals.py), bulk writes call books_changed(), and every change moves a version
+number in the default cache, which all processes share (CACHES in settings), so
+the other processes rebuild their copy on next use. The file cache's incr is a read
+and a write rather than atomic, so two processes changing books at the same moment
+can move the version once between them and each keep missing the other's change;
+memcached or redis don't have that race. That, and a save that is rolled back and
+leaves a phantom change behind, is why an index is also rebuilt once it is
+INDEX_MAX_AGE old.
+"""
+import threading
+import time
+from urllib.parse import urlencode
+from django.core.cache import cache
+from django.db.models import Q
+from .models import Book
+
+VERSION_KEY = "facets:version"
+INDEX_MAX_AGE = 600 # seconds
+IN_LOOKUP_LIMIT = 500 # up to this many matches are fetched by primary key, more with the facet conditions
+PUBLISHER_LIMIT = 15 # publishers listed in the sidebar, by number of books, besides the chosen ones
+
+# (url value, label, lowest price, highest price or None)
+PRICE_BANDS = [
+    ('0-9', "Under $10", 0, 9),
+    ('10-19', "$10 - $19", 10, 19),
+    ('20-29', "$20 - $29", 20, 29),
+    ('30-49', "$30 - $49", 30, 49),
+    ('50+', "$50 and up", 50, None),
+]
+FACETS = ('publisher', 'decade', 'price')
+
+_lock = threading.RLock() # held while the index is read or changed, so a reader never sees a half made change
+_index = None
+
+
+def price_band(price):
+    for value, label, low, high in PRICE_BANDS:
+        if price >= low and (high is None or price <= high):
+            return value
+    return None
+
+
+def book_facets(publisher, year_public, price):
+    """ {facet: value} for one book, leaving out facets it has no value for """
+    values = {}
+    if publisher:
+        values['publisher'] = publisher
+    if year_public and year_public > 0: # the catalog feed uses 0 for unknown years
+        values['decade'] = year_public // 10 * 10
+    band = price_band(price) if price is not None else None
+    if band is not None:
+        values['price'] = band
+    return values
+
+
+def with_bit(entry, bit):
+    """ A stored (offset, bits) bitmap with `bit` set """
+    if entry is None:
+        return bit, 1
+    offset, bits = entry
+    if bit >= offset:
+        return offset, bits | 1 << (bit - offset)
+    return bit, bits << (offset - bit) | 1
+
+
+def without_bit(entry, bit):
+    """ A stored (offset, bits) bitmap with `bit` cleared, None once it's empty """
+    offset, bits = entry
+    bits &= ~(1 << (bit - offset))
+    return (offset, bits) if bits else None
+
+
+def from_bits(bits):
+    """ A stored (offset, bits) bitmap with the given bit positions set, built in one pass """
+    offset = min(bits)
+    flags = bytearray((max(bits) - offset) // 8 + 1)
+    for bit in bits:
+        bit -= offset
+        flags[bit >> 3] |= 1 << (bit & 7)
+    return offset, int.from_bytes(flags, 'little')
+
+
+def positions(bitmap):
+    """ The set bits of a plain bitmap, lowest first """
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    for i, byte in enumerate(data):
+        if byte:
+            for j in range(8):
+                if byte >> j & 1:
+                    yield i * 8 + j
+
+
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+else: # Python before 3.10
+    def popcount(bitmap):
+        """ Number of set bits in a plain bitmap """
+        return bin(bitmap).count('1')
+
+
+def expand(entry):
+    """ A stored (offset, bits) bitmap as a plain bitmap """
+    if entry is None:
+        return 0
+    offset, bits = entry
+    return bits << offset
+
+
+class FacetIndex:
+    """ Bitmaps over bit positions handed out to books, one per facet value """
+
+    def __init__(self, version):
+        self.version = version
+        self.built = time.monotonic()
+        self.isbns = [] # bit -> isbn, None once the book is gone
+        self.bits = {} # isbn -> bit
+        self.values = {} # isbn -> {facet: value}
+        self.bitmaps = {facet: {} for facet in FACETS} # facet -> {value: (offset, bits)}
+        self.everything = 0
+        self.sizes = {} # cached largest() rankings
+
+    def add(self, isbn, publisher, year_public, price):
+        self.discard(isbn)
+        bit = len(self.isbns)
+        self.isbns.append(isbn)
+        self.bits[isbn] = bit
+        self.values[isbn] = book_facets(publisher, year_public, price)
+        flag = 1 << bit
+        self.everything |= flag
+        for facet, value in self.values[isbn].items():
+            self.bitmaps[facet][value] = with_bit(self.bitmaps[facet].get(value), bit)
+        self.sizes.clear()
+
+    def discard(self, isbn):
+        bit = self.bits.pop(isbn, None)
+        if bit is None:
+            return
+        self.isbns[bit] = None
+        flag = 1 << bit
+        self.everything &= ~flag
+        for facet, value in self.values.pop(isbn).items():
+            entry = without_bit(self.bitmaps[facet][value], bit)
+            if entry is None:
+                del self.bitmaps[facet][value]
+            else:
+                self.bitmaps[facet][value] = entry
+        self.sizes.clear()
+
+    def match(self, filters, skip = None):
+        """ Bitmap of the books matching every facet in `filters` except `skip` """
+        bitmap = self.everything
+        for facet, values in filters.items():
+            if facet == skip:
+                continue
+            chosen = 0
+            for value in values:
+                chosen |= expand(self.bitmaps[facet].get(value))
+            bitmap &= chosen
+        return bitmap
+
+    def isbns_in(self, bitmap):
+        return [self.isbns[bit] for bit in positions(bitmap)]
+
+    def counts(self, filters, facet, values):
+        """ {value: books} for the given values of `facet`, within the other facets' filters """
+        within = self.match(filters, skip = facet)
+        return {value: popcount(expand(self.bitmaps[facet].get(value)) & within) for value in values}
+
+    def largest(self, facet, number):
+        """ The `number` values of `facet` with the most books """
+        if facet not in self.sizes:
+            self.sizes[facet] = sorted(((popcount(bits), value) for value, (offset, bits) in self.bitmaps[facet].items()),
+                                       key = lambda size: (-size[0], str(size[1])))
+        return [value for size, value in self.sizes[facet][:number]]
+
+
+def shared_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # a microsecond clock value, so an evicted version never comes back as an old number
+        cache.add(VERSION_KEY, time.time_ns() // 1000, None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def next_version():
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError: # not set yet, or evicted
+        return shared_version()
+
+
+def build_index(version):
+    """ A fresh index of the whole catalog. Bits are collected per value first and each
+    bitmap made once, setting them one book at a time would copy the bitmaps every time """
+    index = FacetIndex(version)
+    groups = {facet: {} for facet in FACETS}
+    books = Book.objects.order_by('publisher', 'isbn').values_list('isbn', 'publisher', 'year_public', 'price')
+    for bit, (isbn, publisher, year_public, price) in enumerate(books.iterator()):
+        index.isbns.append(isbn)
+        index.bits[isbn] = bit
+        index.values[isbn] = book_facets(publisher, year_public, price)
+        for facet, value in index.values[isbn].items():
+            groups[facet].setdefault(value, []).append(bit)
+    index.bitmaps = {facet: {value: from_bits(bits) for value, bits in values.items()} for facet, values in groups.items()}
+    index.everything = (1 << len(index.isbns)) - 1
+    return index
+
+
+def facet_index():
+    """ This process's index, rebuilt first if another process changed the catalog or it's too old """
+    global _index
+    version = shared_version()
+    with _lock:
+        if _index is None or _index.version != version or time.monotonic() - _index.built > INDEX_MAX_AGE:
+            _index = build_index(version)
+        return _index
+
+
+def apply_change(change):
+    """ Move the version on, and make `change` to this process's index if it was up to date """
+    global _index
+    with _lock:
+        version = next_version()
+        if _index is None:
+            return
+        if _index.version == version - 1:
+            change(_index)
+            _index.version = version
+        else:
+            _index = None # missed someone else's change, rebuild on next use
+
+
+def book_changed(book):
+    # a saved instance keeps whatever was assigned to it, such as a year given as a string
+    year_public = Book._meta.get_field('year_public').to_python(book.year_public)
+    price = Book._meta.get_field('price').to_python(book.price)
+    apply_change(lambda index: index.add(book.isbn, book.publisher, year_public, price))
+
+
+def book_deleted(isbn):
+    apply_change(lambda index: index.discard(isbn))
+
+
+def books_changed():
+    """ Rebuild every process's index on next use, called after bulk writes that skip the signals """
+    global _index
+    with _lock:
+        next_version()
+        _index = None
+
+
+def parse_filters(query):
+    """ {facet: [values]} from the request's query string, ignoring values that can't be facet values """
+    filters = {}
+    publishers = [value for value in query.getlist('publisher') if value]
+    if publishers:
+        filters['publisher'] = publishers
+    decades = [int(value) // 10 * 10 for value in query.getlist('decade') if value.isdigit()]
+    if decades:
+        filters['decade'] = decades
+    bands = {value for value, label, low, high in PRICE_BANDS}
+    prices = [value for value in query.getlist('price') if value in bands]
+    if prices:
+        filters['price'] = prices
+    return filters
+
+
+def filter_query(filters):
+    """ Query string for `filters`, the inverse of parse_filters() """
+    return urlencode([(facet, value) for facet in FACETS for value in filters.get(facet, [])])
+
+
+def facet_q(filters):
+    """ The same filters as database conditions """
+    condition = Q()
+    if 'publisher' in filters:
+        condition &= Q(publisher__in = filters['publisher'])
+    if 'decade' in filters:
+        years = Q()
+        for decade in filters['decade']:
+            years |= Q(year_public__range = (decade, decade + 9))
+        condition &= years
+    if 'price' in filters:
+        prices = Q()
+        for value, label, low, high in PRICE_BANDS:
+            if value in filters['price']:
+                prices |= Q(price__gte = low) if high is None else Q(price__range = (low, high))
+        condition &= prices
+    return condition
+
+
+def filtered_books(filters):
+    """ (queryset, count) of the books matching `filters`.
+
+    Few matches are fetched by primary key straight from the bitmap, a big match falls
+    back to the facet conditions so the query doesn't carry thousands of parameters.
+    """
+    with _lock:
+        index = facet_index()
+        bitmap = index.match(filters)
+        count = popcount(bitmap)
+        if count <= IN_LOOKUP_LIMIT:
+            return Book.objects.filter(isbn__in = index.isbns_in(bitmap)), count
+    return Book.objects.filter(facet_q(filters)), count
+
+
+def toggled(filters, facet, value):
+    """ `filters` with `value` of `facet` switched on or off """
+    values = list(filters.get(facet, []))
+    if value in values:
+        values.remove(value)
+    else:
+        values.append(value)
+    changed = dict(filters, **{facet: values})
+    return {facet: values for facet, values in changed.items() if values}
+
+
+def facet_counts(filters):
+    """ Sidebar entries, {facet: [{value, label, count, selected, query}]}. Counts for a facet
+    are within the filters on the other facets, so they say what choosing that value would show """
+    with _lock:
+        index = facet_index()
+        chosen = {facet: list(values) for facet, values in filters.items()}
+        publishers = index.largest('publisher', PUBLISHER_LIMIT)
+        publishers = sorted(set(publishers) | set(chosen.get('publisher', [])), key = str.lower)
+        options = {
+            'publisher': [(value, value) for value in publishers],
+            'decade': [(value, "%ds" % value) for value in sorted(index.bitmaps['decade'])],
+            'price': [(value, label) for value, label, low, high in PRICE_BANDS],
+        }
+        sidebar = {}
+        for facet in FACETS:
+            counts = index.counts(chosen, facet, [value for value, label in options[facet]])
+            sidebar[facet] = [
+                {'value': value, 'label': label, 'count': counts[value], 'selected': value in chosen.get(facet, []),
+                 'query': filter_query(toggled(chosen, facet, value))}
+                for value, label in options[facet]
+            ]
+        return sidebar
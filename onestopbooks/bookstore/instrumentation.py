@@ -0,0 +1,87 @@
+""" Per-request SQL query counting and timing.
+
+Every database connection gets one execute wrapper when it's created. While a request
+is being recorded (QueryInstrumentationMiddleware) the wrapper adds each query to the
+request's QueryStats, found through a contextvar so it also works in the threads that
+async views hand their queries to. Outside a request it does nothing.
+
+Queries are grouped by fingerprint, the SQL with literals and IN lists blanked out, so
+an N+1 loop shows up as one fingerprint run many times.
+"""
+import contextvars
+import re
+import time
+from collections import Counter
+
+FINGERPRINT_RULES = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"), # string literals
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"), # numbers
+    (re.compile(r"%s"), "?"), # parameters
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(...)"), # IN lists of any length
+    (re.compile(r"\s+"), " "),
+]
+
+_current = contextvars.ContextVar('query_stats', default = None)
+
+
+class QueryBudgetExceeded(Exception):
+    """ Raised when a view runs more queries than its budget and budgets are strict """
+
+
+def fingerprint(sql):
+    for pattern, replacement in FINGERPRINT_RULES:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+class QueryStats:
+    """ Queries run during one request """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.fingerprints = Counter()
+        self.statements = Counter() # exact sql and parameters, the same query run twice
+
+    def add(self, sql, params, many, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.fingerprints[fingerprint(sql)] += 1
+        if not many:
+            self.statements[(sql, repr(params))] += 1
+
+    def duplicates(self):
+        """ {fingerprint: times run} for fingerprints run more than once, most repeated first """
+        return {sql: number for sql, number in self.fingerprints.most_common() if number > 1}
+
+    def exact_duplicates(self):
+        """ Queries that repeated an earlier one with the same parameters """
+        return sum(number - 1 for number in self.statements.values())
+
+
+def record_query(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.add(sql, params, many, time.perf_counter() - started)
+
+
+def install(connection):
+    """ Add the wrapper to a connection, once """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def start():
+    """ Start recording queries for the current request """
+    stats = QueryStats()
+    _current.set(stats)
+    return stats
+
+
+def stop():
+    _current.set(None)
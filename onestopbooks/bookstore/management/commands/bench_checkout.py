@@ -0,0 +1,237 @@
+import json
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import django
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, OperationalError, connection, connections
+from django.db.models import Count, Sum
+from bookstore.models import Book, CartLine, Customer, Order
+from bookstore.benchmarks import benchmark_database, percentile, synthetic_book
+from bookstore.cart import update_cart
+from bookstore.checkout import OutOfStock, place_order
+
+SHOPPER_PREFIX = "shopper"
+ERROR_SAMPLES = 5 # distinct unexpected errors kept for the report
+
+
+def setup_shop(books, stock, customers, seed = 0):
+    """ Hot books with `stock` copies each and `customers` shoppers, returns (isbns, [(user id, customer id)]) """
+    rng = random.Random(seed)
+    hot = [synthetic_book(number, rng, []) for number in range(books)]
+    for book in hot:
+        book.quantity = stock
+    Book.objects.bulk_create(hot)
+    User.objects.bulk_create([User(username = "%s%d" % (SHOPPER_PREFIX, i), password = "!") for i in range(customers)])
+    user_ids = list(User.objects.filter(username__startswith = SHOPPER_PREFIX).order_by('id').values_list('id', flat = True))
+    Customer.objects.bulk_create([
+        Customer(user_id = user_id, first_name = "Shopper", last_name = str(i), email = "shopper%d@example.com" % i,
+                 address_1 = "123 S. Denver", city = "Denver", state = "Colorado", zip_code = "80123")
+        for i, user_id in enumerate(user_ids)
+    ])
+    shoppers = list(Customer.objects.filter(user_id__in = user_ids).order_by('user_id').values_list('user_id', 'id'))
+    return [book.isbn for book in hot], shoppers
+
+
+def new_tally():
+    return {'adds': 0, 'checkouts': 0, 'empty_checkouts': 0, 'out_of_stock': 0, 'locked': 0, 'errors': 0,
+            'add_ms': [], 'checkout_ms': [], 'error_samples': []}
+
+
+def attempt(tally, kind, call):
+    """ Run one cart add or checkout, counting how it ended. Returns (succeeded, result) """
+    started = time.perf_counter()
+    try:
+        return True, call()
+    except OutOfStock:
+        tally['out_of_stock'] += 1
+    except OperationalError as error:
+        # "database is locked", or "database table is locked" on a shared cache
+        if 'locked' in str(error):
+            tally['locked'] += 1
+        else:
+            unexpected(tally, error)
+    except DatabaseError as error:
+        unexpected(tally, error)
+    finally:
+        tally[kind + '_ms'].append((time.perf_counter() - started) * 1000)
+    return False, None
+
+
+def unexpected(tally, error):
+    tally['errors'] += 1
+    message = "%s: %s" % (type(error).__name__, error)
+    if message not in tally['error_samples'] and len(tally['error_samples']) < ERROR_SAMPLES:
+        tally['error_samples'].append(message)
+
+
+def run_session(job):
+    """ One simulated shopper: `rounds` times, add `cart_size` hot books one click at a time, then check out """
+    number, user_id, customer_id, isbns, rounds, cart_size = job
+    rng = random.Random(number)
+    tally = new_tally()
+    customer = Customer(pk = customer_id, user_id = user_id)
+    try:
+        for i in range(rounds):
+            for j in range(cart_size):
+                operations = [{'bookIsbn': rng.choice(isbns), 'action': 'add'}]
+                succeeded, result = attempt(tally, 'add', lambda: update_cart(customer, operations))
+                tally['adds'] += succeeded
+            key = "bench-%d-%d" % (number, i)
+            succeeded, order = attempt(tally, 'checkout', lambda: place_order(user_id, key))
+            if order is not None:
+                tally['checkouts'] += 1
+            elif succeeded:
+                tally['empty_checkouts'] += 1 # every add failed, or another session of the same shopper checked the cart out first
+    finally:
+        connection.close()
+    return tally
+
+
+def start_worker(database, timeout):
+    """ Process pool initializer. Forked workers inherit the set up Django, spawned ones start from scratch """
+    if not apps.ready:
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'onestopbooks.settings')
+        django.setup()
+    settings_dict = connections[DEFAULT_DB_ALIAS].settings_dict
+    settings_dict['NAME'] = database
+    settings_dict['OPTIONS']['timeout'] = timeout
+
+
+def run_sessions(jobs, workers, processes = False, timeout = 5):
+    """ Run the sessions `workers` at a time, returns (merged tally, seconds) """
+    connections[DEFAULT_DB_ALIAS].settings_dict['OPTIONS']['timeout'] = timeout
+    if processes:
+        # forked workers must not share the parent's sqlite handle
+        connections.close_all()
+        pool = ProcessPoolExecutor(max_workers = workers, initializer = start_worker,
+                                   initargs = (connections[DEFAULT_DB_ALIAS].settings_dict['NAME'], timeout))
+    else:
+        pool = ThreadPoolExecutor(max_workers = workers)
+    started = time.perf_counter()
+    with pool:
+        tallies = list(pool.map(run_session, jobs))
+    elapsed = time.perf_counter() - started
+
+    total = new_tally()
+    for tally in tallies:
+        for key, value in tally.items():
+            if key == 'error_samples':
+                total[key] += [message for message in value if message not in total[key]][:ERROR_SAMPLES - len(total[key])]
+            else:
+                total[key] += value
+    return total, elapsed
+
+
+def check_invariants(initial_stock, adds):
+    """ Stock accounting problems after a run, as messages. None means the books add up """
+    problems = []
+    sold = Counter(dict(CartLine.objects.filter(order__complete = True, product__in = list(initial_stock))
+                        .values_list('product').annotate(copies = Sum('quantity')).values_list('product', 'copies')))
+    for isbn, quantity in Book.objects.filter(isbn__in = list(initial_stock)).values_list('isbn', 'quantity'):
+        if quantity < 0:
+            problems.append("%s oversold: %d copies in stock" % (isbn, quantity))
+        if initial_stock[isbn] - quantity != sold[isbn]:
+            problems.append("%s: stock went from %d to %d, but completed orders hold %d copies"
+                            % (isbn, initial_stock[isbn], quantity, sold[isbn]))
+
+    # every successful add put one copy on a line, a lost update leaves fewer
+    on_lines = CartLine.objects.aggregate(copies = Sum('quantity'))['copies'] or 0
+    if on_lines != adds:
+        problems.append("%d cart adds succeeded but the carts hold %d copies" % (adds, on_lines))
+
+    carts = Order.objects.filter(complete = False).values_list('customer').annotate(open = Count('id')).filter(open__gt = 1)
+    if carts:
+        problems.append("%d customers have more than one open cart" % len(carts))
+    keys = Counter(Order.objects.filter(complete = True).values_list('transaction_id', flat = True))
+    if keys[None]:
+        problems.append("%d completed orders have no transaction id" % keys[None])
+    reused = [key for key, number in keys.items() if key is not None and number > 1]
+    if reused:
+        problems.append("%d transaction ids were used by more than one order" % len(reused))
+    return problems
+
+
+class Command(BaseCommand):
+    """ Concurrent add-to-cart and checkout load on a few hot books, checked for stock accounting errors """
+
+    help = ("Seed a separate database with a few hot books and many shoppers, then run the shoppers at once on "
+            "threads (or processes), each adding hot books to its cart and checking out, several rounds each. "
+            "Reports throughput, latency, 'database is locked' errors and out of stock rejections, then checks "
+            "that stock taken matches the copies in completed orders, nothing is oversold and no cart add was "
+            "lost. Fails if any of those checks does. The site's own database is never touched.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=5, help="Hot books every shopper picks from")
+        parser.add_argument('--stock', type=int, default=100, help="Copies of each hot book")
+        parser.add_argument('--customers', type=int, default=50, help="Shoppers")
+        parser.add_argument('--sessions-per-customer', type=int, default=1,
+                            help="Concurrent sessions sharing each shopper's cart, more than 1 races on the same cart")
+        parser.add_argument('--rounds', type=int, default=3, help="Checkouts each session tries")
+        parser.add_argument('--cart-size', type=int, default=3, help="Books added before each checkout")
+        parser.add_argument('--workers', type=int, default=16, help="Sessions running at once")
+        parser.add_argument('--processes', action='store_true', help="Run the sessions in processes instead of threads")
+        parser.add_argument('--busy-timeout', type=float, default=5, help="Seconds SQLite waits for a lock before 'database is locked'")
+        parser.add_argument('--wal', action='store_true', help="Put the benchmark database in WAL journal mode")
+        parser.add_argument('--database', help="SQLite file for the benchmark database, defaults to one in the temp directory")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed")
+        parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        for name in ('books', 'customers', 'sessions_per_customer', 'rounds', 'cart_size', 'workers'):
+            if options[name] < 1:
+                raise CommandError("--%s must be at least 1" % name.replace('_', '-'))
+        database = options['database'] or os.path.join(tempfile.gettempdir(), "onestopbooks-bench-checkout.sqlite3")
+
+        with benchmark_database(database) as bench_connection:
+            if options['wal']:
+                with bench_connection.cursor() as cursor:
+                    cursor.execute("PRAGMA journal_mode=WAL")
+            isbns, shoppers = setup_shop(options['books'], options['stock'], options['customers'], options['seed'])
+            jobs = [
+                (options['seed'] * 100000 + number, user_id, customer_id, isbns, options['rounds'], options['cart_size'])
+                for number, (user_id, customer_id) in enumerate(shoppers * options['sessions_per_customer'])
+            ]
+            random.Random(options['seed']).shuffle(jobs)
+            tally, elapsed = run_sessions(jobs, options['workers'], options['processes'], options['busy_timeout'])
+            problems = check_invariants({isbn: options['stock'] for isbn in isbns}, tally['adds'])
+
+        results = {
+            'sessions': len(jobs),
+            'workers': options['workers'],
+            'processes': options['processes'],
+            'wal': options['wal'],
+            'seconds': round(elapsed, 3),
+            'checkouts_per_second': round(tally['checkouts'] / elapsed, 1),
+            'operations_per_second': round((len(tally['add_ms']) + len(tally['checkout_ms'])) / elapsed, 1),
+            'add_p50_ms': round(percentile(tally['add_ms'], 0.50), 2),
+            'add_p95_ms': round(percentile(tally['add_ms'], 0.95), 2),
+            'checkout_p50_ms': round(percentile(tally['checkout_ms'], 0.50), 2),
+            'checkout_p95_ms': round(percentile(tally['checkout_ms'], 0.95), 2),
+            'invariant_violations': problems,
+        }
+        results.update((key, value) for key, value in tally.items() if not key.endswith('_ms'))
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent = 2))
+        else:
+            self.report(results)
+        if problems:
+            raise CommandError("Stock accounting is off:\n%s" % "\n".join(problems))
+
+    def report(self, results):
+        self.stdout.write("%(sessions)d sessions, %(workers)d at a time, in %(seconds).1fs" % results)
+        self.stdout.write("cart adds: %(adds)d ok, p50 %(add_p50_ms).1fms, p95 %(add_p95_ms).1fms" % results)
+        self.stdout.write("checkouts: %(checkouts)d placed, %(out_of_stock)d out of stock, %(empty_checkouts)d found "
+                          "no open cart, p50 %(checkout_p50_ms).1fms, p95 %(checkout_p95_ms).1fms" % results)
+        self.stdout.write("throughput: %(checkouts_per_second).1f checkouts/sec, %(operations_per_second).1f operations/sec" % results)
+        self.stdout.write("database is locked: %(locked)d, other errors: %(errors)d" % results)
+        for message in results['error_samples']:
+            self.stdout.write("  " + message)
+        if not results['invariant_violations']:
+            self.stdout.write(self.style.SUCCESS("Stock accounting adds up"))
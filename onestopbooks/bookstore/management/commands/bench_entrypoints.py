@@ -0,0 +1,169 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from bookstore.models import Book
+from bookstore.benchmarks import percentile
+
+ENTRY_POINTS = ('wsgi', 'asgi')
+
+
+def wsgi_request(application, host, path):
+    """ Send one GET through the WSGI application, returns (status, seconds) """
+    path, _, query = path.partition('?')
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+        'SERVER_NAME': host, 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_HOST': host,
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(), 'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+    }
+    statuses = []
+    started = time.perf_counter()
+    body = application(environ, lambda status, headers, exc_info = None: statuses.append(int(status.split()[0])))
+    try:
+        for chunk in body:
+            pass
+    finally:
+        body.close() # sends request_finished, which closes this thread's database connection
+    return statuses[0], time.perf_counter() - started
+
+
+async def asgi_request(application, host, path):
+    """ Send one GET through the ASGI application, returns (status, seconds) """
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+        'headers': [(b'host', host.encode())], 'client': ('127.0.0.1', 0), 'server': (host, 80),
+    }
+    requested = False
+    statuses = []
+
+    async def receive():
+        nonlocal requested
+        if requested:
+            return {'type': 'http.disconnect'}
+        requested = True
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            statuses.append(message['status'])
+
+    started = time.perf_counter()
+    await application(scope, receive, send)
+    return statuses[0], time.perf_counter() - started
+
+
+def run_wsgi(paths, host, concurrency):
+    application = get_wsgi_application()
+    # like a threaded WSGI server, each request holds one of `concurrency` threads until it's done
+    with ThreadPoolExecutor(max_workers = concurrency) as pool:
+        return list(pool.map(lambda path: wsgi_request(application, host, path), paths))
+
+
+def run_asgi(paths, host, concurrency):
+    application = get_asgi_application()
+
+    async def run():
+        # like an ASGI server, at most `concurrency` requests in flight on one event loop
+        slots = asyncio.Semaphore(concurrency)
+
+        async def one(path):
+            async with slots:
+                return await asgi_request(application, host, path)
+
+        return await asyncio.gather(*[one(path) for path in paths])
+
+    return asyncio.run(run())
+
+
+class Command(BaseCommand):
+    """ Compare concurrent-request throughput of the WSGI and ASGI entry points """
+
+    help = ("Send the same mix of catalog requests through wsgi.py and asgi.py at a fixed concurrency and report "
+            "requests per second and latency. Each entry point runs in its own process, the ASGI one with "
+            "ASYNC_VIEWS=1 as asgi.py sets it, so it uses the async views. The app is called in-process, "
+            "so the numbers leave out the web server itself.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', action='append', dest='paths',
+                            help="Path to request, can be repeated. Defaults to a mix of catalog pages")
+        parser.add_argument('--requests', type=int, default=400, help="Requests sent to each entry point")
+        parser.add_argument('--concurrency', type=int, default=16, help="Requests in flight at once")
+        parser.add_argument('--uncached', action='store_true',
+                            help="Add a unique query string to every request so none is a page cache hit")
+        parser.add_argument('--entry-point', choices=ENTRY_POINTS,
+                            help="Only run this entry point, in this process")
+        parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+
+    def default_paths(self):
+        paths = ['/books/', '/books/?sort=price_lh', '/newestbooks/', '/bookstore/search?searched=the']
+        isbns = list(Book.objects.order_by('isbn').values_list('isbn', flat=True)[:4])
+        return paths + ['/product/%s' % isbn for isbn in isbns]
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError("--requests and --concurrency must be at least 1")
+        if options['entry_point']:
+            results = {options['entry_point']: self.bench(options['entry_point'], options)}
+        else:
+            results = {entry_point: self.bench_in_process(entry_point, options) for entry_point in ENTRY_POINTS}
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent = 2))
+            return
+        for entry_point, result in results.items():
+            self.stdout.write("%s: %.1f requests/sec, p50 %.1fms, p95 %.1fms, %d errors" % (
+                entry_point, result['requests_per_second'], result['p50_ms'], result['p95_ms'], result['errors']))
+        if len(results) == len(ENTRY_POINTS) and results['wsgi']['requests_per_second']:
+            self.stdout.write(self.style.SUCCESS("asgi/wsgi throughput: %.2fx"
+                % (results['asgi']['requests_per_second'] / results['wsgi']['requests_per_second'])))
+
+    def bench_in_process(self, entry_point, options):
+        """ Run one entry point in a fresh process, so each gets its own url routing and cold caches """
+        command = [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'bench_entrypoints',
+                   '--entry-point', entry_point, '--json',
+                   '--requests', str(options['requests']), '--concurrency', str(options['concurrency'])]
+        for path in options['paths'] or []:
+            command += ['--path', path]
+        if options['uncached']:
+            command.append('--uncached')
+        environment = dict(os.environ, ASYNC_VIEWS = '1' if entry_point == 'asgi' else '0')
+        finished = subprocess.run(command, env = environment, capture_output = True, text = True)
+        if finished.returncode:
+            raise CommandError("The %s run failed:\n%s" % (entry_point, finished.stderr))
+        return json.loads(finished.stdout)[entry_point]
+
+    def bench(self, entry_point, options):
+        paths = options['paths'] or self.default_paths()
+        requests = [paths[i % len(paths)] for i in range(options['requests'])]
+        if options['uncached']:
+            requests = ['%s%sbench=%d' % (path, '&' if '?' in path else '?', i) for i, path in enumerate(requests)]
+        host = settings.ALLOWED_HOSTS[0] if settings.ALLOWED_HOSTS else 'localhost'
+        run = run_asgi if entry_point == 'asgi' else run_wsgi
+
+        run(paths, host, options['concurrency']) # warm up templates, connections and caches
+        started = time.perf_counter()
+        responses = run(requests, host, options['concurrency'])
+        elapsed = time.perf_counter() - started
+
+        latencies = [seconds * 1000 for status, seconds in responses]
+        return {
+            'async_views': settings.ASYNC_VIEWS,
+            'requests': len(responses),
+            'concurrency': options['concurrency'],
+            'errors': sum(1 for status, seconds in responses if status != 200),
+            'seconds': round(elapsed, 3),
+            'requests_per_second': round(len(responses) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+        }
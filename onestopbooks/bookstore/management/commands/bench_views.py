@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import platform
+import tempfile
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from django.utils import timezone
+from bookstore.models import Book
+from bookstore import benchmarks
+
+# the page cache would turn every anonymous page after the first into a cache hit
+NO_PAGE_CACHE = {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+
+
+class Command(BaseCommand):
+    """ Latency and query count benchmark for every public page at catalog scale """
+
+    help = ("Seed a separate benchmark database with a synthetic catalog, reviews and a cart, request every public "
+            "page through the test client and report p50/p95/p99 latency and query counts. Results can be written "
+            "to JSON and compared with an earlier run's file to flag regressions. Seeding a large catalog takes a "
+            "while, --keepdb reuses the database between runs. The site's own database is never touched.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=10000, help="Books in the synthetic catalog")
+        parser.add_argument('--reviews-per-book', type=int, default=2, help="Average reviews per book")
+        parser.add_argument('--cart-lines', type=int, default=10, help="Lines in the logged in user's cart")
+        parser.add_argument('--requests', type=int, default=50, help="Timed requests per page")
+        parser.add_argument('--view', action='append', dest='views', choices=list(benchmarks.SCENARIOS),
+                            help="Only benchmark this page, can be repeated")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for the catalog and the requests")
+        parser.add_argument('--database', help="SQLite file for the benchmark database, defaults to one per catalog size in the temp directory")
+        parser.add_argument('--keepdb', action='store_true', help="Reuse the benchmark database if it exists and keep it afterwards")
+        parser.add_argument('--page-cache', action='store_true', help="Leave the anonymous page cache on")
+        parser.add_argument('--output', help="Write the results to this JSON file")
+        parser.add_argument('--baseline', help="JSON file from an earlier run to compare against")
+        parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed p50/p95 slowdown against the baseline, 0.25 is 25%%")
+
+    def handle(self, *args, **options):
+        if options['books'] < 1 or options['requests'] < 1:
+            raise CommandError("--books and --requests must be at least 1")
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        database = options['database'] or os.path.join(tempfile.gettempdir(), "onestopbooks-bench-%d.sqlite3" % options['books'])
+        caches = dict(settings.CACHES)
+        if not options['page_cache']:
+            caches[settings.PAGE_CACHE_ALIAS] = NO_PAGE_CACHE
+
+        # per-request query log lines would drown the report, budget warnings still show
+        query_logger = logging.getLogger('bookstore.queries')
+        log_level = query_logger.level
+        query_logger.setLevel(logging.WARNING)
+        try:
+            with benchmarks.benchmark_database(database, options['keepdb']), override_settings(CACHES = caches):
+                results = self.run_benchmark(options)
+        finally:
+            query_logger.setLevel(log_level)
+
+        self.report(results['views'])
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent = 2)
+        if baseline is not None:
+            self.check_baseline(results, baseline, options['tolerance'])
+
+    def run_benchmark(self, options):
+        books = Book.objects.count()
+        if books == 0:
+            self.stdout.write("Seeding %d books..." % options['books'])
+            user = benchmarks.seed_catalog(options['books'], options['reviews_per_book'], options['cart_lines'], seed = options['seed'])
+        elif books == options['books']:
+            user = benchmarks.User.objects.get(username = benchmarks.BENCH_USERNAME)
+        else:
+            raise CommandError("The kept benchmark database has %d books, not %d. Drop --keepdb to reseed it" % (books, options['books']))
+
+        user_client = Client()
+        user_client.force_login(user)
+        views = benchmarks.run_scenarios(Client(), user_client, options['requests'], seed = options['seed'], names = options['views'])
+        return {
+            'meta': {
+                'books': options['books'],
+                'reviews_per_book': options['reviews_per_book'],
+                'cart_lines': options['cart_lines'],
+                'requests': options['requests'],
+                'page_cache': options['page_cache'],
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'date': timezone.now().isoformat(),
+            },
+            'views': views,
+        }
+
+    def report(self, views):
+        self.stdout.write("%-20s %9s %9s %9s %8s %7s" % ("view", "p50 ms", "p95 ms", "p99 ms", "queries", "errors"))
+        for name, result in views.items():
+            self.stdout.write("%-20s %9.2f %9.2f %9.2f %8d %7d" % (
+                name, result['p50_ms'], result['p95_ms'], result['p99_ms'], result['queries'], result['errors']))
+
+    def check_baseline(self, results, baseline, tolerance):
+        for key in ('books', 'reviews_per_book', 'cart_lines', 'page_cache'):
+            if baseline['meta'].get(key) != results['meta'][key]:
+                self.stderr.write("The baseline was run with %s=%s, this run with %s" % (key, baseline['meta'].get(key), results['meta'][key]))
+        regressions = benchmarks.compare(results['views'], baseline['views'], tolerance)
+        if regressions:
+            raise CommandError("Regressions against %s:\n%s" % ("the baseline", "\n".join(regressions)))
+        self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
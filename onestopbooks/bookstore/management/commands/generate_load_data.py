@@ -0,0 +1,217 @@
+import bisect
+import csv
+import os
+import random
+import time
+from itertools import accumulate
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from bookstore.models import Book, CartLine, Customer, Order, ReviewRating
+from bookstore import catalog, facets, page_cache, search
+from bookstore.management.commands import load_catalog, load_customers
+
+USERNAME_PREFIX = "load"
+REVIEW_WORDS = ["great", "slow", "loved", "characters", "ending", "classic", "boring", "moving", "recommend", "plot"]
+
+
+class ZipfSampler:
+    """ Picks books with Zipf distributed popularity: the book of rank k is picked in
+    proportion to 1 / k ** exponent. Ranks are a seeded shuffle of the catalog """
+
+    def __init__(self, isbns, exponent, rng):
+        self.isbns = sorted(isbns)
+        rng.shuffle(self.isbns)
+        self.cumulative = list(accumulate(1 / rank ** exponent for rank in range(1, len(self.isbns) + 1)))
+        self.rng = rng
+
+    def pick(self):
+        point = self.rng.random() * self.cumulative[-1]
+        return self.isbns[min(bisect.bisect_right(self.cumulative, point), len(self.isbns) - 1)]
+
+
+class Command(BaseCommand):
+    """ Generate customers, orders, cart lines and reviews that look like production traffic """
+
+    help = ("Generate customers (based on bookstore/customers.csv), their completed and abandoned orders with buy "
+            "and rent lines, and reviews, with Zipf skewed book popularity. The same --seed and catalog give the "
+            "same rows. Rows are written in batches, so memory stays flat however many are asked for. Books come "
+            "from the current catalog, bookstore/books.csv is loaded first when it's empty.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=10000, help="Customers to generate")
+        parser.add_argument('--orders-per-customer', type=float, default=3, help="Average orders per customer")
+        parser.add_argument('--lines-per-order', type=float, default=3, help="Average lines per order")
+        parser.add_argument('--rent-ratio', type=float, default=0.3, help="Share of lines that are rentals")
+        parser.add_argument('--abandonment', type=float, default=0.25,
+                            help="Share of customers whose latest cart was abandoned, left open with lines in it")
+        parser.add_argument('--reviews-per-book', type=float, default=5, help="Average reviews per book")
+        parser.add_argument('--zipf', type=float, default=1.1, help="Zipf exponent for book popularity, 0 is uniform")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed")
+        parser.add_argument('--batch-size', type=int, default=500, help="Customers, or reviews, written per transaction")
+        parser.add_argument('--customers-csv', default=os.path.join(settings.BASE_DIR, 'bookstore', 'customers.csv'))
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['customers'] < 0:
+            raise CommandError("--batch-size must be at least 1 and --customers at least 0")
+        for ratio in ('rent_ratio', 'abandonment'):
+            if not 0 <= options[ratio] <= 1:
+                raise CommandError("--%s must be between 0 and 1" % ratio.replace('_', '-'))
+        if User.objects.filter(username__startswith = USERNAME_PREFIX).exists():
+            raise CommandError("Generated customers are already in this database, start from a fresh one")
+
+        self.options = options
+        self.rng = random.Random(options['seed'])
+        self.started = time.monotonic()
+        self.counts = {'customers': 0, 'orders': 0, 'open': 0, 'lines': 0, 'reviews': 0}
+        self.user_ids = None # (lowest, highest) id of the generated users
+        self.seeds = self.read_customers(options['customers_csv'])
+        if not Book.objects.exists():
+            self.load_books()
+        self.books = ZipfSampler(Book.objects.values_list('isbn', flat = True), options['zipf'], self.rng)
+
+        for start in range(0, options['customers'], options['batch_size']):
+            self.generate_customers(start, min(options['customers'], start + options['batch_size']))
+            self.progress()
+        self.generate_reviews()
+
+        # stored rating totals, the cached counts and cached pages are all out of date now
+        call_command('rebuild_ratings', verbosity = 0)
+        catalog.books_added_or_removed()
+        page_cache.catalog_changed()
+        self.stdout.write(self.style.SUCCESS(
+            "Generated %(customers)d customers, %(orders)d orders (%(open)d abandoned carts), %(lines)d lines and %(reviews)d reviews" % self.counts
+            + " in %.1fs" % (time.monotonic() - self.started)))
+
+    def read_customers(self, path):
+        try:
+            with open(path, newline = '', encoding = 'utf-8') as csv_file:
+                seeds = []
+                for row in csv.reader(csv_file):
+                    try:
+                        seeds.append(load_customers.parse_row(row))
+                    except ValueError:
+                        continue
+        except OSError as error:
+            raise CommandError("Could not open customer file: %s" % error)
+        if not seeds:
+            raise CommandError("No usable rows in %s" % path)
+        return seeds
+
+    def load_books(self):
+        path = os.path.join(settings.BASE_DIR, 'bookstore', 'books.csv')
+        with open(path, newline = '', encoding = 'utf-8') as csv_file:
+            books = {}
+            for row in csv.reader(csv_file):
+                try:
+                    book = load_catalog.parse_row(row)
+                except ValueError:
+                    continue
+                books.setdefault(book.isbn, book)
+        Book.objects.bulk_create(books.values())
+        search.rebuild_index()
+        facets.books_changed()
+
+    def new_customer(self, number):
+        """ Unsaved (User, Customer) for generated customer `number`, a variation on a seed row """
+        seed_user, seed_customer = self.seeds[number % len(self.seeds)]
+        local, domain = seed_user.email.split('@', 1)
+        email = "%s+%s%d@%s" % (local, USERNAME_PREFIX, number, domain)
+        user = User(username = "%s%07d" % (USERNAME_PREFIX, number), email = email, password = "!", # unusable password
+                    first_name = seed_user.first_name, last_name = seed_user.last_name)
+        customer = Customer(first_name = seed_customer.first_name, last_name = seed_customer.last_name, email = email,
+                            address_1 = seed_customer.address_1, city = seed_customer.city,
+                            state = seed_customer.state, zip_code = seed_customer.zip_code)
+        return user, customer
+
+    def around(self, mean):
+        """ A random count averaging about `mean`, exponentially distributed so most are small and a few are big """
+        return round(self.rng.expovariate(1 / mean)) if mean > 0 else 0
+
+    def new_lines(self):
+        """ Unsaved lines for one order, at most one buy and one rent line per book as the cart allows """
+        lines = {}
+        for i in range(max(1, self.around(self.options['lines_per_order']))):
+            line_type = CartLine.RENT if self.rng.random() < self.options['rent_ratio'] else CartLine.BUY
+            quantity = 1 if line_type == CartLine.RENT else self.rng.choice([1, 1, 1, 2, 3])
+            lines.setdefault((self.books.pick(), line_type), quantity)
+        return [CartLine(product_id = isbn, line_type = line_type, quantity = quantity) for (isbn, line_type), quantity in lines.items()]
+
+    def generate_customers(self, start, end):
+        accounts = [self.new_customer(number) for number in range(start, end)]
+        # every customer's orders, oldest first: [(complete, transaction id, lines)]
+        histories = []
+        for number in range(start, end):
+            orders = [(True, "%s-%d-%d" % (USERNAME_PREFIX, number, i), self.new_lines())
+                      for i in range(self.around(self.options['orders_per_customer']))]
+            if self.rng.random() < self.options['abandonment']:
+                orders.append((False, None, self.new_lines()))
+            histories.append(orders)
+
+        with transaction.atomic():
+            users = [user for user, customer in accounts]
+            User.objects.bulk_create(users)
+            # look the ids up again, bulk_create doesn't return them on every database
+            user_ids = dict(User.objects.filter(username__in = [user.username for user in users]).values_list('username', 'id'))
+            lowest, highest = min(user_ids.values()), max(user_ids.values())
+            if self.user_ids is not None:
+                lowest, highest = min(lowest, self.user_ids[0]), max(highest, self.user_ids[1])
+            self.user_ids = (lowest, highest)
+            customers = []
+            for user, customer in accounts:
+                customer.user_id = user_ids[user.username]
+                customers.append(customer)
+            Customer.objects.bulk_create(customers)
+            customer_ids = dict(Customer.objects.filter(user_id__in = list(user_ids.values())).values_list('user_id', 'id'))
+            customer_ids = [customer_ids[user_ids[user.username]] for user in users]
+
+            Order.objects.bulk_create([
+                Order(customer_id = customer_id, complete = complete, transaction_id = transaction_id)
+                for customer_id, orders in zip(customer_ids, histories) for complete, transaction_id, lines in orders
+            ])
+            order_ids = {}
+            for order_id, customer_id in Order.objects.filter(customer_id__in = customer_ids).order_by('id').values_list('id', 'customer_id'):
+                order_ids.setdefault(customer_id, []).append(order_id)
+            lines = []
+            for customer_id, orders in zip(customer_ids, histories):
+                for order_id, (complete, transaction_id, order_lines) in zip(order_ids.get(customer_id, []), orders):
+                    for line in order_lines:
+                        line.order_id = order_id
+                        lines.append(line)
+            CartLine.objects.bulk_create(lines, batch_size = 5000)
+
+        self.counts['customers'] += len(accounts)
+        self.counts['orders'] += sum(len(orders) for orders in histories)
+        self.counts['open'] += sum(1 for orders in histories if orders and not orders[-1][0])
+        self.counts['lines'] += len(lines)
+
+    def generate_reviews(self):
+        """ About reviews_per_book reviews per book, popular books get more, written by generated customers.
+
+        Customers are inserted in order a batch at a time, so their ids are the range recorded while
+        generating them and a reviewer is a random number in it, without loading every id. An account
+        someone else created between two batches falls inside the range too, which a load test doesn't mind.
+        """
+        total = round(len(self.books.isbns) * self.options['reviews_per_book'])
+        if self.user_ids is None:
+            return
+        lowest, highest = self.user_ids
+        for start in range(0, total, self.options['batch_size']):
+            reviews = [
+                ReviewRating(user_id = self.rng.randint(lowest, highest), book_id = self.books.pick(), subject = "Review",
+                             review = " ".join(self.rng.choice(REVIEW_WORDS) for i in range(self.rng.randint(3, 30))),
+                             rate = self.rng.choice([1, 2, 3, 3.5, 4, 4, 4.5, 5, 5]))
+                for i in range(min(self.options['batch_size'], total - start))
+            ]
+            ReviewRating.objects.bulk_create(reviews)
+            self.counts['reviews'] += len(reviews)
+            self.progress()
+
+    def progress(self):
+        if self.options['verbosity'] >= 1:
+            elapsed = time.monotonic() - self.started
+            rows = sum(self.counts.values()) - self.counts['open']
+            self.stdout.write("%(customers)d customers, %(orders)d orders, %(lines)d lines, %(reviews)d reviews" % self.counts
+                              + " (%.0f rows/sec)" % (rows / elapsed if elapsed else 0))
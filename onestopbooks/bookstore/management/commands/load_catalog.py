@@ -0,0 +1,113 @@
+import csv
+import html
+import os
+import time
+from datetime import timedelta
+from itertools import islice
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from bookstore.models import Book
+from bookstore import catalog, facets, page_cache, search
+
+# books.csv columns: id, isbn, title, authors, year, publisher, image url, price, quantity
+CSV_COLUMNS = 9
+UPDATE_FIELDS = ['title', 'authors', 'year_public', 'publisher', 'image_url', 'price', 'quantity']
+
+
+def parse_row(row):
+    """ Build an unsaved Book from one catalog row, raises ValueError for a bad row """
+    if len(row) != CSV_COLUMNS:
+        raise ValueError("expected %d columns, got %d" % (CSV_COLUMNS, len(row)))
+    row_id, isbn, title, authors, year, publisher, image_url, price, quantity = [html.unescape(value.strip()) for value in row]
+    if not isbn:
+        raise ValueError("missing isbn")
+    return Book(
+        isbn = isbn[:Book._meta.get_field('isbn').max_length],
+        title = title[:Book._meta.get_field('title').max_length],
+        authors = authors[:Book._meta.get_field('authors').max_length],
+        year_public = int(year) if year and year != "0" else None,
+        publisher = publisher[:Book._meta.get_field('publisher').max_length] or None,
+        image_url = image_url or None,
+        price = int(price),
+        quantity = int(quantity),
+    )
+
+
+class Command(BaseCommand):
+    """ Stream a catalog CSV into the Book table in batches """
+
+    help = "Load or update books from a catalog CSV (defaults to bookstore/books.csv), upserting on isbn"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=os.path.join(settings.BASE_DIR, 'bookstore', 'books.csv'))
+        parser.add_argument('--batch-size', type=int, default=500, help="Rows read, checked and written per transaction")
+        parser.add_argument('--encoding', default='utf-8')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1")
+        try:
+            csv_file = open(options['path'], newline='', encoding=options['encoding'])
+        except OSError as error:
+            raise CommandError("Could not open catalog: %s" % error)
+
+        started = time.monotonic()
+        loaded_at = timezone.now()
+        created = updated = skipped = 0
+        with csv_file:
+            reader = csv.reader(csv_file)
+            line = 0
+            # only one batch of rows is ever held in memory
+            while True:
+                rows = list(islice(reader, batch_size))
+                if not rows:
+                    break
+                books = {}
+                for row in rows:
+                    line += 1
+                    try:
+                        book = parse_row(row)
+                    except ValueError as error:
+                        skipped += 1
+                        self.stderr.write("Skipping line %d: %s" % (line, error))
+                        continue
+                    # new books keep the feed's order in the newest arrivals list
+                    book.date_added = loaded_at + timedelta(microseconds = line)
+                    books[book.isbn] = book # a later row for the same isbn wins
+
+                batch_created, batch_updated = self.save_batch(list(books.values()))
+                created += batch_created
+                updated += batch_updated
+                if options['verbosity'] >= 1:
+                    elapsed = time.monotonic() - started
+                    self.stdout.write("%d rows, %d created, %d updated, %d skipped (%.0f rows/sec)"
+                                      % (line, created, updated, skipped, line / elapsed if elapsed else 0))
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS("Loaded catalog in %.1fs: %d created, %d updated, %d skipped"
+                                             % (elapsed, created, updated, skipped)))
+
+    def save_batch(self, books):
+        """ Insert new books and update existing ones in one transaction, returns (created, updated) """
+        if not books:
+            return 0, 0
+        with transaction.atomic():
+            existing = set(Book.objects.filter(isbn__in = [book.isbn for book in books]).values_list('isbn', flat=True))
+            new_books = [book for book in books if book.isbn not in existing]
+            old_books = [book for book in books if book.isbn in existing]
+            Book.objects.bulk_create(new_books)
+            if old_books:
+                for book in old_books:
+                    book.version = F('version') + 1 # retire the cached book cards
+                Book.objects.bulk_update(old_books, UPDATE_FIELDS + ['version'])
+            # bulk writes skip the post_save receivers, so index the batch here
+            search.index_books(books)
+        if new_books:
+            catalog.books_added_or_removed()
+        facets.books_changed()
+        page_cache.catalog_changed()
+        return len(new_books), len(old_books)
@@ -0,0 +1,151 @@
+import csv
+import os
+import secrets
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from bookstore.models import Customer
+from bookstore.workers import init_worker
+
+# customers.csv columns: first name, last name, email, address, city, state, zip code
+CSV_COLUMNS = 7
+
+
+def parse_row(row):
+    """ Build an unsaved (User, Customer) pair from one customer row, raises ValueError for a bad row """
+    if len(row) != CSV_COLUMNS:
+        raise ValueError("expected %d columns, got %d" % (CSV_COLUMNS, len(row)))
+    first_name, last_name, email, address, city, state, zip_code = [value.strip() for value in row]
+    if not email:
+        raise ValueError("missing email")
+    username = email.lower()
+    user = User(username = username, email = email, first_name = first_name[:150], last_name = last_name[:150])
+    customer = Customer(
+        first_name = first_name[:30],
+        last_name = last_name[:30],
+        email = email,
+        address_1 = address[:128],
+        city = city[:128],
+        state = state[:128],
+        zip_code = zip_code[:5],
+    )
+    return user, customer
+
+
+class Command(BaseCommand):
+    """ Bulk create customer accounts from a CSV """
+
+    help = ("Create a User and linked Customer for every row of a customer CSV (defaults to bookstore/customers.csv). "
+            "Rows whose email already has an account are skipped, so an interrupted import can simply be re-run.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=os.path.join(settings.BASE_DIR, 'bookstore', 'customers.csv'))
+        parser.add_argument('--batch-size', type=int, default=500, help="Accounts created per transaction")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Processes used to hash passwords, 1 hashes in this process")
+        parser.add_argument('--credentials-out',
+                            help="Append the generated username,password pairs to this CSV. If an import is "
+                                 "interrupted and re-run, a username's later row is its password")
+        parser.add_argument('--unusable-passwords', action='store_true',
+                            help="Create the accounts without passwords, customers then need a password reset to log in")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1 or options['workers'] < 1:
+            raise CommandError("--batch-size and --workers must be at least 1")
+        if not options['credentials_out'] and not options['unusable_passwords']:
+            raise CommandError("Give --credentials-out to keep the generated passwords, "
+                               "or --unusable-passwords to create the accounts without any")
+        if options['credentials_out'] and options['unusable_passwords']:
+            raise CommandError("--credentials-out and --unusable-passwords can't be used together")
+        try:
+            csv_file = open(options['path'], newline='', encoding='utf-8')
+        except OSError as error:
+            raise CommandError("Could not open customer file: %s" % error)
+
+        started = time.monotonic()
+        created = existing = skipped = line = 0
+        with csv_file:
+            # password hashing is CPU bound, so it is spread over a process pool
+            pool = None
+            if options['workers'] > 1:
+                pool = ProcessPoolExecutor(max_workers = options['workers'], initializer = init_worker)
+            try:
+                reader = csv.reader(csv_file)
+                while True:
+                    rows = list(islice(reader, batch_size))
+                    if not rows:
+                        break
+                    accounts = {}
+                    for row in rows:
+                        line += 1
+                        try:
+                            user, customer = parse_row(row)
+                        except ValueError as error:
+                            skipped += 1
+                            self.stderr.write("Skipping line %d: %s" % (line, error))
+                            continue
+                        accounts.setdefault(user.username, (user, customer))
+
+                    # accounts from an earlier, interrupted run are already committed
+                    done = set(User.objects.filter(username__in = list(accounts)).values_list('username', flat=True))
+                    existing += len(done)
+                    accounts = [account for username, account in accounts.items() if username not in done]
+                    created += self.create_accounts(accounts, pool, options)
+
+                    if options['verbosity'] >= 1:
+                        elapsed = time.monotonic() - started
+                        self.stdout.write("%d rows, %d created, %d already existed, %d skipped (%.0f accounts/sec)"
+                                          % (line, created, existing, skipped, created / elapsed if elapsed else 0))
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+
+        self.stdout.write(self.style.SUCCESS("Created %d customers, %d already existed, %d skipped"
+                                             % (created, existing, skipped)))
+
+    def create_accounts(self, accounts, pool, options):
+        """ Hash passwords and insert one batch of users and customers, returns the number created """
+        if not accounts:
+            return 0
+        users = [user for user, customer in accounts]
+        if options['unusable_passwords']:
+            passwords = None
+            for user in users:
+                user.set_unusable_password()
+        else:
+            passwords = [secrets.token_urlsafe(12) for account in accounts]
+            if pool is None:
+                hashes = [make_password(password) for password in passwords]
+            else:
+                chunksize = max(1, len(passwords) // (options['workers'] * 4))
+                hashes = list(pool.map(make_password, passwords, chunksize = chunksize))
+            for user, password_hash in zip(users, hashes):
+                user.password = password_hash
+
+        with transaction.atomic():
+            User.objects.bulk_create(users)
+            # look the ids up again, bulk_create doesn't return them on every database
+            ids = dict(User.objects.filter(username__in = [user.username for user in users]).values_list('username', 'id'))
+            customers = []
+            for user, customer in accounts:
+                customer.user_id = ids[user.username]
+                customers.append(customer)
+            Customer.objects.bulk_create(customers)
+            # on disk before the accounts are committed, so a crash can't leave accounts nobody has the password to
+            if passwords is not None:
+                self.save_credentials(options['credentials_out'], users, passwords)
+        return len(accounts)
+
+    def save_credentials(self, path, users, passwords):
+        with open(path, 'a', newline='', encoding='utf-8') as out:
+            writer = csv.writer(out)
+            for user, password in zip(users, passwords):
+                writer.writerow([user.username, password])
+            out.flush()
+            os.fsync(out.fileno())
@@ -0,0 +1,90 @@
+import asyncio
+import queue
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F, Q
+from bookstore.models import Book
+from bookstore import page_cache, thumbnails
+from bookstore.mirror import Mirror
+
+
+class Command(BaseCommand):
+    """ Download catalog cover images into our own storage """
+
+    help = ("Download the image_url of every book that has no thumbnail_pic yet, store it once per distinct "
+            "image and point the book at it. Books that are done are skipped, so an interrupted run can simply be re-run.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=8, help="Downloads in flight at once")
+        parser.add_argument('--retries', type=int, default=3, help="Extra attempts for timeouts, rate limits and server errors")
+        parser.add_argument('--backoff', type=float, default=0.5, help="Seconds before the first retry, doubled for each further one")
+        parser.add_argument('--timeout', type=float, default=10, help="Seconds to wait for one download")
+        parser.add_argument('--batch-size', type=int, default=50, help="Books saved per transaction")
+        parser.add_argument('--limit', type=int, help="Only mirror this many books")
+        parser.add_argument('--skip-thumbnails', action='store_true',
+                            help="Don't make the resized copies now, run rebuild_thumbnails afterwards instead")
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1 or options['batch_size'] < 1 or options['retries'] < 0:
+            raise CommandError("--concurrency and --batch-size must be at least 1, --retries at least 0")
+        self.options = options
+        self.saved = 0
+        self.started = time.monotonic()
+
+        books = (Book.objects.filter(Q(thumbnail_pic = "") | Q(thumbnail_pic = None))
+                 .exclude(image_url = None).exclude(image_url = "").order_by('isbn'))
+        if options['limit']:
+            books = books[:options['limit']]
+        jobs = list(books.values_list('isbn', 'image_url'))
+
+        # downloads run on an event loop in a second thread, the database is only used from this one
+        finished = queue.Queue()
+        mirror = Mirror(
+            finished.put,
+            concurrency = options['concurrency'],
+            retries = options['retries'],
+            backoff = options['backoff'],
+            timeout = options['timeout'],
+            batch_size = options['batch_size'],
+        )
+        errors = []
+
+        def download():
+            try:
+                asyncio.run(mirror.run(jobs))
+            except BaseException as error:
+                errors.append(error)
+            finally:
+                finished.put(None)
+
+        thread = threading.Thread(target = download, name = "mirror_thumbnails", daemon = True)
+        thread.start()
+        for results in iter(finished.get, None):
+            self.save_results(results)
+        thread.join()
+        if errors:
+            raise errors[0]
+
+        for isbn, url, error in mirror.failures:
+            self.stderr.write("Failed %s (%s): %s" % (isbn, url, error))
+        if self.saved:
+            page_cache.catalog_changed()
+        self.stdout.write(self.style.SUCCESS(
+            "Mirrored %d of %d books in %.1fs: %d new images, %d already stored, %d failed"
+            % (self.saved, len(jobs), time.monotonic() - self.started, mirror.stored, mirror.deduplicated, len(mirror.failures))))
+
+    def save_results(self, results):
+        """ Point a batch of books at their stored images """
+        with transaction.atomic():
+            for isbn, name in results:
+                # still unset, the admin may have uploaded a cover while we were downloading
+                self.saved += Book.objects.filter(Q(thumbnail_pic = "") | Q(thumbnail_pic = None), isbn = isbn).update(
+                    thumbnail_pic = name, version = F('version') + 1)
+        if not self.options['skip_thumbnails']:
+            for book in Book.objects.filter(isbn__in = [isbn for isbn, name in results]):
+                thumbnails.update_thumbnails(book)
+        if self.options['verbosity'] >= 1:
+            elapsed = time.monotonic() - self.started
+            self.stdout.write("%d books mirrored (%.1f books/sec)" % (self.saved, self.saved / elapsed if elapsed else 0))
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
+from bookstore.models import Book
+from bookstore import page_cache
+
+
+class Command(BaseCommand):
+    """ Backfill or repair the stored rating totals on Book from the ReviewRating table """
+
+    help = "Recompute Book.rating_count, rating_sum and rating_average for books whose stored totals are out of date"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Number of books to update per query")
+        parser.add_argument('--dry-run', action='store_true', help="Only report how many books are out of date")
+
+    def handle(self, *args, **options):
+        # only books whose stored totals disagree with their reviews are touched
+        books = Book.objects.annotate(
+            actual_count = Count('reviewrating'),
+            actual_sum = Coalesce(Sum('reviewrating__rate'), 0.0),
+        ).filter(~Q(rating_count = F('actual_count')) | ~Q(rating_sum = F('actual_sum')))
+        books = books.only('isbn', 'rating_count', 'rating_sum', 'rating_average').order_by('isbn')
+
+        # walk the catalog in isbn order one batch at a time, so memory stays flat and
+        # we never write to the table while a cursor over it is still open
+        repaired = 0
+        last_isbn = ""
+        while True:
+            batch = list(books.filter(isbn__gt = last_isbn)[:options['batch_size']])
+            if not batch:
+                break
+            for book in batch:
+                book.rating_count = book.actual_count
+                book.rating_sum = book.actual_sum
+                book.rating_average = book.actual_sum / book.actual_count if book.actual_count else 0
+                book.version = F('version') + 1 # retire the cached book cards and product page ETags
+            if not options['dry_run']:
+                with transaction.atomic():
+                    Book.objects.bulk_update(batch, ['rating_count', 'rating_sum', 'rating_average', 'version'])
+            repaired += len(batch)
+            last_isbn = batch[-1].isbn
+
+        if repaired and not options['dry_run']:
+            page_cache.catalog_changed()
+
+        if options['verbosity'] < 1:
+            return
+        if options['dry_run']:
+            self.stdout.write("%d books have out of date rating totals" % repaired)
+        else:
+            self.stdout.write(self.style.SUCCESS("Repaired rating totals for %d books" % repaired))
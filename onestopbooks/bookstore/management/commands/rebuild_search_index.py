@@ -0,0 +1,20 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from bookstore import search
+
+
+class Command(BaseCommand):
+    """ Rebuild the full-text search index from the Book table """
+
+    help = "Re-create the SQLite FTS5 search index and re-index every book"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Number of books to index per batch")
+
+    def handle(self, *args, **options):
+        if not search.create_index():
+            raise CommandError("The full-text index is only available on SQLite")
+        started = time.monotonic()
+        total = search.rebuild_index(batch_size = options['batch_size'])
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS("Indexed %d books in %.1fs" % (total, elapsed)))
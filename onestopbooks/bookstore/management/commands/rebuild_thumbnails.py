@@ -0,0 +1,83 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+from bookstore.models import Book
+from bookstore import page_cache, thumbnails
+from bookstore.workers import init_worker
+
+
+def thumbnail_job(job):
+    """ Resize one cover, runs in a pool worker. Returns (isbn, thumbnails or None, error) """
+    isbn, source = job
+    try:
+        return isbn, thumbnails.make_thumbnails(source), None
+    except OSError as error:
+        return isbn, None, str(error)
+
+
+class Command(BaseCommand):
+    """ Regenerate the resized cover images for the whole catalog """
+
+    help = ("Write the cart, grid and detail sized copies (JPEG, and WebP when Pillow supports it) of every "
+            "uploaded book cover. Books whose copies are already up to date are skipped unless --force is given.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Regenerate every book, not just the out of date ones")
+        parser.add_argument('--batch-size', type=int, default=200, help="Books resized and saved per batch")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Processes used for resizing, 1 resizes in this process")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1 or options['workers'] < 1:
+            raise CommandError("--batch-size and --workers must be at least 1")
+        if not thumbnails.webp_supported():
+            self.stderr.write("This Pillow build can't write WebP, only JPEG copies will be made")
+
+        # resizing is CPU bound, so it is spread over a process pool
+        pool = None
+        if options['workers'] > 1:
+            pool = ProcessPoolExecutor(max_workers = options['workers'], initializer = init_worker)
+
+        started = time.monotonic()
+        done = failed = 0
+        last_isbn = ""
+        books = Book.objects.exclude(thumbnail_pic = "").exclude(thumbnail_pic = None).only('isbn', 'thumbnail_pic', 'thumbnails').order_by('isbn')
+        try:
+            while True:
+                batch = list(books.filter(isbn__gt = last_isbn)[:batch_size])
+                if not batch:
+                    break
+                last_isbn = batch[-1].isbn
+                jobs = [(book.isbn, book.thumbnail_pic.name) for book in batch
+                        if thumbnails.is_stored_file(book.thumbnail_pic.name)
+                        and (options['force'] or thumbnails.needs_thumbnails(book))]
+                if pool is None:
+                    results = map(thumbnail_job, jobs)
+                else:
+                    results = pool.map(thumbnail_job, jobs, chunksize = max(1, len(jobs) // (options['workers'] * 4)))
+
+                updated = []
+                for isbn, made, error in results:
+                    if made is None:
+                        failed += 1
+                        self.stderr.write("Skipping %s: %s" % (isbn, error))
+                        continue
+                    # new image urls, so cached cards for the book have to go
+                    updated.append(Book(isbn = isbn, thumbnails = made, version = F('version') + 1))
+                with transaction.atomic():
+                    Book.objects.bulk_update(updated, ['thumbnails', 'version'])
+                done += len(updated)
+                if options['verbosity'] >= 1 and jobs:
+                    self.stdout.write("%d books resized, %d failed (%.1f books/sec)"
+                                      % (done, failed, done / (time.monotonic() - started)))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        if done:
+            page_cache.catalog_changed()
+        self.stdout.write(self.style.SUCCESS("Resized covers for %d books, %d failed" % (done, failed)))
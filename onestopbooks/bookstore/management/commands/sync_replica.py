@@ -0,0 +1,64 @@
+import sqlite3
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from bookstore import facets, page_cache
+
+
+class Command(BaseCommand):
+    """ Refresh the local file-copy catalog replica from the primary SQLite database """
+
+    help = ("Copy the default database into the REPLICA_DATABASE file with SQLite's online backup, which gives a "
+            "consistent snapshot while the site keeps writing. With --interval it keeps copying, like a replica "
+            "that lags the primary by up to that many seconds.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', help="Replica file to write, defaults to settings.REPLICA_DATABASE")
+        parser.add_argument('--interval', type=float, help="Copy again every this many seconds until interrupted")
+
+    def handle(self, *args, **options):
+        target = options['to'] or settings.REPLICA_DATABASE
+        if not target:
+            raise CommandError("Set REPLICA_DATABASE or pass --to")
+        primary = connections[DEFAULT_DB_ALIAS]
+        if primary.vendor != 'sqlite':
+            raise CommandError("sync_replica copies SQLite files, use the database's own replication for %s" % primary.vendor)
+        if options['interval'] is not None and options['interval'] <= 0:
+            raise CommandError("--interval must be more than 0")
+
+        copied_version = None
+        while True:
+            started = time.monotonic()
+            version = self.data_version(primary)
+            self.copy(primary, str(target))
+            changed = version != copied_version
+            if changed:
+                # cached pages and facet indexes may have been built from the replica's older rows. The generation
+                # and facet version live in the shared caches (CACHES in settings), so this reaches the web processes
+                page_cache.catalog_changed()
+                facets.books_changed()
+            copied_version = version
+            if options['verbosity'] >= 1:
+                self.stdout.write("Copied %s to %s in %.2fs%s" % (primary.settings_dict['NAME'], target,
+                                  time.monotonic() - started, "" if changed else ", unchanged since the last copy"))
+            if options['interval'] is None:
+                break
+            time.sleep(max(0, options['interval'] - (time.monotonic() - started)))
+
+    def data_version(self, primary):
+        """ SQLite's counter of commits made by other connections, the site's writes move it and
+        this command's own reads don't. Only comparable on the same connection, so the first
+        pass of a run always counts as a change """
+        with primary.cursor() as cursor:
+            cursor.execute("PRAGMA data_version")
+            return cursor.fetchone()[0]
+
+    def copy(self, primary, target):
+        primary.ensure_connection()
+        replica = sqlite3.connect(target)
+        try:
+            # replaces every page of the replica in one transaction, readers see the old or the new copy
+            primary.connection.backup(replica)
+        finally:
+            replica.close()
@@ -0,0 +1,157 @@
+""" Request middleware for the bookstore project """
+import json
+import logging
+import mimetypes
+import os
+import time
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.db import connections
+from django.http import FileResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+from . import instrumentation, routers
+
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE = 'public, max-age=3600' # files whose name doesn't change with their content
+PIN_COOKIE = 'read_primary'
+DUPLICATES_LOGGED = 5 # most repeated fingerprints put in a log line
+
+logger = logging.getLogger('bookstore.queries')
+# encodings we keep precompressed siblings for, best first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+class StaticAssetsMiddleware(MiddlewareMixin):
+    """ Serve STATIC_URL requests straight from STATIC_ROOT, before sessions and auth run.
+
+    Hashed names from the collectstatic manifest are sent as immutable for a year.
+    When the client accepts it the brotli or gzip sibling written by collectstatic is
+    sent instead of the original. Files that were never collected, like covers uploaded
+    since the last deploy, are looked up in STATICFILES_DIRS and revalidated hourly.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response) # works in both the sync and the async middleware chain
+        self.prefix = settings.STATIC_URL if settings.STATIC_URL.startswith('/') else '/' + settings.STATIC_URL
+        self.roots = [settings.STATIC_ROOT] if settings.STATIC_ROOT else []
+        self.roots += [str(directory) for directory in settings.STATICFILES_DIRS]
+        hashed_files = getattr(staticfiles_storage, 'hashed_files', None) or {}
+        self.hashed_names = set(hashed_files.values())
+
+    def process_request(self, request):
+        if request.method in ('GET', 'HEAD') and request.path.startswith(self.prefix):
+            return self.serve(request, request.path[len(self.prefix):])
+        return None
+
+    def find(self, name):
+        for root in self.roots:
+            try:
+                path = safe_join(str(root), name)
+            except SuspiciousFileOperation:
+                return None
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def serve(self, request, name):
+        path = self.find(name)
+        if path is None:
+            return None
+        content_type = mimetypes.guess_type(path)[0]
+        accepted = request.headers.get('Accept-Encoding', '')
+        accepted = {token.split(';')[0].strip() for token in accepted.split(',')}
+
+        chosen, chosen_encoding, has_variants = path, None, False
+        for encoding_name, suffix in ENCODINGS:
+            if os.path.isfile(path + suffix):
+                has_variants = True
+                if chosen_encoding is None and encoding_name in accepted:
+                    chosen, chosen_encoding = path + suffix, encoding_name
+
+        stat = os.stat(chosen)
+        if not was_modified_since(request.headers.get('If-Modified-Since'), stat.st_mtime):
+            response = HttpResponseNotModified()
+        else:
+            response = FileResponse(open(chosen, 'rb'), content_type = content_type or 'application/octet-stream')
+            response['Content-Length'] = stat.st_size
+            if chosen_encoding:
+                response['Content-Encoding'] = chosen_encoding
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        response['Cache-Control'] = IMMUTABLE_CACHE if name in self.hashed_names else REVALIDATE_CACHE
+        if has_variants:
+            response['Vary'] = 'Accept-Encoding'
+        return response
+
+
+class ReplicaStickinessMiddleware(MiddlewareMixin):
+    """ Read-your-writes for the catalog replica.
+
+    A response to a request that wrote a book or review sets a short lived cookie, and
+    requests carrying it read from the primary database, see bookstore.routers.
+    """
+
+    def process_request(self, request):
+        routers.start_request(pinned = PIN_COOKIE in request.COOKIES)
+
+    def process_response(self, request, response):
+        if routers.wrote_catalog() and settings.REPLICA_ALIAS is not None:
+            response.set_cookie(PIN_COOKIE, '1', max_age = settings.REPLICA_STICKY_SECONDS, httponly = True, samesite = 'Lax')
+        return response
+
+
+class QueryInstrumentationMiddleware(MiddlewareMixin):
+    """ Count and time each request's SQL queries.
+
+    Adds a Server-Timing header (database time and query count, view time, total time)
+    and logs one JSON line per request to the bookstore.queries logger. Views named in
+    settings.QUERY_BUDGETS that run more queries than their budget log a warning, or
+    raise QueryBudgetExceeded when settings.QUERY_BUDGETS_STRICT is on, as it is in tests.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        for connection in connections.all(): # opened before the connection_created receiver was connected
+            instrumentation.install(connection)
+
+    def process_request(self, request):
+        request.query_stats = instrumentation.start()
+        request.started = request.view_started = time.perf_counter()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.view_started = time.perf_counter()
+
+    def process_response(self, request, response):
+        stats = getattr(request, 'query_stats', None)
+        if stats is None:
+            return response
+        instrumentation.stop()
+        finished = time.perf_counter()
+        view = request.resolver_match.url_name if request.resolver_match else None
+        duplicates = stats.duplicates()
+
+        response['Server-Timing'] = 'db;dur=%.2f;desc="%d queries", view;dur=%.2f, total;dur=%.2f' % (
+            stats.seconds * 1000, stats.count, (finished - request.view_started) * 1000, (finished - request.started) * 1000)
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'status': response.status_code,
+            'queries': stats.count,
+            'db_ms': round(stats.seconds * 1000, 2),
+            'view_ms': round((finished - request.view_started) * 1000, 2),
+            'total_ms': round((finished - request.started) * 1000, 2),
+            'exact_duplicates': stats.exact_duplicates(),
+            'duplicates': dict(list(duplicates.items())[:DUPLICATES_LOGGED]),
+        }))
+
+        budget = settings.QUERY_BUDGETS.get(view)
+        if budget is not None and stats.count > budget:
+            message = "%s ran %d queries, its budget is %d. Repeated: %s" % (view, stats.count, budget, duplicates or "none")
+            if settings.QUERY_BUDGETS_STRICT:
+                raise instrumentation.QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
@@ -0,0 +1,43 @@
+# Generated by Django 4.0.10 on 2026-10-18 06:35
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_rating_totals(apps, schema_editor):
+    """ Fill the new rating columns from the reviews that already exist """
+    Book = apps.get_model('bookstore', 'Book')
+    ReviewRating = apps.get_model('bookstore', 'ReviewRating')
+    totals = ReviewRating.objects.values('book_id').annotate(count=Count('id'), total=Sum('rate'))
+    for row in totals.iterator():
+        Book.objects.filter(isbn=row['book_id']).update(
+            rating_count=row['count'],
+            rating_sum=row['total'],
+            rating_average=row['total'] / row['count'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0014_auto_20220410_2205'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='rating_average',
+            field=models.FloatField(default=0, verbose_name='rating_average'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_count',
+            field=models.IntegerField(default=0, verbose_name='rating_count'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_sum',
+            field=models.FloatField(default=0, verbose_name='rating_sum'),
+        ),
+        migrations.RunPython(backfill_rating_totals, migrations.RunPython.noop),
+    ]
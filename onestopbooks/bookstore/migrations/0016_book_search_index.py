@@ -0,0 +1,44 @@
+# Generated by Django 4.0.10 on 2026-10-18 07:02
+
+import hashlib
+
+from django.db import migrations
+
+FTS_TABLE = "bookstore_book_fts"
+
+
+def create_search_index(apps, schema_editor):
+    """ Create the FTS5 table on SQLite and index the books that already exist """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    Book = apps.get_model('bookstore', 'Book')
+    rows = []
+    for book in Book.objects.iterator():
+        digest = hashlib.blake2b(book.isbn.encode(), digest_size=8).digest()
+        year = "" if book.year_public is None else str(book.year_public)
+        rows.append((int.from_bytes(digest, 'big') >> 1, book.isbn, book.title, book.authors, book.publisher or "", year))
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE %s USING fts5(isbn, title, authors, publisher, year_public, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')" % FTS_TABLE
+    )
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(
+            "INSERT INTO %s (rowid, isbn, title, authors, publisher, year_public) VALUES (%%s, %%s, %%s, %%s, %%s, %%s)" % FTS_TABLE,
+            rows,
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS %s" % FTS_TABLE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0015_book_rating_totals'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 06:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0016_book_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='image_url',
+            field=models.URLField(blank=True, null=True, verbose_name='image_url'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.0.10 on 2026-10-18 06:40
+
+import random
+
+import bookstore.models
+from django.db import migrations, models
+
+
+def spread_random_keys(apps, schema_editor):
+    """ AddField gives every existing row the same default, so give each book its own key """
+    Book = apps.get_model('bookstore', 'Book')
+    last_isbn = ""
+    while True:
+        books = list(Book.objects.filter(isbn__gt=last_isbn).order_by('isbn').only('isbn')[:1000])
+        if not books:
+            break
+        for book in books:
+            book.random_key = random.random()
+        Book.objects.bulk_update(books, ['random_key'])
+        last_isbn = books[-1].isbn
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0017_book_image_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='random_key',
+            field=models.FloatField(db_index=True, default=bookstore.models.new_random_key, verbose_name='random_key'),
+        ),
+        migrations.RunPython(spread_random_keys, migrations.RunPython.noop),
+    ]
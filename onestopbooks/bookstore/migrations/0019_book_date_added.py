@@ -0,0 +1,54 @@
+# Generated by Django 4.0.10 on 2026-10-18 06:41
+
+import csv
+import os
+from datetime import timedelta
+
+from django.db import migrations, models
+import django.utils.timezone
+
+BOOKS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'books.csv')
+
+
+def backfill_date_added(apps, schema_editor):
+    """ Order existing books by their row in books.csv, one second apart, ending now.
+    Books that aren't in the csv are treated as older than all of them. """
+    Book = apps.get_model('bookstore', 'Book')
+    import_order = {}
+    if os.path.exists(BOOKS_CSV):
+        with open(BOOKS_CSV, newline='', encoding='utf-8') as csv_file:
+            for row in csv.reader(csv_file):
+                if len(row) > 1 and row[0].isdigit():
+                    import_order[row[1].strip()] = int(row[0])
+    newest = django.utils.timezone.now()
+    oldest = newest - timedelta(seconds=max(import_order.values(), default=0) + 1)
+
+    last_isbn = ""
+    while True:
+        books = list(Book.objects.filter(isbn__gt=last_isbn).order_by('isbn').only('isbn')[:1000])
+        if not books:
+            break
+        for book in books:
+            book.date_added = oldest + timedelta(seconds=import_order.get(book.isbn, 0))
+        Book.objects.bulk_update(books, ['date_added'])
+        last_isbn = books[-1].isbn
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0018_book_random_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='date_added',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='date_added'),
+        ),
+        migrations.RunPython(backfill_date_added, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['date_added', 'isbn'], name='book_date_added_idx'),
+        ),
+    ]
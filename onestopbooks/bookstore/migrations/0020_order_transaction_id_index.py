@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 06:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0019_book_date_added'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='transaction_id',
+            field=models.CharField(db_index=True, max_length=200, null=True),
+        ),
+    ]
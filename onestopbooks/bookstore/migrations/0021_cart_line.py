@@ -0,0 +1,95 @@
+# Generated by Django 4.0.10 on 2026-10-18 06:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# duplicate lines left by the old get_or_create are merged, and empty ones dropped
+COPY_LINES = """
+    INSERT INTO bookstore_cartline (order_id, product_id, line_type, quantity, date_added)
+    SELECT {order}, {product}, '{line_type}', SUM(COALESCE({quantity}, 0)), MIN({date_added})
+    FROM {table}
+    GROUP BY {order}, {product}
+    HAVING SUM(COALESCE({quantity}, 0)) > 0
+"""
+COPY_BACK = """
+    INSERT INTO {table} ({order}, {product}, {quantity}, {date_added})
+    SELECT order_id, product_id, quantity, date_added FROM bookstore_cartline WHERE line_type = '{line_type}'
+"""
+OLD_TABLES = [
+    {'table': 'bookstore_orderitem', 'line_type': 'buy', 'order': 'order_id', 'product': 'product_id',
+     'quantity': 'quantity', 'date_added': 'date_added'},
+    {'table': 'bookstore_rentitem', 'line_type': 'rent', 'order': 'order1_id', 'product': 'product1_id',
+     'quantity': 'quantity1', 'date_added': 'date_added1'},
+]
+
+
+def copy_lines(apps, schema_editor):
+    for table in OLD_TABLES:
+        schema_editor.execute(COPY_LINES.format(**table))
+
+
+def copy_lines_back(apps, schema_editor):
+    for table in OLD_TABLES:
+        schema_editor.execute(COPY_BACK.format(**table))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0020_order_transaction_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CartLine',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line_type', models.CharField(choices=[('buy', 'Buy'), ('rent', 'Rent')], max_length=4)),
+                ('quantity', models.IntegerField(blank=True, default=0, null=True)),
+                ('date_added', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='lines', to='bookstore.order')),
+                ('product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='cart_lines', to='bookstore.book')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='cartline',
+            constraint=models.UniqueConstraint(fields=('order', 'product', 'line_type'), name='cartline_unique_line'),
+        ),
+        migrations.RunPython(copy_lines, copy_lines_back),
+        migrations.RemoveField(
+            model_name='rentitem',
+            name='order1',
+        ),
+        migrations.RemoveField(
+            model_name='rentitem',
+            name='product1',
+        ),
+        migrations.DeleteModel(
+            name='OrderItem',
+        ),
+        migrations.DeleteModel(
+            name='RentItem',
+        ),
+        migrations.CreateModel(
+            name='OrderItem',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('bookstore.cartline',),
+        ),
+        migrations.CreateModel(
+            name='RentItem',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('bookstore.cartline',),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.0.10 on 2026-10-18 06:53
+
+import bookstore.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0021_cart_line'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='version',
+            field=models.BigIntegerField(default=bookstore.models.new_version, verbose_name='version'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 06:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0022_book_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=dict, verbose_name='thumbnails'),
+        ),
+    ]
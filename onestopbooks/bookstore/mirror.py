@@ -0,0 +1,164 @@
+""" Copying catalog cover images from their remote URLs into our own storage.
+
+Downloads run on an asyncio event loop with a fixed number of workers, each
+blocking urllib call is handed to a thread. Files are stored under the SHA-256 of
+their content, so the same cover used by several books (or the same placeholder
+image) is stored once, and a re-run finds what an earlier run already saved.
+"""
+import asyncio
+import hashlib
+import random
+import urllib.error
+import urllib.request
+from io import BytesIO
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+MIRROR_DIR = "static/images/books/mirror"
+MAX_BYTES = 5 * 1024 * 1024
+USER_AGENT = "onestopbooks-mirror/1.0"
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+
+
+class MirrorError(Exception):
+    """ A download that failed. `retry` is False for failures another attempt won't fix """
+
+    def __init__(self, message, retry = True):
+        super().__init__(message)
+        self.retry = retry
+
+
+def fetch(url, timeout):
+    """ Download one image, returns its bytes """
+    if not url.startswith(('http://', 'https://')):
+        raise MirrorError("not an http url", retry = False)
+    request = urllib.request.Request(url, headers = {'User-Agent': USER_AGENT})
+    try:
+        with urllib.request.urlopen(request, timeout = timeout) as response:
+            content = response.read(MAX_BYTES + 1)
+    except urllib.error.HTTPError as error:
+        # 404 and friends won't change, rate limits and server errors might
+        raise MirrorError("HTTP %d" % error.code, retry = error.code == 429 or error.code >= 500)
+    except (urllib.error.URLError, OSError) as error:
+        raise MirrorError(str(getattr(error, 'reason', error)))
+    if len(content) > MAX_BYTES:
+        raise MirrorError("larger than %d bytes" % MAX_BYTES, retry = False)
+    return content
+
+
+def image_extension(content):
+    """ File extension for downloaded bytes, raises MirrorError if they aren't a real cover """
+    try:
+        image = Image.open(BytesIO(content))
+        image.verify()
+    except Exception: # Pillow raises a wide range of errors for bad data
+        raise MirrorError("not an image", retry = False)
+    if image.format not in EXTENSIONS:
+        raise MirrorError("unsupported image format %s" % image.format, retry = False)
+    # missing covers come back as a 1x1 placeholder instead of a 404
+    if image.width <= 1 or image.height <= 1:
+        raise MirrorError("placeholder image", retry = False)
+    return EXTENSIONS[image.format]
+
+
+def content_name(content, extension):
+    digest = hashlib.sha256(content).hexdigest()
+    return "%s/%s/%s.%s" % (MIRROR_DIR, digest[:2], digest, extension)
+
+
+def store(name, content):
+    """ Save content under its content name, returns False if an identical file was already there """
+    if default_storage.exists(name):
+        return False
+    default_storage.save(name, ContentFile(content))
+    return True
+
+
+class Mirror:
+    """ Download and store a set of (key, url) jobs with bounded concurrency.
+
+    `on_results` is called on the event loop with lists of (key, stored name) as they
+    finish, at most `batch_size` at a time, so it must not block. Failures are collected
+    in `failures`, `stored` counts new files and `deduplicated` downloads that matched
+    a stored file.
+    """
+
+    def __init__(self, on_results, concurrency = 8, retries = 3, backoff = 0.5, timeout = 10, batch_size = 50):
+        self.on_results = on_results
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.stored = 0
+        self.deduplicated = 0
+        self.failures = []
+        self._saving = {} # content name -> the save of that file, done or still running
+        self._results = []
+
+    def delay(self, attempt):
+        """ Exponential backoff with jitter, so retries from many workers don't line up """
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    async def download(self, url):
+        for attempt in range(self.retries + 1):
+            try:
+                return await asyncio.to_thread(fetch, url, self.timeout)
+            except MirrorError as error:
+                if not error.retry or attempt == self.retries:
+                    raise
+            await asyncio.sleep(self.delay(attempt))
+
+    async def mirror_one(self, key, url):
+        content = await self.download(url)
+        name = content_name(content, image_extension(content))
+        # the first worker with this content saves it, any other waits for that save instead of saving it again
+        saving = self._saving.get(name)
+        if saving is None:
+            saving = self._saving[name] = asyncio.ensure_future(asyncio.to_thread(store, name, content))
+            try:
+                written = await saving
+            except OSError as error:
+                del self._saving[name] # so a later job with this content tries again
+                raise MirrorError("could not store: %s" % error, retry = False)
+            if written:
+                self.stored += 1
+                return name
+        else:
+            try:
+                await asyncio.shield(saving)
+            except OSError as error:
+                raise MirrorError("could not store: %s" % error, retry = False)
+        self.deduplicated += 1
+        return name
+
+    async def worker(self, queue):
+        while True:
+            job = await queue.get()
+            if job is None:
+                return
+            key, url = job
+            try:
+                name = await self.mirror_one(key, url)
+            except MirrorError as error:
+                self.failures.append((key, url, str(error)))
+                continue
+            self._results.append((key, name))
+            if len(self._results) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        results, self._results = self._results, []
+        if results:
+            self.on_results(results)
+
+    async def run(self, jobs):
+        queue = asyncio.Queue(maxsize = self.concurrency * 2)
+        workers = [asyncio.create_task(self.worker(queue)) for i in range(self.concurrency)]
+        for job in jobs:
+            await queue.put(job)
+        for worker in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        self.flush()
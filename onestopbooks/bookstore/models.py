@@ -1,8 +1,23 @@
+import random
+import time
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext as _
-from datetime import datetime, timedelta
+from datetime import timedelta
 from django.contrib.auth.models import User
-from django.db.models import Avg, Count
+from django.db.models import F, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+def new_version():
+    """ Starting version for a book: a microsecond clock value, so a book deleted and added
+    again under the same isbn doesn't pick up the old book's cached versions """
+    return time.time_ns() // 1000
+
+
+def new_random_key():
+    """ Default for Book.random_key """
+    return random.random()
+
 # Create your models here.
 class Book(models.Model):
     """ Book model with ISBN, title, authors, year public, price, quantity and thumbnail"""
@@ -12,40 +27,71 @@ class Book(models.Model):
     year_public = models.IntegerField(_("year_public"), null = True)
     publisher = models.CharField(_("publisher"), max_length = 100, null = True)  
     thumbnail_pic = models.ImageField(_("thumbnail_pic"), null = True, blank = True, upload_to ="static/images/books")
+    image_url = models.URLField(_("image_url"), null = True, blank = True) # cover image from the catalog feed
     price = models.IntegerField(_("price"))
     quantity = models.IntegerField(_("Quantity"))
+    # stored rating totals, kept up to date by submit_review and repaired by the rebuild_ratings command
+    rating_count = models.IntegerField(_("rating_count"), default = 0)
+    rating_sum = models.FloatField(_("rating_sum"), default = 0)
+    rating_average = models.FloatField(_("rating_average"), default = 0)
+    # uniform random number given to every book when it's created, indexed so random picks are a range lookup
+    random_key = models.FloatField(_("random_key"), default = new_random_key, db_index = True)
+    date_added = models.DateTimeField(_("date_added"), default = timezone.now)
+    # resized copies of thumbnail_pic, written by bookstore/thumbnails.py
+    thumbnails = models.JSONField(_("thumbnails"), default = dict, blank = True)
+    # goes up on every save, cached book cards are keyed on it (templates/book-card.html)
+    version = models.BigIntegerField(_("version"), default = new_version)
+
+    class Meta:
+        indexes = [
+            # newest arrivals are read with ORDER BY date_added DESC, isbn DESC LIMIT n
+            models.Index(fields = ['date_added', 'isbn'], name = 'book_date_added_idx'),
+            # the books page's keyset sorts (views.BOOK_SORTS), so any page is a range read of one of these
+            models.Index(fields = ['title', 'isbn'], name = 'book_title_idx'),
+            models.Index(fields = ['authors', 'isbn'], name = 'book_authors_idx'),
+            models.Index(fields = ['price', 'isbn'], name = 'book_price_idx'),
+            models.Index(fields = ['-price', 'isbn'], name = 'book_price_desc_idx'),
+        ]
 
     def __str__(self):
         """String for representing the Book title."""
         return self.title
 
+    def save(self, *args, **kwargs):
+        """ Saving an existing book moves it to the next version """
+        if not self._state.adding:
+            self.version = F('version') + 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields']) | {'version'}
+        super().save(*args, **kwargs)
+        if not isinstance(self.version, int):
+            self.refresh_from_db(fields = ['version'])
+
     def decrease_quantity(self, quantity_to_decrease):
-        print("Current Quantity: " + str(self.quantity) + " Amount to Decrease: " + str(quantity_to_decrease))
-        if (quantity_to_decrease < self.quantity):
-            self.quantity = self.quantity - quantity_to_decrease
-            self.save()
-            print("New Quantity: " + str(self.quantity))
+        """ Take copies out of stock if there are enough, returns False when there aren't.
+        Done as one conditional UPDATE so two sales of the same book can't both read the old quantity """
+        updated = Book.objects.filter(isbn = self.isbn, quantity__gte = quantity_to_decrease).update(
+            quantity = F('quantity') - quantity_to_decrease)
+        if updated:
+            self.refresh_from_db(fields = ['quantity'])
+        return bool(updated)
     
     def countReview(self):
         """ To find the total Review for that book """
-        
-        reviews = ReviewRating.objects.filter(book=self).aggregate(count=Count('id'))
-        count = 0
-        if reviews['count'] is not None:
-            count = int(reviews['count'])
-        return count
+        return self.rating_count
     
     
     def averageReview(self):
         """ To find the Average Review for that book """
-        
-        reviews = ReviewRating.objects.filter(book=self).aggregate(average=Avg('rate'))
-        avg = 0
-        ave = 0
-        if reviews['average'] is not None:
-            avg = float(reviews['average'])
-            ave = round(avg, 2)
-        return ave
+        return round(self.rating_average, 2)
+
+    def add_rating(self, rate):
+        """ Add one rating to the stored rating totals in a single UPDATE, so concurrent reviews don't lose counts """
+        Book.objects.filter(isbn = self.isbn).update(
+            rating_count = F('rating_count') + 1,
+            rating_sum = F('rating_sum') + rate,
+            rating_average = (F('rating_sum') + rate) / (F('rating_count') + 1))
+
         
 # Customer Model
 class Customer(models.Model):
@@ -65,55 +111,169 @@ class Customer(models.Model):
         """String for representing the Book title."""
         return self.last_name
 
+class OrderQuerySet(models.QuerySet):
+    """ Cart lookups shared by the views and the cart context processor """
+
+    def open_for(self, user):
+        """ The user's open cart, newest first. Matches on the user so accounts without a Customer just get nothing """
+        return self.filter(customer__user = user, complete = False).order_by('-id')
+
+    def with_cart_summary(self):
+        """ Annotate cart_items and cart_total (quantity * price over buy and rent lines) with
+        correlated subqueries, so any number of carts and lines is summed in one query """
+        lines = CartLine.objects.filter(order = OuterRef('pk')).order_by().values('order')
+        zero = Value(0, output_field = IntegerField())
+
+        def line_sum(expression):
+            return Coalesce(Subquery(lines.annotate(total = Sum(expression)).values('total')), zero)
+
+        return self.annotate(
+            cart_items = line_sum(F('quantity')),
+            cart_total = line_sum(F('quantity') * F('product__price')),
+        )
+
 class Order(models.Model):
     """ Cart/Order model """
     customer = models.ForeignKey(Customer, on_delete = models.SET_NULL, blank=True, null=True) #ForeignKey => so one to many relationship which one customer can have many orders
     date_order = models.DateTimeField(auto_now_add=True) #When order created
     complete = models.BooleanField(default=False, null=True, blank=False) # if complete is false then customer can continue to adding items to that cart
-    transaction_id = models.CharField(max_length=200, null=True) # add some extra info to order
+    transaction_id = models.CharField(max_length=200, null=True, db_index=True) # checkout idempotency key, shown as the confirmation number
+
+    objects = OrderQuerySet.as_manager()
     
     def __str__(self):
         """ Function to get total price for items in cart """
         return str(self.id)
+    def cart_summary(self):
+        """ (items, total) from the with_cart_summary annotations, or one query when they weren't loaded """
+        if not hasattr(self, 'cart_total'):
+            self.cart_items, self.cart_total = (
+                Order.objects.filter(pk = self.pk).with_cart_summary().values_list('cart_items', 'cart_total').get())
+        return self.cart_items, self.cart_total
+
     @property
     # get total price for cart
     def get_cart_total(self):
-        orderitems = self.orderitem_set.all()
-        total = sum([item.get_total for item in orderitems])
-        return total
+        return self.cart_summary()[1]
 
     @property
     def get_cart_items(self):
         """ Function to get total items in cart """
-        orderitems = self.orderitem_set.all()
-        rentitems = self.rentitem_set.all()
-        totalbuy = sum([item.quantity for item in orderitems])
-        totalrent = sum([item.quantity1 for item in rentitems])
-        total = totalbuy + totalrent
-        return total
+        return self.cart_summary()[0]
+
+    def cart_lines(self):
+        """ (buy lines, rent lines) with their books, from one query """
+        buys, rents = [], []
+        for line in self.lines.select_related('product').order_by('date_added', 'pk'):
+            (buys if line.line_type == CartLine.BUY else rents).append(line)
+        return buys, rents
+
+# old RentItem field names -> CartLine field names, so code written against RentItem keeps working
+LINE_FIELD_ALIASES = {'product1': 'product', 'order1': 'order', 'quantity1': 'quantity', 'date_added1': 'date_added'}
+RENTAL_PERIOD = timedelta(days=7)
+
+
+def unalias_lookups(kwargs):
+    """ {'product1__isbn': x} -> {'product__isbn': x} """
+    lookups = {}
+    for key, value in kwargs.items():
+        field, separator, rest = key.partition('__')
+        lookups[LINE_FIELD_ALIASES.get(field, field) + separator + rest] = value
+    return lookups
+
+
+def line_alias(field):
+    """ Read/write property standing in for an old field name """
+    return property(lambda line: getattr(line, field), lambda line, value: setattr(line, field, value))
+
 
-class OrderItem(models.Model):
-    """ Cart can have multiple item thats why we use foregnkey relationship """
-    product = models.ForeignKey(Book, on_delete=models.SET_NULL, blank=True, null=True)
-    order = models.ForeignKey(Order, on_delete=models.SET_NULL, blank=True, null=True)
+class CartLineQuerySet(models.QuerySet):
+    """ Accepts the old RentItem field names in filter(), exclude(), get() and create() """
+
+    def filter(self, *args, **kwargs):
+        return super().filter(*args, **unalias_lookups(kwargs))
+
+    def exclude(self, *args, **kwargs):
+        return super().exclude(*args, **unalias_lookups(kwargs))
+
+    def create(self, **kwargs):
+        """ OrderItem.objects.create() and RentItem.objects.create() fill in their line type """
+        kwargs = unalias_lookups(kwargs)
+        if self.model.line_type_default is not None:
+            kwargs.setdefault('line_type', self.model.line_type_default)
+        return super().create(**kwargs)
+
+
+class LineTypeManager(models.Manager.from_queryset(CartLineQuerySet)):
+    """ Only the buy or only the rent lines """
+
+    def __init__(self, line_type):
+        super().__init__()
+        self.line_type = line_type
+
+    def get_queryset(self):
+        return super().get_queryset().filter(line_type = self.line_type)
+
+
+class CartLine(models.Model):
+    """ One book in a cart, either bought or rented. Replaces the separate OrderItem and RentItem tables """
+    BUY = 'buy'
+    RENT = 'rent'
+    LINE_TYPES = [(BUY, 'Buy'), (RENT, 'Rent')]
+    line_type_default = None # set by the OrderItem and RentItem proxies
+
+    # no separate index on order, the unique constraint below starts with it
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, blank=True, null=True, related_name='lines', db_index=False)
+    product = models.ForeignKey(Book, on_delete=models.SET_NULL, blank=True, null=True, related_name='cart_lines')
+    line_type = models.CharField(max_length=4, choices=LINE_TYPES)
     quantity = models.IntegerField(default=0, null=True, blank=True) # quantity of that book in cart, default is at 0
     date_added = models.DateTimeField(auto_now_add=True)
-    
+
+    objects = CartLineQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # a book is bought or rented at most once per cart, more copies go in quantity
+            models.UniqueConstraint(fields = ['order', 'product', 'line_type'], name = 'cartline_unique_line'),
+        ]
+
+    def __str__(self):
+        return "%s x%s (%s)" % (self.product_id, self.quantity, self.line_type)
+
     @property
     # get total prices in cart for that book
     def get_total(self):
         """ Function to get total price for purchse book """
         total = self.product.price * self.quantity
         return total
-    
-class RentItem(models.Model):
-    """ Cart can have multiple item thats why we use foregnkey relationship """
-    product1 = models.ForeignKey(Book, on_delete=models.SET_NULL, blank=True, null=True)
-    order1 = models.ForeignKey(Order, on_delete=models.SET_NULL, blank=True, null=True)
-    quantity1 = models.IntegerField(default=0, null=True, blank=True) # quantity of that book in cart, default is at 0
-    date_added1 = models.DateTimeField(auto_now_add=True)
-    date_due1 = datetime.now() + timedelta(days=7)
-    
+
+    # names the templates still use for rent lines
+    product1 = line_alias('product')
+    order1 = line_alias('order')
+    quantity1 = line_alias('quantity')
+    date_added1 = line_alias('date_added')
+
+    @property
+    def date_due1(self):
+        """ Rentals are due back a week after they were added to the cart """
+        return (self.date_added or timezone.now()) + RENTAL_PERIOD
+
+class OrderItem(CartLine):
+    """ Buy lines of a cart """
+    line_type_default = CartLine.BUY
+    objects = LineTypeManager(CartLine.BUY)
+
+    class Meta:
+        proxy = True
+
+class RentItem(CartLine):
+    """ Rent lines of a cart """
+    line_type_default = CartLine.RENT
+    objects = LineTypeManager(CartLine.RENT)
+
+    class Meta:
+        proxy = True
+
 class ReviewRating(models.Model):
     """ Review model for user with one to many relation ship, so one user can have write many reviews """
     
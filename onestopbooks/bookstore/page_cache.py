@@ -0,0 +1,206 @@
+""" Whole-page cache for anonymous visitors.
+
+Catalog pages look the same to every visitor who isn't logged in, so the rendered
+HTML is kept in the cache named by settings.PAGE_CACHE_ALIAS. Keys include a catalog
+generation number that is changed whenever a book or review is saved or deleted,
+which retires every cached page at once without having to find them.
+
+Every page carries a CSRF token (the navbar search form), so the token is blanked
+out before a page is stored and a fresh one for the current visitor is put in on
+every hit.
+
+Hits and misses are counted in memory and added to shared counters in the page cache
+at most every COUNT_FLUSH_SECONDS, so serving a hit never has to write to the cache.
+
+The decorator works on async views too. Their cache lookup only leaves the event
+loop for a visitor with a session cookie, whose login has to be read from the database.
+"""
+import asyncio
+import functools
+import hashlib
+import re
+import threading
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+
+GENERATION_KEY = "page_cache:generation"
+CHANGED_KEY = "page_cache:changed" # unix time, with the fraction, when the generation last moved
+HITS_KEY = "page_cache:hits"
+MISSES_KEY = "page_cache:misses"
+COUNT_FLUSH_SECONDS = 10 # how stale another process's share of the hit and miss counts can be
+
+CSRF_INPUT = re.compile(rb'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+CSRF_PLACEHOLDER = b"__csrf_token__"
+
+
+def page_cache():
+    return caches[settings.PAGE_CACHE_ALIAS]
+
+
+def catalog_generation():
+    """ Current catalog generation, part of every page key """
+    cache = page_cache()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # a microsecond clock value, so a generation key that was evicted never comes back as an old number
+        cache.add(GENERATION_KEY, time.time_ns() // 1000, None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def catalog_changed_at():
+    """ Unix time of the last catalog change. If it was evicted, now, which is later than the real time so still safe """
+    cache = page_cache()
+    changed = cache.get(CHANGED_KEY)
+    if changed is None:
+        cache.add(CHANGED_KEY, time.time(), None)
+        changed = cache.get(CHANGED_KEY)
+    return changed
+
+
+def next_generation():
+    cache = page_cache()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError: # not set yet, or evicted
+        catalog_generation()
+    cache.set(CHANGED_KEY, time.time(), None)
+
+
+def catalog_changed():
+    """ Retire every cached page, called when books or reviews change """
+    next_generation()
+    # a page rendered before the change commits can still be stored under the new generation
+    transaction.on_commit(next_generation)
+
+
+_counts = {HITS_KEY: 0, MISSES_KEY: 0} # this process's, not yet added to the shared counters
+_counts_lock = threading.Lock()
+_flushed_at = time.monotonic()
+
+
+def count(key):
+    global _flushed_at
+    with _counts_lock:
+        _counts[key] += 1
+        if time.monotonic() - _flushed_at < COUNT_FLUSH_SECONDS:
+            return
+        _flushed_at = time.monotonic()
+    flush_counts()
+
+
+def flush_counts():
+    """ Add this process's hits and misses to the shared counters """
+    with _counts_lock:
+        counts = dict(_counts)
+        _counts.update(dict.fromkeys(_counts, 0))
+    cache = page_cache()
+    for key, value in counts.items():
+        if value:
+            cache.add(key, 0, None)
+            try:
+                cache.incr(key, value)
+            except ValueError: # evicted between add and incr, the stats are only for sizing
+                pass
+
+
+def stats():
+    """ Hit and miss counts since the counters were last reset. Other processes' counts
+    from the last COUNT_FLUSH_SECONDS may not be in them yet """
+    flush_counts()
+    values = page_cache().get_many([HITS_KEY, MISSES_KEY])
+    hits, misses = values.get(HITS_KEY, 0), values.get(MISSES_KEY, 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / (hits + misses), 3) if hits + misses else None,
+        'generation': catalog_generation(),
+    }
+
+
+def reset_stats():
+    with _counts_lock:
+        _counts.update(dict.fromkeys(_counts, 0))
+    page_cache().delete_many([HITS_KEY, MISSES_KEY])
+
+
+def page_key(request, name):
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return "page:%s:%s:%s" % (catalog_generation(), name, path)
+
+
+def cacheable(request):
+    return request.method in ('GET', 'HEAD') and not request.user.is_authenticated
+
+
+async def acacheable(request):
+    """ cacheable() for async views, without a session cookie the visitor can't be logged in """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if settings.SESSION_COOKIE_NAME not in request.COOKIES:
+        return True
+    return not await sync_to_async(lambda: request.user.is_authenticated)()
+
+
+def cached_response(request, name):
+    """ The stored page for this request as a response, or None after counting a miss """
+    cached = page_cache().get(page_key(request, name))
+    if cached is None:
+        count(MISSES_KEY)
+        return None
+    count(HITS_KEY)
+    content_type, content = cached
+    content = content.replace(CSRF_PLACEHOLDER, get_token(request).encode())
+    response = HttpResponse(content, content_type = content_type)
+    response['X-Page-Cache'] = 'hit'
+    return response
+
+
+def store_response(request, name, response, timeout):
+    # only plain successful pages that don't set anything for this visitor
+    if response.status_code == 200 and not response.streaming and not response.cookies:
+        content = CSRF_INPUT.sub(rb'\1' + CSRF_PLACEHOLDER + rb'\2', response.content)
+        page_timeout = settings.PAGE_CACHE_TIMEOUT if timeout is None else timeout
+        page_cache().set(page_key(request, name), (response['Content-Type'], content), page_timeout)
+    response['X-Page-Cache'] = 'miss'
+    return response
+
+
+def cache_anonymous_page(timeout=None):
+    """ Decorator serving a view's anonymous GETs from the page cache.
+
+    `timeout` is in seconds and defaults to settings.PAGE_CACHE_TIMEOUT. Responses are
+    marked with an X-Page-Cache header of "hit" or "miss".
+    """
+    def decorator(view):
+        name = view.__name__
+
+        if asyncio.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if not await acacheable(request):
+                    return await view(request, *args, **kwargs)
+                response = await sync_to_async(cached_response)(request, name)
+                if response is not None:
+                    return response
+                response = await view(request, *args, **kwargs)
+                return await sync_to_async(store_response)(request, name, response, timeout)
+
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not cacheable(request):
+                return view(request, *args, **kwargs)
+            response = cached_response(request, name)
+            if response is not None:
+                return response
+            return store_response(request, name, view(request, *args, **kwargs), timeout)
+
+        return wrapper
+    return decorator
@@ -0,0 +1,159 @@
+""" Keyset (cursor) pagination.
+
+Instead of OFFSET, each page is fetched with a WHERE on the sort key of the row at
+the edge of the previous page, so page 50,000 costs the same index range scan as
+page 1. Cursors are opaque url-safe tokens holding the ordering, that sort key and a
+page number for display. A cursor is only accepted for the ordering it was made for,
+with a key of the right length whose values fit their fields.
+"""
+import base64
+import binascii
+import json
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    """ Raised when a cursor token can't be decoded, or doesn't belong to the ordering """
+
+
+def encode_cursor(direction, ordering, key, number):
+    data = json.dumps({'d': direction, 'o': list(ordering), 'k': key, 'n': number}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, ordering):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        direction, cursor_ordering, key, number = data['d'], data['o'], data['k'], int(data['n'])
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, KeyError):
+        raise InvalidCursor(token)
+    if direction not in ('next', 'prev', 'last') or not isinstance(key, list):
+        raise InvalidCursor(token)
+    if cursor_ordering != list(ordering): # a cursor from another sort
+        raise InvalidCursor(token)
+    if direction != 'last' and len(key) != len(ordering):
+        raise InvalidCursor(token)
+    return direction, key, number
+
+
+def clean_key(model, ordering, key, token):
+    """ The cursor's key values as their fields' Python values, raises InvalidCursor for one that doesn't fit """
+    cleaned = []
+    for (field, descending), value in zip(parse_ordering(ordering), key):
+        try:
+            cleaned.append(model._meta.get_field(field).to_python(value))
+        except (FieldDoesNotExist, ValidationError):
+            raise InvalidCursor(token)
+        if cleaned[-1] is None: # none of the ordering's fields are null
+            raise InvalidCursor(token)
+    return cleaned
+
+
+def parse_ordering(ordering):
+    """ ('-price', 'isbn') -> [('price', True), ('isbn', False)] """
+    return [(field.lstrip('-'), field.startswith('-')) for field in ordering]
+
+
+def reverse_ordering(ordering):
+    return [field[1:] if field.startswith('-') else '-' + field for field in ordering]
+
+
+def after_key(ordering, key, before=False):
+    """ Q for rows strictly after (or before) the given sort key in this ordering """
+    fields = parse_ordering(ordering)
+    condition = Q()
+    for i, (field, descending) in enumerate(fields):
+        # ascending fields move forward with gt, descending ones with lt
+        lookup = 'lt' if descending != before else 'gt'
+        step = Q(**{'%s__%s' % (field, lookup): key[i]})
+        for previous, (previous_field, _) in enumerate(fields[:i]):
+            step &= Q(**{previous_field: key[previous]})
+        condition |= step
+    # the same bound on the leading field alone, so the database seeks into the index instead of scanning it from the start
+    field, descending = fields[0]
+    return Q(**{'%s__%s' % (field, 'lte' if descending != before else 'gte'): key[0]}) & condition
+
+
+class KeysetPage:
+    """ One page of a keyset paginated queryset, iterable like a Django Page """
+
+    def __init__(self, object_list, number, num_pages, has_next, has_previous, ordering):
+        self.object_list = object_list
+        self.number = number
+        self.num_pages = num_pages
+        self._has_next = has_next
+        self._has_previous = has_previous
+        self.ordering = ordering
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def row_key(self, row):
+        return [getattr(row, field) for field, descending in parse_ordering(self.ordering)]
+
+    @property
+    def next_cursor(self):
+        if not self._has_next:
+            return None
+        return encode_cursor('next', self.ordering, self.row_key(self.object_list[-1]), self.number + 1)
+
+    @property
+    def previous_cursor(self):
+        if not self._has_previous:
+            return None
+        return encode_cursor('prev', self.ordering, self.row_key(self.object_list[0]), self.number - 1)
+
+    @property
+    def last_cursor(self):
+        return encode_cursor('last', self.ordering, [], self.num_pages)
+
+
+def keyset_page(queryset, ordering, per_page, cursor=None, count=None):
+    """ Fetch the page of `queryset` named by `cursor` (the first page when it's empty).
+
+    `ordering` must end in a unique field so every row has a distinct key, and none of
+    its fields may be null. `count` is the (possibly approximate) number of rows, only
+    used for page numbers and the size of the last page. Raises InvalidCursor for a
+    cursor that can't be used with this ordering.
+    """
+    direction, key, number = decode_cursor(cursor, ordering) if cursor else ('first', [], 1)
+    key = clean_key(queryset.model, ordering, key, cursor)
+    if count is None:
+        count = queryset.count()
+    num_pages = max(1, -(-count // per_page))
+    number = min(max(number, 1), num_pages)
+
+    if direction == 'next':
+        rows = list(queryset.filter(after_key(ordering, key)).order_by(*ordering)[:per_page + 1])
+        has_next, has_previous = len(rows) > per_page, True
+        rows = rows[:per_page]
+    elif direction == 'prev':
+        rows = list(queryset.filter(after_key(ordering, key, before=True)).order_by(*reverse_ordering(ordering))[:per_page + 1])
+        has_next, has_previous = True, len(rows) > per_page
+        rows = rows[:per_page][::-1]
+    elif direction == 'last':
+        size = count % per_page or per_page
+        rows = list(queryset.order_by(*reverse_ordering(ordering))[:size + 1])
+        has_next, has_previous = False, len(rows) > size
+        rows = rows[:size][::-1]
+    else:
+        rows = list(queryset.order_by(*ordering)[:per_page + 1])
+        has_next, has_previous = len(rows) > per_page, False
+        rows = rows[:per_page]
+
+    # a stale cursor can land past either end of the list
+    if not has_previous:
+        number = 1
+    if not has_next:
+        number = num_pages if has_previous else 1
+    return KeysetPage(rows, number, num_pages, has_next, has_previous, ordering)
@@ -0,0 +1,64 @@
+""" Database routing for the catalog read replica.
+
+Book and ReviewRating reads go to settings.REPLICA_ALIAS when one is configured. All
+writes, every other model and anything inside a transaction on default use default.
+
+Once a request writes a book or review it is pinned to default for the rest of the
+request, and ReplicaStickinessMiddleware carries the pin over to the visitor's
+next requests with a cookie until the replica has had time to catch up.
+"""
+import contextvars
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+REPLICA_MODELS = {'bookstore.book', 'bookstore.reviewrating'}
+
+# set per request by ReplicaStickinessMiddleware, contextvars follow the request into sync_to_async threads
+_pinned = contextvars.ContextVar('replica_pinned', default = False)
+_wrote = contextvars.ContextVar('replica_wrote', default = False)
+
+
+def start_request(pinned):
+    """ Reset the routing state at the start of a request, `pinned` if the visitor wrote recently """
+    _pinned.set(pinned)
+    _wrote.set(False)
+
+
+def pin_to_primary():
+    _pinned.set(True)
+    _wrote.set(True)
+
+
+def wrote_catalog():
+    """ True when this request wrote a book or review """
+    return _wrote.get()
+
+
+class ReplicaRouter:
+    """ Send catalog reads to the replica, everything else to default """
+
+    def db_for_read(self, model, **hints):
+        alias = settings.REPLICA_ALIAS
+        if alias is None or model._meta.label_lower not in REPLICA_MODELS or _pinned.get():
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block: # reads inside a transaction must see its writes
+            return None
+        return alias
+
+    def db_for_write(self, model, **hints):
+        if model._meta.label_lower in REPLICA_MODELS:
+            pin_to_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows, so a book read from it can be attached to an order
+        databases = {DEFAULT_DB_ALIAS, settings.REPLICA_ALIAS}
+        if settings.REPLICA_ALIAS is not None and obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replica is a copy of default, it gets its tables from sync_replica
+        if db == settings.REPLICA_ALIAS:
+            return False
+        return None
@@ -0,0 +1,173 @@
+""" Full-text search for books.
+
+On SQLite the catalog is mirrored into an FTS5 virtual table and searches are ranked
+with BM25. The index is keyed by a 63-bit hash of the isbn so single books can be
+replaced or removed with a rowid lookup instead of a scan. Any other database, or an
+SQLite build without the table, falls back to the old LIKE based ORM query.
+"""
+import hashlib
+import re
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Q
+from .models import Book
+
+FTS_TABLE = "bookstore_book_fts"
+RESULTS_PER_PAGE = 20
+
+# column weights for bm25(), in the same order as the table columns below
+FTS_COLUMNS = ("isbn", "title", "authors", "publisher", "year_public")
+FTS_WEIGHTS = (1.0, 10.0, 5.0, 1.0, 1.0)
+
+CREATE_FTS_TABLE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    % (FTS_TABLE, ", ".join(FTS_COLUMNS))
+)
+
+# databases (by NAME) where the FTS table is known to exist
+_fts_databases = set()
+
+
+def fts_enabled():
+    """ True when the default database is SQLite and the FTS table has been created """
+    if connection.vendor != 'sqlite':
+        return False
+    name = str(connection.settings_dict['NAME'])
+    if name not in _fts_databases:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+            if cursor.fetchone() is None:
+                return False
+        _fts_databases.add(name)
+    return True
+
+
+def create_index():
+    """ Create the FTS table if it is missing, returns False on databases other than SQLite """
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(CREATE_FTS_TABLE)
+    return True
+
+
+def fts_rowid(isbn):
+    """ Stable positive 63-bit rowid for an isbn """
+    digest = hashlib.blake2b(isbn.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') >> 1
+
+
+def fts_row(book):
+    """ Values for one book's index row, rowid first """
+    year = "" if book.year_public is None else str(book.year_public)
+    return (fts_rowid(book.isbn), book.isbn, book.title, book.authors, book.publisher or "", year)
+
+
+def index_books(books):
+    """ Add or replace the index rows for the given books """
+    if not fts_enabled():
+        return
+    rows = [fts_row(book) for book in books]
+    if not rows:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany("DELETE FROM %s WHERE rowid = %%s" % FTS_TABLE, [(row[0],) for row in rows])
+        cursor.executemany(
+            "INSERT INTO %s (rowid, %s) VALUES (%%s, %%s, %%s, %%s, %%s, %%s)" % (FTS_TABLE, ", ".join(FTS_COLUMNS)),
+            rows,
+        )
+
+
+def unindex_book(isbn):
+    """ Remove one book from the index """
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM %s WHERE rowid = %%s" % FTS_TABLE, [fts_rowid(isbn)])
+
+
+def rebuild_index(batch_size=1000):
+    """ Drop every index row and re-add the whole catalog, returns the number of books indexed """
+    if not fts_enabled():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM %s" % FTS_TABLE)
+    books = Book.objects.only(*FTS_COLUMNS).order_by()
+    batch = []
+    total = 0
+    for book in books.iterator(chunk_size=batch_size):
+        batch.append(book)
+        if len(batch) >= batch_size:
+            index_books(batch)
+            total += len(batch)
+            batch = []
+    index_books(batch)
+    total += len(batch)
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO %s (%s) VALUES ('optimize')" % (FTS_TABLE, FTS_TABLE))
+    return total
+
+
+def match_expression(text):
+    """ Turn free text into an FTS5 query: every word must match, as a prefix """
+    words = re.findall(r"\w+", text.lower())
+    return " ".join('"%s"*' % word for word in words)
+
+
+class RankedSearchResults:
+    """ Lazy, sliceable list of books matching an FTS query, best match first.
+
+    Paginator only needs count() and slicing, so a page costs one COUNT over the
+    index, one LIMIT/OFFSET over the index and one primary key lookup for the books.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM %s WHERE %s MATCH %%s" % (FTS_TABLE, FTS_TABLE), [self.expression])
+                self._count = cursor.fetchone()[0]
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start = index.start or 0
+        limit = -1 if index.stop is None else max(index.stop - start, 0)
+        weights = ", ".join(str(weight) for weight in FTS_WEIGHTS)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT isbn FROM %s WHERE %s MATCH %%s ORDER BY bm25(%s, %s) LIMIT %%s OFFSET %%s"
+                % (FTS_TABLE, FTS_TABLE, FTS_TABLE, weights),
+                [self.expression, limit, start],
+            )
+            isbns = [row[0] for row in cursor.fetchall()]
+        books = Book.objects.in_bulk(isbns)
+        return [books[isbn] for isbn in isbns if isbn in books]
+
+
+def orm_search(text):
+    """ Fallback search for databases without the FTS index """
+    return Book.objects.filter(
+        Q(title__icontains = text) | Q(isbn__icontains = text) | Q(authors__icontains = text)
+        | Q(year_public__contains = text) | Q(publisher__icontains = text)
+    ).order_by('title', 'isbn')
+
+
+def search_books(text, page_number=None):
+    """ Return one page of books matching the search text """
+    expression = match_expression(text)
+    if fts_enabled():
+        if expression:
+            results = RankedSearchResults(expression)
+        else:
+            results = Book.objects.none()
+    else:
+        results = orm_search(text)
+    return Paginator(results, RESULTS_PER_PAGE).get_page(page_number)
@@ -0,0 +1,43 @@
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import Book, ReviewRating
+from . import catalog, facets, instrumentation, page_cache, search, thumbnails
+
+
+@receiver(post_save, sender=Book)
+def book_saved(sender, instance, created=False, raw=False, **kwargs):
+    """ Keep the search index and cached catalog lists in step with the saved book """
+    if raw:
+        return
+    search.index_books([instance])
+    facets.book_changed(instance)
+    thumbnails.update_thumbnails(instance) # only does anything when the cover changed
+    if created:
+        catalog.books_added_or_removed()
+    page_cache.catalog_changed()
+
+
+@receiver(post_delete, sender=Book)
+def book_deleted(sender, instance, **kwargs):
+    """ Drop a deleted book from the search index and cached catalog lists """
+    search.unindex_book(instance.isbn)
+    facets.book_deleted(instance.isbn)
+    catalog.books_added_or_removed()
+    page_cache.catalog_changed()
+
+
+@receiver(post_save, sender=ReviewRating)
+@receiver(post_delete, sender=ReviewRating)
+def review_changed(sender, instance, raw=False, **kwargs):
+    """ Product pages show reviews and ratings, so cached pages and the book's version have to go """
+    if not raw:
+        Book.objects.filter(isbn = instance.book_id).update(version = F('version') + 1)
+        page_cache.catalog_changed()
+
+
+@receiver(connection_created)
+def connection_opened(sender, connection, **kwargs):
+    """ Let the per-request query instrumentation see this connection's queries """
+    instrumentation.install(connection)
@@ -0,0 +1,64 @@
+""" Static file storage for `manage.py collectstatic`.
+
+Files are copied to STATIC_ROOT under content-hashed names listed in a manifest,
+which {% static %} resolves through, so they can be cached forever. Text assets
+also get .gz (and .br, when the brotli package is installed) siblings that
+bookstore.middleware.StaticAssetsMiddleware serves to clients that accept them.
+"""
+import gzip
+import os
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+try:
+    import brotli
+except ImportError: # optional, gzip alone is still a big saving
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.xml', '.map', '.ico'}
+MIN_COMPRESS_SIZE = 256 # bytes, smaller files aren't worth the extra request headers
+
+
+def compress_file(path):
+    """ Write .gz and .br siblings of a file when they come out smaller, returns the paths written """
+    with open(path, 'rb') as original:
+        content = original.read()
+    if len(content) < MIN_COMPRESS_SIZE:
+        return []
+    encoded = [('.gz', gzip.compress(content, 9, mtime = 0))]
+    if brotli is not None:
+        encoded.append(('.br', brotli.compress(content)))
+    written = []
+    for suffix, data in encoded:
+        if len(data) < len(content):
+            with open(path + suffix, 'wb') as compressed:
+                compressed.write(data)
+            written.append(path + suffix)
+    return written
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """ ManifestStaticFilesStorage that also precompresses text assets.
+
+    Names missing from the manifest resolve to their plain unhashed url instead of
+    raising, so a page still renders when collectstatic hasn't been run (tests, a
+    fresh checkout) or an asset was added without re-running it.
+    """
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+    def post_process(self, paths, dry_run = False, **options):
+        # hashed names are rewritten over several passes, so compress once they are final
+        results = list(super().post_process(paths, dry_run, **options))
+        if not dry_run:
+            for name, hashed_name, processed in results:
+                if isinstance(processed, Exception):
+                    continue
+                for stored in {name, hashed_name} - {None}:
+                    if os.path.splitext(stored)[1].lower() in COMPRESSIBLE_EXTENSIONS and self.exists(stored):
+                        compress_file(self.path(stored))
+        yield from results
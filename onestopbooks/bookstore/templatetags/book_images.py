@@ -0,0 +1,35 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html
+from bookstore.thumbnails import srcset
+
+register = template.Library()
+
+# how wide each slot is drawn (static/css/style.css), tells the browser which srcset entry it needs
+SLOT_WIDTHS = {
+    'cart': '80px',
+    'grid': '120px',
+    'detail': '120px',
+}
+
+
+@register.simple_tag
+def book_image(book, slot, css_class="", alt=""):
+    """ Cover image for a book in the given slot (cart, grid or detail).
+
+    Books with resized copies get a <picture> with WebP and JPEG srcsets, the others
+    a plain <img> of the original upload.
+    """
+    original = book.thumbnail_pic.url if book.thumbnail_pic else (book.image_url or "")
+    jpeg_srcset = srcset(book.thumbnails, 'jpg')
+    if not jpeg_srcset:
+        return format_html('<img class="{}" src="{}" alt="{}">', css_class, original, alt)
+
+    sizes = SLOT_WIDTHS[slot]
+    derivative = book.thumbnails['sizes'].get(slot) or {}
+    src = default_storage.url(derivative['jpg']) if derivative.get('jpg') else original
+    image = format_html('<img class="{}" src="{}" srcset="{}" sizes="{}" alt="{}">', css_class, src, jpeg_srcset, sizes, alt)
+    webp_srcset = srcset(book.thumbnails, 'webp')
+    if not webp_srcset:
+        return image
+    return format_html('<picture><source type="image/webp" srcset="{}" sizes="{}">{}</picture>', webp_srcset, sizes, image)
@@ -1,6 +1,42 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import http.server
+import json
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Count, Q
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from django.core.cache import cache, caches
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.cache.utils import make_template_fragment_key
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.template import Context, Template
 from bookstore.models import *
+from bookstore import benchmarks, facets, instrumentation, mirror, page_cache, routers, search, thumbnails, views
+from bookstore.catalog import book_count, newest_books, random_books
+from bookstore.checkout import new_idempotency_key, place_order
+from bookstore.pagination import InvalidCursor, encode_cursor, keyset_page
+from bookstore.context_processors import cart_summary
+from bookstore.management.commands import bench_checkout, load_customers
 
 # Create your tests here.
 # Django test example: https://docs.djangoproject.com/en/4.0/topics/testing/overview/
@@ -130,6 +166,12 @@ class BookTestCase(TestCase):
         valid_book.decrease_quantity(3)
         self.assertEqual(7, valid_book.quantity)
 
+        # can't sell more copies than there are, but can sell the last one
+        self.assertFalse(valid_book.decrease_quantity(8))
+        self.assertEqual(7, Book.objects.get(isbn="195153448").quantity)
+        self.assertTrue(valid_book.decrease_quantity(7))
+        self.assertEqual(0, valid_book.quantity)
+
 class CustomerTestCase(TestCase):
     def test_valid_customer(self):
         Customer.objects.create(
@@ -550,6 +592,43 @@ class RentItemCase(TestCase):
                 order1 = self.test_order,
                 quantity1 = "not a number")
 
+class CartLineTestCase(TestCase):
+    """ Test case for the single cart line table behind OrderItem and RentItem """
+
+    def setUp(self):
+        self.test_book = Book.objects.create(
+            isbn = "195153448",
+            title = "Classical Mythology",
+            authors = "Mark P. O. Morford",
+            thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg",
+            quantity = 10,
+            price = 10)
+        self.test_order = Order.objects.create(complete = False)
+
+    def test_buy_and_rent_lines_share_one_table(self):
+        OrderItem.objects.create(product = self.test_book, order = self.test_order, quantity = 2)
+        RentItem.objects.create(product1 = self.test_book, order1 = self.test_order, quantity1 = 1)
+
+        self.assertEqual(CartLine.objects.count(), 2)
+        self.assertEqual(list(OrderItem.objects.values_list('line_type', 'quantity')), [('buy', 2)])
+        self.assertEqual(list(RentItem.objects.values_list('line_type', 'quantity')), [('rent', 1)])
+        rent = RentItem.objects.get(order1 = self.test_order, product1__isbn = "195153448")
+        self.assertEqual(rent.quantity1, 1)
+        self.assertEqual(rent.date_due1, rent.date_added + timedelta(days=7))
+
+    def test_one_line_per_book_and_type(self):
+        OrderItem.objects.create(product = self.test_book, order = self.test_order, quantity = 1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            OrderItem.objects.create(product = self.test_book, order = self.test_order, quantity = 1)
+
+    def test_cart_lines_is_one_query(self):
+        OrderItem.objects.create(product = self.test_book, order = self.test_order, quantity = 2)
+        RentItem.objects.create(product1 = self.test_book, order1 = self.test_order, quantity1 = 1)
+        with self.assertNumQueries(1):
+            buys, rents = self.test_order.cart_lines()
+            self.assertEqual([(line.product.title, line.get_total) for line in buys], [("Classical Mythology", 20)])
+            self.assertEqual([(line.product1.title, line.quantity1) for line in rents], [("Classical Mythology", 1)])
+
 class ViewsTestCase(TestCase):
     def setUp(self):
         self.credentials = {
@@ -771,14 +850,14 @@ class ViewsTestCase(TestCase):
         self.assertTemplateUsed(response, 'product.html')
     
     def test_successcheckout_view_Not_Authenticated(self):
-        response = self.client.get('/successcheckout/')
+        response = self.client.post('/successcheckout/', {'idempotency_key': new_idempotency_key()})
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'checkout-success.html')
     
     def test_successcheckout_view_Authenticated_Purchase_Book(self):
         self.client.post('/login/', self.credentials)
         
-        response = self.client.get('/successcheckout/')
+        response = self.client.post('/successcheckout/', {'idempotency_key': new_idempotency_key()})
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'checkout-success.html')
         
@@ -787,6 +866,78 @@ class ViewsTestCase(TestCase):
         
         self.assertEqual(6, test_book.quantity)
         self.assertEqual(9, test_book_2.quantity)
+
+        order = Order.objects.get(pk=self.test_order.pk)
+        self.assertTrue(order.complete)
+        self.assertContains(response, order.transaction_id)
+
+        # the cart is gone, so checking out again doesn't sell anything
+        self.client.post('/successcheckout/', {'idempotency_key': new_idempotency_key()})
+        self.assertEqual(6, Book.objects.get(isbn="195153448").quantity)
+
+    def test_successcheckout_view_GET_places_no_order(self):
+        self.client.post('/login/', self.credentials)
+
+        response = self.client.get('/successcheckout/', {'idempotency_key': new_idempotency_key()})
+        self.assertEqual(response.status_code, 405)
+        self.assertFalse(Order.objects.get(pk=self.test_order.pk).complete)
+        self.assertEqual(10, Book.objects.get(isbn="195153448").quantity)
+
+    def test_successcheckout_view_needs_idempotency_key(self):
+        self.client.post('/login/', self.credentials)
+
+        response = self.client.post('/successcheckout/')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.get(pk=self.test_order.pk).complete)
+
+    def test_successcheckout_view_idempotency_key(self):
+        self.client.post('/login/', self.credentials)
+        response = self.client.get('/checkout/')
+        key = response.context['idempotency_key']
+
+        first = self.client.post('/successcheckout/', {'idempotency_key': key})
+        # a new cart, then the same form submitted again
+        Order.objects.create(customer=self.test_customer, complete=False)
+        second = self.client.post('/successcheckout/', {'idempotency_key': key})
+
+        self.assertEqual(first.context['order'].pk, self.test_order.pk)
+        self.assertEqual(second.context['order'].pk, self.test_order.pk)
+        self.assertEqual(key, Order.objects.get(pk=self.test_order.pk).transaction_id)
+        self.assertEqual(6, Book.objects.get(isbn="195153448").quantity)
+        self.assertEqual(1, Order.objects.filter(customer=self.test_customer, complete=False).count())
+
+    def test_successcheckout_view_database_busy(self):
+        self.client.post('/login/', self.credentials)
+        def locked(user, key):
+            raise OperationalError("database is locked")
+        self.addCleanup(setattr, views, 'place_order', views.place_order)
+        views.place_order = locked
+
+        response = self.client.post('/successcheckout/', {'idempotency_key': new_idempotency_key()}, follow=True)
+        self.assertRedirects(response, '/cart/')
+        self.assertContains(response, "please try again")
+
+    def test_place_order_lost_claim_returns_the_placed_order(self):
+        key = new_idempotency_key()
+        placed = place_order(self.test_user, key)
+        # the cart is already completed under this key, a retry claims nothing and gets the same order
+        Order.objects.create(customer=self.test_customer, complete=False)
+        self.assertEqual(place_order(self.test_user, key).pk, placed.pk)
+        self.assertEqual(place_order(self.test_user.pk, key).pk, placed.pk)
+        self.assertEqual(1, Order.objects.filter(customer=self.test_customer, complete=False).count())
+
+    def test_successcheckout_view_out_of_stock(self):
+        self.client.post('/login/', self.credentials)
+        Book.objects.filter(isbn="195153448").update(quantity=3)
+
+        response = self.client.post('/successcheckout/', {'idempotency_key': new_idempotency_key()}, follow=True)
+        self.assertRedirects(response, '/cart/')
+        self.assertContains(response, "Not enough stock for: Classical Mythology")
+
+        # nothing was sold and the cart is still open
+        self.assertEqual(3, Book.objects.get(isbn="195153448").quantity)
+        self.assertEqual(10, Book.objects.get(isbn="771074670").quantity)
+        self.assertFalse(Order.objects.get(pk=self.test_order.pk).complete)
     
     def test_randombooks_view(self):
         self.create_n_books(20)
@@ -867,3 +1018,1662 @@ class ReviewRatingTestCase(TestCase):
             ReviewRating.objects.create(
                 rate = "Vầng Trăng Xưa",
             )
+
+class RatingTotalsTestCase(TestCase):
+    """ Test case for the stored rating totals on Book """
+
+    def setUp(self):
+        self.credentials = {
+            'username' : 'testuser',
+            'password' : 'testpass'
+        }
+        self.test_user = User.objects.create_user(**self.credentials)
+
+        Book.objects.create(
+            isbn = "195153448",
+            title = "Classical Mythology",
+            authors = "Mark P. O. Morford",
+            year_public = "2002",
+            publisher = "Oxford University Press",
+            thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg",
+            quantity = 10,
+            price = 10)
+        self.test_book = Book.objects.get(isbn="195153448")
+
+    def test_new_book_has_no_ratings(self):
+        self.assertEqual(self.test_book.countReview(), 0)
+        self.assertEqual(self.test_book.averageReview(), 0)
+
+    def test_add_rating(self):
+        self.test_book.add_rating(5)
+        self.test_book.add_rating(4)
+        self.test_book.add_rating(4)
+
+        book = Book.objects.get(isbn="195153448")
+        self.assertEqual(book.countReview(), 3)
+        self.assertEqual(book.rating_sum, 13)
+        self.assertEqual(book.averageReview(), 4.33)
+
+    def test_submit_review_updates_totals(self):
+        self.client.post('/login/', self.credentials)
+        header = {'HTTP_REFERER': '/product/195153448'}
+        self.client.post('/submit_review/195153448', {'rate': '5', 'subject': 'test', 'review': 'test'}, **header)
+        self.client.post('/submit_review/195153448', {'rate': '2', 'subject': 'test', 'review': 'test'}, **header)
+
+        book = Book.objects.get(isbn="195153448")
+        self.assertEqual(book.countReview(), 2)
+        self.assertEqual(book.averageReview(), 3.5)
+
+    def test_product_view_does_not_aggregate_reviews(self):
+        self.test_book.add_rating(5)
+        # the book's version for the ETag, book, reviews list - no per-call Avg/Count queries
+        with self.assertNumQueries(3):
+            response = self.client.get('/product/195153448')
+        self.assertContains(response, "Average Rating 5.0")
+
+    def test_rebuild_ratings_repairs_drift(self):
+        ReviewRating.objects.create(user = self.test_user, book = self.test_book, rate = 3)
+        ReviewRating.objects.create(user = self.test_user, book = self.test_book, rate = 4)
+        Book.objects.filter(isbn="195153448").update(rating_count = 7, rating_sum = 1, rating_average = 0.1)
+
+        call_command('rebuild_ratings', stdout=StringIO())
+
+        book = Book.objects.get(isbn="195153448")
+        self.assertEqual(book.countReview(), 2)
+        self.assertEqual(book.rating_sum, 7)
+        self.assertEqual(book.averageReview(), 3.5)
+
+    def test_rebuild_ratings_dry_run(self):
+        ReviewRating.objects.create(user = self.test_user, book = self.test_book, rate = 3)
+        out = StringIO()
+
+        call_command('rebuild_ratings', '--dry-run', stdout=out)
+
+        self.assertIn("1 books have out of date rating totals", out.getvalue())
+        self.assertEqual(Book.objects.get(isbn="195153448").countReview(), 0)
+
+    def test_rebuild_ratings_quiet(self):
+        ReviewRating.objects.create(user = self.test_user, book = self.test_book, rate = 3)
+        out = StringIO()
+        call_command('rebuild_ratings', verbosity = 0, stdout = out)
+        self.assertEqual(out.getvalue(), "")
+        self.assertEqual(Book.objects.get(isbn="195153448").countReview(), 1)
+
+class SearchTestCase(TestCase):
+    """ Test case for the full-text book search """
+
+    def setUp(self):
+        Book.objects.create(
+            isbn = "195153448",
+            title = "Classical Mythology",
+            authors = "Mark P. O. Morford",
+            year_public = "2002",
+            publisher = "Oxford University Press",
+            thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg",
+            quantity = 10,
+            price = 10)
+        Book.objects.create(
+            isbn = "771074670",
+            title = "Nights Below Station Street",
+            authors = "David Adams Richards",
+            year_public = "1988",
+            publisher = "Emblem Editions",
+            thumbnail_pic = "http://images.amazon.com/images/P/0771074670.01.MZZZZZZZ.jpg",
+            quantity = 10,
+            price = 10)
+
+    def search_isbns(self, text, page=None):
+        return [book.isbn for book in search.search_books(text, page)]
+
+    def test_index_is_enabled_on_sqlite(self):
+        self.assertTrue(search.fts_enabled())
+
+    def test_search_title_prefix(self):
+        self.assertEqual(self.search_isbns("classic myth"), ["195153448"])
+
+    def test_search_author_and_publisher(self):
+        self.assertEqual(self.search_isbns("richards"), ["771074670"])
+        self.assertEqual(self.search_isbns("oxford"), ["195153448"])
+
+    def test_search_isbn(self):
+        self.assertEqual(self.search_isbns("7710"), ["771074670"])
+
+    def test_search_ranks_title_matches_first(self):
+        Book.objects.create(
+            isbn = "111111111",
+            title = "Street Food",
+            authors = "Nobody",
+            year_public = "2010",
+            publisher = "Station Press",
+            quantity = 10,
+            price = 10)
+        self.assertEqual(self.search_isbns("station street"), ["771074670", "111111111"])
+
+    def test_index_follows_save_and_delete(self):
+        book = Book.objects.get(isbn="195153448")
+        book.title = "Greek Legends"
+        book.save()
+        self.assertEqual(self.search_isbns("mythology"), [])
+        self.assertEqual(self.search_isbns("legends"), ["195153448"])
+
+        book.delete()
+        self.assertEqual(self.search_isbns("legends"), [])
+
+    def test_search_is_paginated(self):
+        for i in range(25):
+            Book.objects.create(isbn = "90000000" + str(i).zfill(2), title = "Paged " + str(i), authors = "A", quantity = 1, price = 1)
+        first = search.search_books("paged")
+        self.assertEqual(first.paginator.count, 25)
+        self.assertEqual(len(first), 20)
+        self.assertEqual(len(search.search_books("paged", 2)), 5)
+
+    def test_search_punctuation_only(self):
+        self.assertEqual(self.search_isbns('"*('), [])
+
+    def test_rebuild_search_index(self):
+        Book.objects.filter(isbn="195153448").update(title = "Updated Without Signals")
+        self.assertEqual(self.search_isbns("updated"), [])
+
+        call_command('rebuild_search_index', stdout=StringIO())
+
+        self.assertEqual(self.search_isbns("updated"), ["195153448"])
+
+    def test_orm_fallback(self):
+        self.assertEqual([book.isbn for book in search.orm_search("Station")], ["771074670"])
+
+    def test_search_view_get_with_page(self):
+        response = self.client.get('/bookstore/search', {'searched': 'mythology', 'page': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Search Results: (1)")
+
+class LoadCatalogTestCase(TestCase):
+    """ Test case for the load_catalog management command """
+
+    def write_csv(self, text):
+        csv_file = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+        csv_file.write(text)
+        csv_file.close()
+        self.addCleanup(os.remove, csv_file.name)
+        return csv_file.name
+
+    def test_load_books_csv(self):
+        call_command('load_catalog', '--batch-size', '128', stdout=StringIO())
+
+        self.assertEqual(Book.objects.count(), 500)
+        book = Book.objects.get(isbn="195153448")
+        self.assertEqual(book.title, "Classical Mythology")
+        self.assertEqual(book.year_public, 2002)
+        self.assertEqual(book.image_url, "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg")
+        self.assertEqual(Book.objects.get(isbn="393045218").publisher, "W. W. Norton & Company")
+        self.assertEqual([b.isbn for b in search.search_books("mummies urumchi")], ["393045218"])
+
+    def test_load_upserts_on_isbn(self):
+        path = self.write_csv(
+            "1,111,Old Title,Author,2001,Pub,http://example.com/1.jpg,10,5\n"
+            "2,222,Second,Author,2002,Pub,http://example.com/2.jpg,20,5\n")
+        call_command('load_catalog', path, stdout=StringIO())
+        path = self.write_csv("1,111,New Title,Author,2001,Pub,http://example.com/1.jpg,12,7\n")
+        call_command('load_catalog', path, stdout=StringIO())
+
+        self.assertEqual(Book.objects.count(), 2)
+        book = Book.objects.get(isbn="111")
+        self.assertEqual((book.title, book.price, book.quantity), ("New Title", 12, 7))
+
+    def test_load_skips_bad_rows(self):
+        path = self.write_csv(
+            "1,111,Good,Author,2001,Pub,http://example.com/1.jpg,10,5\n"
+            "2,222,Bad price,Author,2002,Pub,http://example.com/2.jpg,lots,5\n"
+            "3,333,Too few columns\n")
+        err = StringIO()
+        call_command('load_catalog', path, stdout=StringIO(), stderr=err)
+
+        self.assertEqual(list(Book.objects.values_list('isbn', flat=True)), ["111"])
+        self.assertIn("Skipping line 2", err.getvalue())
+        self.assertIn("Skipping line 3", err.getvalue())
+
+    def test_load_missing_file(self):
+        with self.assertRaises(CommandError):
+            call_command('load_catalog', '/does/not/exist.csv', stdout=StringIO())
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class LoadCustomersTestCase(TestCase):
+    """ Test case for the load_customers management command """
+
+    def test_load_customers_csv(self):
+        call_command('load_customers', '--workers', '1', '--unusable-passwords', stdout=StringIO(), stderr=StringIO())
+
+        self.assertEqual(Customer.objects.count(), 100)
+        self.assertEqual(User.objects.count(), 100)
+        self.assertFalse(User.objects.get(username="gabate0@slate.com").has_usable_password())
+        customer = Customer.objects.get(email="gabate0@slate.com")
+        self.assertEqual(customer.user.username, "gabate0@slate.com")
+        self.assertEqual(customer.city, "Garland")
+
+    def test_load_customers_is_resumable(self):
+        call_command('load_customers', '--workers', '1', '--batch-size', '30', '--unusable-passwords',
+                     stdout=StringIO(), stderr=StringIO())
+        Customer.objects.filter(email="gabate0@slate.com").delete()
+        User.objects.filter(username="gabate0@slate.com").delete()
+        out = StringIO()
+
+        call_command('load_customers', '--workers', '1', '--unusable-passwords', stdout=out, stderr=StringIO())
+
+        self.assertEqual(Customer.objects.count(), 100)
+        self.assertIn("Created 1 customers, 99 already existed", out.getvalue())
+
+    def test_load_customers_with_process_pool(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, "customers.csv")
+        credentials = os.path.join(folder, "credentials.csv")
+        with open(path, 'w') as csv_file:
+            csv_file.write("Amy,Test,AmyTest@gmail.com,123 S. Denver,Denver,CO,80123\n")
+            csv_file.write("Bob,Test,bob@example.com,1 Main St,Denver,CO,80124\n")
+
+        call_command('load_customers', path, '--workers', '2', '--credentials-out', credentials, stdout=StringIO())
+
+        with open(credentials) as csv_file:
+            rows = list(csv.reader(csv_file))
+        self.assertEqual([row[0] for row in rows], ["amytest@gmail.com", "bob@example.com"])
+        self.assertTrue(self.client.login(username=rows[1][0], password=rows[1][1]))
+
+    def test_load_customers_needs_somewhere_for_passwords(self):
+        with self.assertRaises(CommandError):
+            call_command('load_customers', '--workers', '1', stdout=StringIO())
+        self.assertEqual(User.objects.count(), 0)
+        # the options are checked before the file is opened
+        with self.assertRaisesRegex(CommandError, "--credentials-out"):
+            call_command('load_customers', '/does/not/exist.csv', '--workers', '1', stdout=StringIO())
+
+    def test_load_customers_saves_credentials_before_commit(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        credentials = os.path.join(folder, "credentials.csv")
+
+        class CrashingCommand(load_customers.Command):
+            def save_credentials(self, path, users, passwords):
+                super().save_credentials(path, users, passwords)
+                raise IntegrityError("crash before the commit")
+
+        with self.assertRaises(IntegrityError):
+            call_command(CrashingCommand(), '--workers', '1', '--credentials-out', credentials, stdout=StringIO())
+
+        self.assertEqual(User.objects.count(), 0)
+        with open(credentials) as csv_file:
+            self.assertEqual(len(list(csv.reader(csv_file))), 100)
+
+class KeysetPaginationTestCase(TestCase):
+    """ Test case for cursor pagination of the books page """
+
+    def setUp(self):
+        cache.clear()
+        for i in range(45):
+            Book.objects.create(
+                isbn = "19515345" + str(i).zfill(2),
+                title = "Book" + str(i % 7),
+                authors = "Author" + str(i % 5),
+                year_public = "2002",
+                publisher = "Oxford University Press",
+                thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg",
+                quantity = 10,
+                price = i % 9)
+
+    def walk(self, ordering, per_page=20):
+        """ Follow next cursors from the first page to the end """
+        pages = [keyset_page(Book.objects.all(), ordering, per_page)]
+        while pages[-1].has_next():
+            pages.append(keyset_page(Book.objects.all(), ordering, per_page, pages[-1].next_cursor))
+        return pages
+
+    def test_pages_cover_every_sort_in_order(self):
+        for ordering in [('isbn',), ('title', 'isbn'), ('authors', 'isbn'), ('price', 'isbn'), ('-price', 'isbn')]:
+            pages = self.walk(ordering)
+            isbns = [book.isbn for page in pages for book in page]
+            expected = list(Book.objects.order_by(*ordering).values_list('isbn', flat=True))
+            self.assertEqual(isbns, expected, ordering)
+            self.assertEqual([page.number for page in pages], [1, 2, 3])
+
+    def test_previous_cursor_returns_the_same_page(self):
+        pages = self.walk(('-price', 'isbn'))
+        previous = keyset_page(Book.objects.all(), ('-price', 'isbn'), 20, pages[2].previous_cursor)
+        self.assertEqual(list(previous), list(pages[1]))
+        self.assertTrue(previous.has_next())
+        self.assertTrue(previous.has_previous())
+        self.assertEqual(previous.number, 2)
+
+    def test_last_cursor(self):
+        first = keyset_page(Book.objects.all(), ('title', 'isbn'), 20)
+        last = keyset_page(Book.objects.all(), ('title', 'isbn'), 20, first.last_cursor)
+        self.assertEqual(list(last), list(self.walk(('title', 'isbn'))[-1]))
+        self.assertFalse(last.has_next())
+        self.assertEqual(last.number, 3)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            keyset_page(Book.objects.all(), ('isbn',), 20, "not-a-cursor")
+        response = self.client.get('/books/', {'sort': 'titles_az', 'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['book_page'].number, 1)
+
+    def test_cursor_with_the_wrong_key_length(self):
+        for key in ([], ["Book1"], ["Book1", "1951534501", "extra"]):
+            cursor = encode_cursor('next', ('title', 'isbn'), key, 2)
+            with self.assertRaises(InvalidCursor, msg = key):
+                keyset_page(Book.objects.all(), ('title', 'isbn'), 20, cursor)
+            response = self.client.get('/books/', {'sort': 'titles_az', 'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['book_page'].number, 1)
+
+    def test_cursor_from_another_sort(self):
+        titles = self.client.get('/books/', {'sort': 'titles_az'}).context['book_page']
+        response = self.client.get('/books/', {'sort': 'price_lh', 'cursor': titles.next_cursor})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['book_page'].number, 1)
+        # same ordering, but a value that doesn't fit the field
+        cursor = encode_cursor('next', ('price', 'isbn'), ["Book1", "1951534501"], 2)
+        with self.assertRaises(InvalidCursor):
+            keyset_page(Book.objects.all(), ('price', 'isbn'), 20, cursor)
+
+    def query_plan(self, ordering, cursor):
+        with CaptureQueriesContext(connection) as queries:
+            keyset_page(Book.objects.all(), ordering, 20, cursor, count = 45)
+        with connection.cursor() as database:
+            database.execute("EXPLAIN QUERY PLAN " + queries[0]['sql'])
+            return " ".join(row[-1] for row in database.fetchall())
+
+    def test_pages_are_index_range_reads(self):
+        for sort, index in [('titles_az', 'book_title_idx'), ('authors_az', 'book_authors_idx'),
+                            ('price_lh', 'book_price_idx'), ('price_hl', 'book_price_desc_idx')]:
+            ordering = views.BOOK_SORTS[sort]
+            first = keyset_page(Book.objects.all(), ordering, 20)
+            # a later page seeks into the index at the previous page's edge, nothing is sorted
+            plan = self.query_plan(ordering, first.next_cursor)
+            self.assertIn("SEARCH bookstore_book USING INDEX %s" % index, plan)
+            self.assertNotIn("TEMP B-TREE", plan)
+            # the last page reads the same index backwards
+            plan = self.query_plan(ordering, first.last_cursor)
+            self.assertIn("USING INDEX %s" % index, plan)
+            self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_books_view_deep_page_query_count(self):
+        self.client.get('/books/') # warm the cached count
+        first = self.client.get('/books/', {'sort': 'price_hl'}).context['book_page']
+        # session-less anonymous request: one query for the page rows and nothing else
+        with self.assertNumQueries(1):
+            response = self.client.get('/books/', {'sort': 'price_hl', 'cursor': first.next_cursor})
+        self.assertContains(response, "Page 2 of 3")
+        self.assertContains(response, "Products (45)")
+
+    def test_book_count_cache_follows_new_books(self):
+        self.assertEqual(book_count(), 45)
+        Book.objects.create(isbn = "1", title = "New", authors = "A", quantity = 1, price = 1)
+        self.assertEqual(book_count(), 46)
+        Book.objects.get(isbn = "1").delete()
+        self.assertEqual(book_count(), 45)
+
+class RandomBooksTestCase(TestCase):
+    """ Test case for random book sampling """
+
+    def setUp(self):
+        cache.clear()
+
+    def create_n_books(self, n):
+        for i in range(n):
+            Book.objects.create(
+                isbn = "19515345" + str(i).zfill(2),
+                title = "Book" + str(i),
+                authors = "Test book author",
+                thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg",
+                quantity = 10,
+                price = 10)
+
+    def test_new_books_get_their_own_random_key(self):
+        self.create_n_books(3)
+        keys = list(Book.objects.values_list('random_key', flat=True))
+        self.assertEqual(len(set(keys)), 3)
+        self.assertTrue(all(0 <= key < 1 for key in keys))
+
+    def test_small_catalog_returns_every_book(self):
+        self.create_n_books(3)
+        self.assertEqual(len(random_books(20)), 3)
+        response = self.client.get('/randombooks/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['books']), 3)
+
+    def test_empty_catalog(self):
+        self.assertEqual(random_books(20), [])
+
+    def test_sample_is_distinct(self):
+        self.create_n_books(60)
+        books = random_books(20)
+        self.assertEqual(len(books), 20)
+        self.assertEqual(len({book.isbn for book in books}), 20)
+
+    def test_sample_does_not_scan_the_catalog(self):
+        self.create_n_books(60)
+        book_count()
+        with CaptureQueriesContext(connection) as queries:
+            random_books(20)
+        self.assertLessEqual(len(queries), 2)
+        for query in queries:
+            self.assertIn("LIMIT", query['sql'])
+
+    def test_sample_wraps_around_the_end(self):
+        self.create_n_books(60)
+        # only the last 10 books are past any point random() is likely to give
+        Book.objects.filter(isbn__lt = "1951534550").update(random_key = 0)
+        Book.objects.filter(isbn__gte = "1951534550").update(random_key = 1 - 1e-12)
+        books = random_books(20)
+        self.assertEqual(len({book.isbn for book in books}), 20)
+        self.assertEqual(sum(book.random_key > 0 for book in books), 10)
+
+        # a logged in visitor's page, wrapping around, is within the view's query budget
+        User.objects.create_user(username = 'testuser', password = 'testpass')
+        self.client.login(username = 'testuser', password = 'testpass')
+        response = self.client.get('/randombooks/')
+        self.assertEqual(len(response.context['books']), 20)
+
+class NewestBooksTestCase(TestCase):
+    """ Test case for the newest arrivals list """
+
+    def setUp(self):
+        cache.clear()
+        start = timezone.now() - timedelta(days=1)
+        for i in range(25):
+            Book.objects.create(
+                isbn = "19515345" + str(i).zfill(2),
+                title = "Book" + str(i),
+                authors = "Test book author",
+                thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg",
+                date_added = start + timedelta(minutes=i),
+                quantity = 10,
+                price = 10)
+
+    def newest_isbns(self):
+        return [book.isbn for book in newest_books()]
+
+    def test_newest_first(self):
+        expected = ["19515345" + str(i).zfill(2) for i in range(24, 4, -1)]
+        self.assertEqual(self.newest_isbns(), expected)
+
+    def test_cached_list_is_dropped_when_a_book_is_added(self):
+        self.newest_isbns()
+        Book.objects.create(isbn = "1", title = "New", authors = "A", quantity = 1, price = 1)
+        self.assertEqual(self.newest_isbns()[0], "1")
+
+    def test_cached_list_only_reads_the_books(self):
+        self.newest_isbns()
+        with CaptureQueriesContext(connection) as queries:
+            books = newest_books()
+        self.assertEqual(len(queries), 1)
+        self.assertIn("IN (", queries[0]['sql'])
+        self.assertEqual(len(books), 20)
+
+    def test_newest_books_view(self):
+        response = self.client.get('/newestbooks/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['books'][0].isbn, "1951534524")
+
+    def test_load_catalog_keeps_feed_order(self):
+        call_command('load_catalog', stdout=StringIO())
+        # the last row of books.csv is the newest arrival
+        self.assertEqual(self.newest_isbns()[:2], ["740700235", "345451260"])
+
+class CartContextTestCase(TestCase):
+    """ Test case for the cart context processor and lazy cart creation """
+
+    def setUp(self):
+        self.credentials = {
+            'username' : 'testuser',
+            'password' : 'testpass'
+        }
+        self.test_user = User.objects.create_user(**self.credentials)
+        self.test_customer = Customer.objects.create(
+            user = self.test_user,
+            first_name = "Amy",
+            last_name = "Test",
+            email = "AmyTest@gmail.com",
+            address_1 = "123 S. Denver",
+            city = "Denver",
+            state = "Colorado",
+            zip_code = "80123")
+        self.test_book = Book.objects.create(
+            isbn = "195153448",
+            title = "Classical Mythology",
+            authors = "Mark P. O. Morford",
+            thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg",
+            quantity = 10,
+            price = 12)
+        self.client.post('/login/', self.credentials)
+
+    def fill_cart(self):
+        order = Order.objects.create(customer = self.test_customer, complete = False)
+        OrderItem.objects.create(product = self.test_book, order = order, quantity = 2)
+        RentItem.objects.create(product1 = self.test_book, order1 = order, quantity1 = 1)
+        return order
+
+    def test_browsing_does_not_create_a_cart(self):
+        for url in ['/', '/books/', '/aboutus/', '/cart/', '/checkout/']:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, '<p id="cart-count">0</p>')
+        self.assertEqual(Order.objects.count(), 0)
+
+    def test_first_update_item_creates_the_cart(self):
+        self.client.post('/update_item', json.dumps({'bookIsbn': '195153448', 'action': 'purchase'}), content_type='application/json')
+        self.assertEqual(Order.objects.filter(customer = self.test_customer, complete = False).count(), 1)
+        response = self.client.get('/')
+        self.assertContains(response, '<p id="cart-count">1</p>')
+
+    def test_navbar_counts_buy_and_rent_lines(self):
+        self.fill_cart()
+        response = self.client.get('/aboutus/')
+        self.assertContains(response, '<p id="cart-count">3</p>')
+
+    def test_cart_summary_is_one_query(self):
+        self.fill_cart()
+        with self.assertNumQueries(1):
+            summary = cart_summary(self.test_user)
+        self.assertEqual(summary['cart_items'], 3)
+        self.assertEqual(summary['cart_total'], 36)
+
+    def test_home_page_queries(self):
+        self.fill_cart()
+        # session, user, cart summary
+        with self.assertNumQueries(3):
+            self.client.get('/')
+
+    def test_user_without_customer(self):
+        User.objects.create_user(username = 'staff', password = 'staffpass')
+        self.client.post('/login/', {'username': 'staff', 'password': 'staffpass'})
+        response = self.client.get('/cart/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '<p id="cart-count">0</p>')
+
+class CartUpdateTestCase(TestCase):
+    """ Test case for the batched update_item cart API """
+
+    def setUp(self):
+        self.credentials = {
+            'username' : 'testuser',
+            'password' : 'testpass'
+        }
+        self.test_user = User.objects.create_user(**self.credentials)
+        self.test_customer = Customer.objects.create(
+            user = self.test_user,
+            first_name = "Amy",
+            last_name = "Test",
+            email = "AmyTest@gmail.com",
+            address_1 = "123 S. Denver",
+            city = "Denver",
+            state = "Colorado",
+            zip_code = "80123")
+        for isbn, price in [("195153448", 12), ("771074670", 5)]:
+            Book.objects.create(isbn = isbn, title = "Book " + isbn, authors = "Author", quantity = 10, price = price)
+        self.client.post('/login/', self.credentials)
+
+    def post(self, data):
+        return self.client.post('/update_item', json.dumps(data), content_type='application/json')
+
+    def lines(self):
+        order = Order.objects.get(customer = self.test_customer, complete = False)
+        buys = dict(order.lines.filter(line_type = CartLine.BUY).values_list('product', 'quantity'))
+        rents = dict(order.lines.filter(line_type = CartLine.RENT).values_list('product', 'quantity'))
+        return buys, rents
+
+    def test_batch_of_operations(self):
+        response = self.post({'operations': [
+            {'bookIsbn': '195153448', 'action': 'purchase'},
+            {'bookIsbn': '195153448', 'action': 'add'},
+            {'bookIsbn': '771074670', 'action': 'rent'},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            'lines': [
+                {'bookIsbn': '195153448', 'type': 'buy', 'quantity': 2, 'total': 24},
+                {'bookIsbn': '771074670', 'type': 'rent', 'quantity': 1, 'total': 5},
+            ],
+            'cartItems': 3,
+            'cartTotal': 29,
+        })
+        # only the lines that were asked for exist, no empty rent/buy twins
+        self.assertEqual(self.lines(), ({'195153448': 2}, {'771074670': 1}))
+
+    def test_single_operation_still_accepted(self):
+        response = self.post({'bookIsbn': '195153448', 'action': 'purchase'})
+        self.assertEqual(response.json()['cartItems'], 1)
+        self.assertEqual(self.lines(), ({'195153448': 1}, {}))
+
+    def test_remove_and_delete_empty_lines(self):
+        self.post({'operations': [
+            {'bookIsbn': '195153448', 'action': 'purchase'},
+            {'bookIsbn': '771074670', 'action': 'rent'},
+        ]})
+        response = self.post({'operations': [
+            {'bookIsbn': '195153448', 'action': 'remove'},
+            {'bookIsbn': '771074670', 'action': 'deleteRent'},
+        ]})
+        self.assertEqual([line['quantity'] for line in response.json()['lines']], [0, 0])
+        self.assertEqual(response.json()['cartItems'], 0)
+        self.assertEqual(self.lines(), ({}, {}))
+
+    def test_batch_touches_only_its_lines(self):
+        self.post({'operations': [
+            {'bookIsbn': '195153448', 'action': 'purchase'},
+            {'bookIsbn': '771074670', 'action': 'purchase'},
+        ]})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post({'operations': [{'bookIsbn': '195153448', 'action': 'add'}]})
+        self.assertEqual(response.json()['lines'], [{'bookIsbn': '195153448', 'type': 'buy', 'quantity': 2, 'total': 24}])
+        writes = [query['sql'] for query in queries.captured_queries if query['sql'].startswith(('UPDATE', 'INSERT', 'DELETE'))]
+        self.assertEqual(len(writes), 2)
+        self.assertIn('"bookstore_customer"', writes[0]) # the no-op write that takes the lock
+        self.assertIn('"bookstore_cartline"', writes[1])
+
+    def test_invalid_batches_change_nothing(self):
+        for data in [
+            {'operations': []},
+            {'operations': [{'bookIsbn': '195153448', 'action': 'purchase'}, {'bookIsbn': '195153448', 'action': 'steal'}]},
+            {'operations': [{'bookIsbn': '195153448', 'action': 'purchase'}, {'bookIsbn': '999', 'action': 'rent'}]},
+            {'operations': ['purchase']},
+        ]:
+            response = self.post(data)
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post('/update_item', 'not json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Order.objects.count(), 0)
+
+    def test_anonymous_user(self):
+        self.client.logout()
+        response = self.post({'bookIsbn': '195153448', 'action': 'purchase'})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(Order.objects.count(), 0)
+
+    def test_busy_database_asks_for_a_retry(self):
+        def locked(customer, operations):
+            raise OperationalError("database is locked")
+        self.addCleanup(setattr, views, 'update_cart', views.update_cart)
+        views.update_cart = locked
+
+        response = self.post({'bookIsbn': '195153448', 'action': 'purchase'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertTrue(response.json()['retry'])
+
+class CartTotalsTestCase(TestCase):
+    """ Test case for the SQL cart totals """
+
+    def setUp(self):
+        self.credentials = {
+            'username' : 'testuser',
+            'password' : 'testpass'
+        }
+        self.test_user = User.objects.create_user(**self.credentials)
+        self.test_customer = Customer.objects.create(
+            user = self.test_user,
+            first_name = "Amy",
+            last_name = "Test",
+            email = "AmyTest@gmail.com",
+            address_1 = "123 S. Denver",
+            city = "Denver",
+            state = "Colorado",
+            zip_code = "80123")
+        self.test_order = Order.objects.create(customer = self.test_customer, complete = False)
+
+    def add_lines(self, n, start=0):
+        for i in range(start, start + n):
+            book = Book.objects.create(
+                isbn = "19515345" + str(i).zfill(2),
+                title = "Book" + str(i),
+                authors = "Test book author",
+                thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg",
+                quantity = 10,
+                price = i + 1)
+            OrderItem.objects.create(product = book, order = self.test_order, quantity = 2)
+            RentItem.objects.create(product1 = book, order1 = self.test_order, quantity1 = 1)
+
+    def test_totals_cover_buy_and_rent_lines(self):
+        self.add_lines(3)
+        order = Order.objects.get(pk = self.test_order.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(order.get_cart_items, 9)
+            self.assertEqual(order.get_cart_total, (1 + 2 + 3) * 3)
+
+    def test_annotated_totals_need_no_query(self):
+        self.add_lines(2)
+        order = Order.objects.with_cart_summary().get(pk = self.test_order.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(order.get_cart_items, 6)
+            self.assertEqual(order.get_cart_total, 9)
+
+    def test_cart_pages_use_fixed_queries(self):
+        self.client.post('/login/', self.credentials)
+        self.add_lines(1)
+        for url in ['/cart/', '/checkout/']:
+            with CaptureQueriesContext(connection) as one_line:
+                self.client.get(url)
+            self.add_lines(5, start=1)
+            with CaptureQueriesContext(connection) as many_lines:
+                response = self.client.get(url)
+            self.assertEqual(len(one_line), len(many_lines), url)
+            self.assertContains(response, "Book5")
+            OrderItem.objects.all().delete()
+            RentItem.objects.all().delete()
+            Book.objects.all().delete()
+            self.add_lines(1)
+
+class PageCacheTestCase(TestCase):
+    """ Test case for the anonymous page cache """
+
+    def setUp(self):
+        caches['pages'].clear()
+        page_cache.reset_stats()
+        self.test_book = Book.objects.create(
+            isbn = "195153448",
+            title = "Classical Mythology",
+            authors = "Mark P. O. Morford",
+            thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg",
+            quantity = 10,
+            price = 12)
+
+    def test_anonymous_pages_are_cached(self):
+        for url in ['/', '/aboutus/', '/books/', '/booksunder/', '/newestbooks/', '/randombooks/', '/product/195153448']:
+            first = self.client.get(url)
+            second = self.client.get(url)
+            self.assertEqual(first['X-Page-Cache'], 'miss', url)
+            self.assertEqual(second['X-Page-Cache'], 'hit', url)
+            self.assertEqual(second.status_code, 200)
+        self.assertEqual(page_cache.stats()['hits'], 7)
+        self.assertEqual(page_cache.stats()['misses'], 7)
+
+    def test_hits_are_counted_without_writing_to_the_cache(self):
+        self.client.get('/books/')
+        cache, writes = caches['pages'], []
+        for name in ('add', 'incr', 'set', 'set_many'):
+            original = getattr(cache, name)
+            self.addCleanup(setattr, cache, name, original)
+            setattr(cache, name, lambda *args, name = name, original = original, **kwargs: writes.append(name) or original(*args, **kwargs))
+        for i in range(5):
+            self.assertEqual(self.client.get('/books/')['X-Page-Cache'], 'hit')
+        self.assertEqual(writes, [])
+        self.assertEqual(page_cache.stats()['hits'], 5) # stats() adds in this process's counts
+
+    def test_hit_needs_no_queries(self):
+        self.client.get('/books/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/books/')
+        self.assertContains(response, "Classical Mythology")
+
+    def test_query_string_is_part_of_the_key(self):
+        self.client.get('/books/?sort=price_hl')
+        self.assertEqual(self.client.get('/books/?sort=titles_az')['X-Page-Cache'], 'miss')
+
+    def test_logged_in_users_are_not_cached(self):
+        User.objects.create_user(username = 'testuser', password = 'testpass')
+        self.client.post('/login/', {'username': 'testuser', 'password': 'testpass'})
+        self.client.get('/aboutus/')
+        self.assertFalse(self.client.get('/aboutus/').has_header('X-Page-Cache'))
+
+    def test_book_changes_retire_pages(self):
+        self.client.get('/product/195153448')
+        self.test_book.price = 99
+        self.test_book.save()
+        response = self.client.get('/product/195153448')
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, "99")
+
+    def test_reviews_retire_pages(self):
+        self.client.get('/product/195153448')
+        user = User.objects.create_user(username = 'reviewer', password = 'testpass')
+        ReviewRating.objects.create(book = self.test_book, user = user, subject = "Great read", review = "Loved it", rate = 5)
+        response = self.client.get('/product/195153448')
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, "Great read")
+
+    def test_cached_pages_get_a_fresh_csrf_token(self):
+        self.client.get('/aboutus/')
+        visitor = self.client_class(enforce_csrf_checks=True)
+        response = visitor.get('/aboutus/')
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        self.assertNotContains(response, "__csrf_token__")
+        token = re.search(r'name="csrfmiddlewaretoken" value="([^"]+)"', response.content.decode()).group(1)
+        # the token from the cached page is accepted with this visitor's cookie
+        response = visitor.post('/bookstore/search', {'searched': 'myth', 'csrfmiddlewaretoken': token})
+        self.assertEqual(response.status_code, 200)
+
+    def test_stats_view_is_staff_only(self):
+        self.assertEqual(self.client.get('/bookstore/page-cache-stats').status_code, 302)
+        User.objects.create_user(username = 'staff', password = 'staffpass', is_staff = True)
+        self.client.post('/login/', {'username': 'staff', 'password': 'staffpass'})
+        response = self.client.post('/bookstore/page-cache-stats')
+        self.assertEqual(response.json()['hits'], 0)
+
+class BookCardCacheTestCase(TestCase):
+    """ Test case for the cached book cards in the product grids """
+
+    def setUp(self):
+        caches['template_fragments'].clear()
+        self.test_book = Book.objects.create(
+            isbn = "195153448",
+            title = "Classical Mythology",
+            authors = "Mark P. O. Morford",
+            thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg",
+            quantity = 10,
+            price = 8)
+        User.objects.create_user(username = 'testuser', password = 'testpass')
+        self.client.post('/login/', {'username': 'testuser', 'password': 'testpass'})
+
+    def card_key(self, book):
+        return make_template_fragment_key('book_card', [book.isbn, book.version])
+
+    def test_cards_are_shared_between_pages(self):
+        self.client.get('/books/')
+        key = self.card_key(self.test_book)
+        self.assertIsNotNone(caches['template_fragments'].get(key))
+
+        caches['template_fragments'].set(key, '<p>cached card</p>')
+        for url in ['/books/?sort=price_hl', '/booksunder/', '/newestbooks/']:
+            response = self.client.get(url)
+            self.assertContains(response, '<p>cached card</p>')
+            # the buttons are rendered for this visitor outside the cached card
+            self.assertContains(response, 'class="btn btn-success')
+
+    def test_saving_a_book_retires_its_card(self):
+        self.client.get('/books/')
+        old_version = self.test_book.version
+        self.test_book.title = "Greek Mythology"
+        self.test_book.save(update_fields = ['title'])
+        self.assertEqual(self.test_book.version, old_version + 1)
+        self.assertEqual(Book.objects.get(isbn = "195153448").version, old_version + 1)
+        self.assertContains(self.client.get('/books/'), "Greek Mythology")
+
+    def test_book_added_again_gets_a_new_card(self):
+        self.client.get('/books/')
+        self.test_book.delete()
+        Book.objects.create(isbn = "195153448", title = "Mythology Again", authors = "Someone",
+                            thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg",
+                            quantity = 1, price = 5)
+        self.assertContains(self.client.get('/books/'), "Mythology Again")
+
+class ThumbnailsTestCase(TestCase):
+    """ Test case for the resized cover images """
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        settings_override = override_settings(MEDIA_ROOT = media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def cover(self, name = "cover.png", size = (400, 600)):
+        from PIL import Image
+        buffer = BytesIO()
+        Image.new('RGB', size, (200, 30, 30)).save(buffer, 'PNG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type = 'image/png')
+
+    def make_book(self, isbn = "195153448", **fields):
+        return Book.objects.create(isbn = isbn, title = "Classical Mythology", authors = "Mark P. O. Morford",
+                                   quantity = 10, price = 8, **fields)
+
+    def test_upload_makes_every_size(self):
+        book = self.make_book(thumbnail_pic = self.cover())
+        sizes = Book.objects.get(isbn = "195153448").thumbnails['sizes']
+        self.assertEqual({size: (d['width'], d['height']) for size, d in sizes.items()},
+                         {'cart': (80, 120), 'grid': (113, 170), 'detail': (227, 340)})
+        for derivative in sizes.values():
+            self.assertTrue(default_storage.exists(derivative['jpg']))
+            self.assertEqual(derivative['webp'] is not None, thumbnails.webp_supported())
+        self.assertEqual(book.thumbnails['source'], book.thumbnail_pic.name)
+
+    def test_small_covers_are_not_scaled_up(self):
+        self.make_book(thumbnail_pic = self.cover(size = (100, 160)))
+        sizes = Book.objects.get(isbn = "195153448").thumbnails['sizes']
+        self.assertEqual(sizes['detail']['width'], 100)
+        # the grid and detail copies are the same size, so the srcset lists it once
+        self.assertEqual(thumbnails.srcset(Book.objects.get(isbn = "195153448").thumbnails, 'jpg').count("100w"), 1)
+
+    def test_image_tag_srcset(self):
+        book = self.make_book(thumbnail_pic = self.cover())
+        html = Template('{% load book_images %}{% book_image book "grid" css_class="thumbnail" alt="Cover" %}').render(Context({'book': book}))
+        self.assertIn('sizes="120px"', html)
+        self.assertIn('derivatives/cover-grid.jpg"', html)
+        self.assertIn('-cart.jpg 80w', html)
+        self.assertIn('-detail.jpg 227w', html)
+        self.assertEqual('<source type="image/webp"' in html, thumbnails.webp_supported())
+
+    def test_remote_and_missing_covers_fall_back_to_the_original(self):
+        book = self.make_book(thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg")
+        missing = self.make_book(isbn = "2", thumbnail_pic = "static/images/books/missing.jpg")
+        self.assertEqual(book.thumbnails, {})
+        self.assertEqual(missing.thumbnails, {})
+        html = Template('{% load book_images %}{% book_image book "cart" %}').render(Context({'book': missing}))
+        self.assertEqual(html, '<img class="" src="/static/images/books/missing.jpg" alt="">')
+
+    def test_rebuild_command(self):
+        self.make_book(thumbnail_pic = self.cover())
+        self.make_book(isbn = "2", thumbnail_pic = self.cover("second.png"))
+        Book.objects.update(thumbnails = {})
+        version = Book.objects.get(isbn = "2").version
+
+        out = StringIO()
+        call_command('rebuild_thumbnails', '--workers', '1', '--batch-size', '1', stdout = out, stderr = StringIO())
+        self.assertIn("Resized covers for 2 books", out.getvalue())
+        book = Book.objects.get(isbn = "2")
+        self.assertEqual(set(book.thumbnails['sizes']), {'cart', 'grid', 'detail'})
+        self.assertEqual(book.version, version + 1)
+
+        # up to date books are skipped unless forced
+        out = StringIO()
+        call_command('rebuild_thumbnails', '--workers', '1', stdout = out, stderr = StringIO())
+        self.assertIn("Resized covers for 0 books", out.getvalue())
+        call_command('rebuild_thumbnails', '--workers', '1', '--force', stdout = out, stderr = StringIO())
+        self.assertIn("Resized covers for 2 books", out.getvalue())
+
+class CoverServer(http.server.BaseHTTPRequestHandler):
+    """ Stand-in for the remote image host, serves canned responses per path """
+    responses = {}
+    hits = {}
+
+    def do_GET(self):
+        CoverServer.hits[self.path] = CoverServer.hits.get(self.path, 0) + 1
+        queued = CoverServer.responses.get(self.path, [(404, b"")])
+        status, body = queued.pop(0) if len(queued) > 1 else queued[0]
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class MirrorThumbnailsTestCase(TestCase):
+    """ Test case for the mirror_thumbnails management command, against a local HTTP server """
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        settings_override = override_settings(MEDIA_ROOT = media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), CoverServer)
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.base_url = "http://127.0.0.1:%d" % server.server_address[1]
+        CoverServer.hits = {}
+        CoverServer.responses = {
+            '/cover.jpg': [(200, self.image_bytes((60, 90)))],
+            '/same-cover.jpg': [(200, self.image_bytes((60, 90)))],
+            '/flaky.jpg': [(503, b""), (500, b""), (200, self.image_bytes((50, 80), 'PNG'))],
+            '/pixel.gif': [(200, self.image_bytes((1, 1), 'GIF'))],
+            '/broken.jpg': [(200, b"<html>not an image</html>")],
+        }
+
+    def image_bytes(self, size, image_format = 'JPEG'):
+        from PIL import Image
+        buffer = BytesIO()
+        Image.new('RGB', size, (10, 120, 200)).save(buffer, image_format)
+        return buffer.getvalue()
+
+    def add_book(self, isbn, path):
+        return Book.objects.create(isbn = isbn, title = "Book " + isbn, authors = "Author", quantity = 1, price = 1,
+                                   image_url = self.base_url + path)
+
+    def mirror(self, *args):
+        out, err = StringIO(), StringIO()
+        call_command('mirror_thumbnails', '--backoff', '0.01', '--batch-size', '2', *args, stdout = out, stderr = err)
+        return out.getvalue(), err.getvalue()
+
+    def test_mirror_covers(self):
+        for isbn, path in [("1", "/cover.jpg"), ("2", "/same-cover.jpg"), ("3", "/flaky.jpg"),
+                           ("4", "/missing.jpg"), ("5", "/pixel.gif"), ("6", "/broken.jpg")]:
+            self.add_book(isbn, path)
+        out, err = self.mirror()
+        self.assertIn("Mirrored 3 of 6 books", out)
+        self.assertIn("2 new images, 1 already stored, 3 failed", out)
+        self.assertIn("HTTP 404", err)
+        self.assertIn("placeholder image", err)
+        self.assertIn("not an image", err)
+
+        books = {book.isbn: book for book in Book.objects.all()}
+        # identical covers are stored once under their content hash
+        self.assertEqual(books["1"].thumbnail_pic.name, books["2"].thumbnail_pic.name)
+        self.assertRegex(books["1"].thumbnail_pic.name, r"^static/images/books/mirror/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$")
+        self.assertTrue(books["3"].thumbnail_pic.name.endswith(".png"))
+        self.assertTrue(default_storage.exists(books["3"].thumbnail_pic.name))
+        self.assertEqual(set(books["1"].thumbnails['sizes']), {'cart', 'grid', 'detail'})
+        # the server errors were retried, the 404 wasn't
+        self.assertEqual(CoverServer.hits['/flaky.jpg'], 3)
+        self.assertEqual(CoverServer.hits['/missing.jpg'], 1)
+        self.assertFalse(books["4"].thumbnail_pic)
+
+    def test_rerun_only_fetches_what_is_left(self):
+        self.add_book("1", "/cover.jpg")
+        self.add_book("2", "/missing.jpg")
+        self.mirror()
+        CoverServer.responses['/missing.jpg'] = [(200, self.image_bytes((70, 100)))]
+        out, err = self.mirror('--skip-thumbnails')
+        self.assertIn("Mirrored 1 of 1 books", out)
+        self.assertEqual(CoverServer.hits['/cover.jpg'], 1)
+        self.assertTrue(Book.objects.get(isbn = "2").thumbnail_pic)
+        self.assertEqual(Book.objects.get(isbn = "2").thumbnails, {})
+
+    def test_retries_give_up(self):
+        CoverServer.responses['/down.jpg'] = [(503, b"")]
+        self.add_book("1", "/down.jpg")
+        out, err = self.mirror('--retries', '1')
+        self.assertIn("HTTP 503", err)
+        self.assertEqual(CoverServer.hits['/down.jpg'], 2)
+
+    def test_same_content_is_saved_once(self):
+        content = self.image_bytes((60, 90))
+
+        class LocalMirror(mirror.Mirror):
+            async def download(self, url):
+                return content
+
+        async def mirror_twice(covers):
+            return await asyncio.gather(covers.mirror_one("1", "a"), covers.mirror_one("2", "b"), return_exceptions = True)
+
+        # the media root is a file, so the save fails: both jobs fail and the next one tries again
+        blocker = os.path.join(settings.MEDIA_ROOT, "blocker")
+        open(blocker, 'w').close()
+        covers = LocalMirror(lambda results: None)
+        with override_settings(MEDIA_ROOT = blocker):
+            results = asyncio.run(mirror_twice(covers))
+        self.assertTrue(all(isinstance(result, mirror.MirrorError) for result in results))
+        self.assertEqual((covers.stored, covers.deduplicated), (0, 0))
+
+        first, second = asyncio.run(mirror_twice(covers))
+        self.assertEqual(first, second)
+        self.assertTrue(default_storage.exists(first))
+        self.assertEqual((covers.stored, covers.deduplicated), (1, 1))
+
+class StaticAssetsTestCase(TestCase):
+    """ Test case for the hashed, precompressed static files and the middleware serving them """
+
+    def setUp(self):
+        source = tempfile.mkdtemp()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        self.addCleanup(shutil.rmtree, root)
+        os.makedirs(os.path.join(source, 'css'))
+        os.makedirs(os.path.join(source, 'images'))
+        with open(os.path.join(source, 'css', 'site.css'), 'w') as css:
+            css.write(".cover { background: url('../images/dot.png'); }\n" + ".row { margin: 0 auto; padding: 10px; }\n" * 20)
+        with open(os.path.join(source, 'images', 'dot.png'), 'wb') as image:
+            image.write(b"not really a png")
+        settings_override = override_settings(STATICFILES_DIRS = [source], STATIC_ROOT = root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.root = root
+
+    def collect(self):
+        call_command('collectstatic', interactive = False, verbosity = 0)
+        return Template('{% load static %}{% static "css/site.css" %}').render(Context())
+
+    def test_collectstatic_hashes_and_compresses(self):
+        url = self.collect()
+        self.assertRegex(url, r"^/static/css/site\.[0-9a-f]{12}\.css$")
+        hashed = os.path.join(self.root, url[len('/static/'):])
+        self.assertTrue(os.path.exists(hashed + '.gz'))
+        # references inside the css point at hashed names too
+        with open(hashed) as css:
+            self.assertRegex(css.read(), r"images/dot\.[0-9a-f]{12}\.png")
+
+    def test_hashed_files_are_immutable_and_compressed(self):
+        url = self.collect()
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING = 'gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        with open(os.path.join(self.root, url[len('/static/'):]), 'rb') as css:
+            self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), css.read())
+
+        plain = self.client.get(url)
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertEqual(int(plain['Content-Length']), os.path.getsize(os.path.join(self.root, url[len('/static/'):])))
+
+    def test_unhashed_and_uncollected_files(self):
+        self.collect()
+        response = self.client.get('/static/css/site.css')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=3600')
+        response = self.client.get('/static/css/site.css', HTTP_IF_MODIFIED_SINCE = response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get('/static/missing.css').status_code, 404)
+        self.assertEqual(self.client.get('/static/../manage.py').status_code, 404)
+
+    def test_pages_render_before_collectstatic(self):
+        html = Template('{% load static %}{% static "css/site.css" %}').render(Context())
+        self.assertEqual(html, '/static/css/site.css')
+        response = self.client.get('/static/css/site.css')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=3600')
+
+
+class AsyncViewsTestCase(TestCase):
+    """ Test case for the async catalog views routed under ASGI """
+
+    def setUp(self):
+        caches['pages'].clear()
+        self.test_book = Book.objects.create(
+            isbn = "195153448",
+            title = "Classical Mythology",
+            authors = "Mark P. O. Morford",
+            thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg",
+            quantity = 10,
+            price = 12)
+        self.test_user = User.objects.create_user(username = 'testuser', password = 'testpass')
+
+    def request(self, path, user = None):
+        request = AsyncRequestFactory().get(path)
+        request.user = user or AnonymousUser()
+        if user is not None:
+            request.COOKIES[settings.SESSION_COOKIE_NAME] = 'session'
+        return request
+
+    async def test_async_views_render_the_catalog(self):
+        pages = [
+            (views.books_view_async, '/books/?sort=price_lh', ()),
+            (views.newestbooks_view_async, '/newestbooks/', ()),
+            (views.product_view_async, '/product/195153448', ("195153448",)),
+            (views.search_results_async, '/bookstore/search?searched=mythology', ()),
+        ]
+        for view, path, args in pages:
+            response = await view(self.request(path), *args)
+            self.assertContains(response, "Classical Mythology", msg_prefix = path)
+
+    async def test_anonymous_pages_are_cached(self):
+        first = await views.product_view_async(self.request('/product/195153448'), "195153448")
+        second = await views.product_view_async(self.request('/product/195153448'), "195153448")
+        self.assertEqual(first['X-Page-Cache'], 'miss')
+        self.assertEqual(second['X-Page-Cache'], 'hit')
+        self.assertContains(second, "Classical Mythology")
+
+    async def test_logged_in_users_are_not_cached(self):
+        await views.books_view_async(self.request('/books/'))
+        response = await views.books_view_async(self.request('/books/', self.test_user))
+        self.assertFalse(response.has_header('X-Page-Cache'))
+
+    def test_wsgi_routes_to_sync_views(self):
+        self.assertFalse(settings.ASYNC_VIEWS)
+        self.assertIs(resolve('/books/').func, views.books_view)
+
+    def test_bench_entrypoints(self):
+        for entry_point in ('wsgi', 'asgi'):
+            out = StringIO()
+            call_command('bench_entrypoints', '--entry-point', entry_point, '--path', '/aboutus/',
+                         '--requests', '6', '--concurrency', '3', '--json', stdout = out)
+            result = json.loads(out.getvalue())[entry_point]
+            self.assertEqual(result['requests'], 6)
+            self.assertEqual(result['errors'], 0)
+
+
+@override_settings(REPLICA_ALIAS = 'replica')
+class ReplicaRouterTestCase(SimpleTestCase):
+    """ Test case for routing catalog reads to the read replica """
+
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+        routers.start_request(pinned = False)
+        self.addCleanup(routers.start_request, pinned = False)
+
+    def test_catalog_reads_go_to_the_replica(self):
+        self.assertEqual(self.router.db_for_read(Book), 'replica')
+        self.assertEqual(self.router.db_for_read(ReviewRating), 'replica')
+        self.assertIsNone(self.router.db_for_read(Order))
+        self.assertIsNone(self.router.db_for_read(CartLine))
+
+    def test_writes_go_to_default(self):
+        for model in (Book, ReviewRating, Order, OrderItem, RentItem, CartLine):
+            self.assertEqual(self.router.db_for_write(model), 'default')
+
+    def test_catalog_write_pins_the_request(self):
+        self.router.db_for_write(Order)
+        self.assertEqual(self.router.db_for_read(Book), 'replica')
+        self.router.db_for_write(ReviewRating)
+        self.assertTrue(routers.wrote_catalog())
+        self.assertIsNone(self.router.db_for_read(Book))
+
+    def test_sticky_visitor_reads_default(self):
+        routers.start_request(pinned = True)
+        self.assertIsNone(self.router.db_for_read(Book))
+        self.assertFalse(routers.wrote_catalog())
+
+    def test_replica_is_never_migrated(self):
+        self.assertFalse(self.router.allow_migrate('replica', 'bookstore'))
+        self.assertIsNone(self.router.allow_migrate('default', 'bookstore'))
+
+    @override_settings(REPLICA_ALIAS = None)
+    def test_no_replica_configured(self):
+        self.assertIsNone(self.router.db_for_read(Book))
+
+
+# the replica alias points at default here, so the requests run but the cookie can be checked
+@override_settings(REPLICA_ALIAS = 'default')
+class ReplicaStickinessTestCase(TestCase):
+    """ Test case for the read-your-writes cookie """
+
+    def setUp(self):
+        self.test_book = Book.objects.create(
+            isbn = "195153448",
+            title = "Classical Mythology",
+            authors = "Mark P. O. Morford",
+            thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg",
+            quantity = 10,
+            price = 12)
+        User.objects.create_user(username = 'testuser', password = 'testpass')
+        self.client.login(username = 'testuser', password = 'testpass')
+
+    def test_review_pins_the_visitor(self):
+        response = self.client.post('/submit_review/195153448', {'subject': 'Great', 'rate': 4, 'review': 'Loved it'},
+                                    HTTP_REFERER = '/product/195153448')
+        self.assertEqual(response.cookies['read_primary']['max-age'], 10)
+
+    def test_reads_do_not_pin(self):
+        response = self.client.get('/product/195153448')
+        self.assertNotIn('read_primary', response.cookies)
+
+
+class SyncReplicaTestCase(TransactionTestCase):
+    """ Test case for the file-copy replica, committed rows are needed for SQLite's backup """
+
+    def test_sync_replica_copies_the_database(self):
+        Book.objects.create(isbn = "195153448", title = "Classical Mythology", authors = "Mark P. O. Morford", quantity = 10, price = 12)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        replica = os.path.join(directory, 'replica.sqlite3')
+        call_command('sync_replica', '--to', replica, stdout = StringIO())
+        copy = sqlite3.connect(replica)
+        self.addCleanup(copy.close)
+        self.assertEqual(copy.execute("SELECT title FROM bookstore_book").fetchall(), [("Classical Mythology",)])
+
+    def test_sync_replica_retires_cached_pages(self):
+        Book.objects.create(isbn = "195153448", title = "Classical Mythology", authors = "Mark P. O. Morford", quantity = 10, price = 12)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        # file caches like the site's, which the command's process and the web processes share
+        file_caches = {name: {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                              'LOCATION': os.path.join(directory, name)}
+                       for name in ('default', 'template_fragments', 'pages')}
+        with override_settings(CACHES = file_caches):
+            self.client.get('/books/')
+            self.assertEqual(self.client.get('/books/')['X-Page-Cache'], 'hit')
+            call_command('sync_replica', '--to', os.path.join(directory, 'replica.sqlite3'), stdout = StringIO())
+            self.assertEqual(self.client.get('/books/')['X-Page-Cache'], 'miss')
+
+    def test_sync_replica_keeps_cached_pages_when_nothing_changed(self):
+        Book.objects.create(isbn = "195153448", title = "Classical Mythology", authors = "Mark P. O. Morford", quantity = 10, price = 12)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        file_caches = {name: {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                              'LOCATION': os.path.join(directory, name)}
+                       for name in ('default', 'template_fragments', 'pages')}
+        pages = []
+        def between_passes(seconds):
+            pages.append([self.client.get('/books/')['X-Page-Cache'] for i in range(2)])
+            if len(pages) == 2:
+                raise KeyboardInterrupt
+        self.addCleanup(setattr, time, 'sleep', time.sleep)
+        time.sleep = between_passes
+        out = StringIO()
+        with override_settings(CACHES = file_caches), self.assertRaises(KeyboardInterrupt):
+            call_command('sync_replica', '--to', os.path.join(directory, 'replica.sqlite3'), '--interval', '1', stdout = out)
+        # the second pass copied the same rows, so the page cached after the first is still served
+        self.assertEqual(pages, [['miss', 'hit'], ['hit', 'hit']])
+        self.assertIn("unchanged since the last copy", out.getvalue())
+
+    def test_sync_replica_needs_a_target(self):
+        with self.assertRaises(CommandError):
+            call_command('sync_replica')
+
+
+class QueryInstrumentationTestCase(TestCase):
+    """ Test case for the per-request query counts, timings and budgets """
+
+    def setUp(self):
+        caches['pages'].clear()
+        self.test_book = Book.objects.create(
+            isbn = "195153448",
+            title = "Classical Mythology",
+            authors = "Mark P. O. Morford",
+            thumbnail_pic = "http://images.amazon.com/images/P/0195153448.01.MZZZZZZZ.jpg",
+            quantity = 10,
+            price = 12)
+        self.test_user = User.objects.create_user(username = 'testuser', password = 'testpass')
+
+    def query_count(self, response):
+        return int(re.search(r'db;dur=[\d.]+;desc="(\d+) queries"', response['Server-Timing']).group(1))
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            instrumentation.fingerprint('SELECT * FROM "t" WHERE "a" IN (%s, %s,  %s) AND b = \'x\' LIMIT 21'),
+            'SELECT * FROM "t" WHERE "a" IN (...) AND b = ? LIMIT ?')
+
+    def test_duplicates(self):
+        stats = instrumentation.start()
+        for isbn in ["1", "2", "1"]:
+            Book.objects.filter(isbn = isbn).first()
+        instrumentation.stop()
+        self.assertEqual(stats.count, 3)
+        self.assertEqual(list(stats.duplicates().values()), [3])
+        self.assertEqual(stats.exact_duplicates(), 1)
+        Book.objects.first() # not recorded once stopped
+        self.assertEqual(stats.count, 3)
+
+    def test_server_timing_and_log_line(self):
+        with self.assertLogs('bookstore.queries', 'INFO') as logs:
+            response = self.client.get('/books/')
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", view;dur=[\d.]+, total;dur=[\d.]+$')
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['view'], 'books')
+        self.assertEqual(line['status'], 200)
+        self.assertEqual(line['queries'], self.query_count(response))
+        # served from the page cache the second time
+        self.assertEqual(self.query_count(self.client.get('/books/')), 0)
+
+    def test_product_reviews_are_not_n_plus_one(self):
+        counts = []
+        for number in (1, 5):
+            for i in range(number):
+                user = User.objects.create_user(username = 'reviewer%d-%d' % (number, i))
+                ReviewRating.objects.create(book = self.test_book, user = user, subject = "Review", review = "Good", rate = 4)
+            counts.append(self.query_count(self.client.get('/product/195153448')))
+        self.assertEqual(counts[0], counts[1])
+
+    @override_settings(QUERY_BUDGETS = {'aboutus': 0})
+    def test_over_budget_fails_in_tests(self):
+        self.client.login(username = 'testuser', password = 'testpass')
+        with self.assertRaises(instrumentation.QueryBudgetExceeded):
+            self.client.get('/aboutus/')
+
+    @override_settings(QUERY_BUDGETS = {'aboutus': 0}, QUERY_BUDGETS_STRICT = False)
+    def test_over_budget_warns(self):
+        self.client.login(username = 'testuser', password = 'testpass')
+        with self.assertLogs('bookstore.queries', 'WARNING') as logs:
+            response = self.client.get('/aboutus/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("aboutus ran", logs.output[-1])
+
+
+class BenchmarksTestCase(TestCase):
+    """ Test case for the view benchmark seeding, scenarios and baseline comparison """
+
+    def test_seed_catalog(self):
+        user = benchmarks.seed_catalog(30, reviews_per_book = 2, cart_lines = 4, batch_size = 7)
+        self.assertEqual(Book.objects.count(), 30)
+        for book in Book.objects.all():
+            self.assertEqual(book.rating_count, book.reviewrating_set.count())
+        self.assertEqual(cart_summary(user)['cart_items'], 4)
+        self.assertGreater(search.search_books(benchmarks.WORDS[0]).paginator.count, 0)
+
+    def test_every_scenario_runs(self):
+        user = benchmarks.seed_catalog(20, cart_lines = 3)
+        user_client = self.client_class()
+        user_client.force_login(user)
+        results = benchmarks.run_scenarios(self.client, user_client, 2)
+        self.assertEqual(set(results), set(benchmarks.SCENARIOS))
+        for name, result in results.items():
+            self.assertEqual(result['errors'], 0, name)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+        self.assertEqual(cart_summary(user)['cart_items'], 3) # update_item leaves the cart as it was
+
+    def test_compare(self):
+        baseline = {'books': {'p50_ms': 10.0, 'p95_ms': 20.0, 'queries': 3}, 'home': {'p50_ms': 0.5, 'p95_ms': 0.6, 'queries': 0}}
+        same = {'books': {'p50_ms': 11.0, 'p95_ms': 22.0, 'queries': 3}, 'home': {'p50_ms': 0.9, 'p95_ms': 1.2, 'queries': 0}}
+        self.assertEqual(benchmarks.compare(same, baseline), [])
+        worse = {'books': {'p50_ms': 10.0, 'p95_ms': 40.0, 'queries': 4}, 'new': {'p50_ms': 1, 'p95_ms': 1, 'queries': 9}}
+        self.assertEqual(benchmarks.compare(worse, baseline), ["books: 4 queries, baseline 3", "books: p95_ms 40.00, baseline 20.00"])
+
+
+class GenerateLoadDataTestCase(TestCase):
+    """ Test case for the synthetic customer, order and review generator """
+
+    def setUp(self):
+        for i in range(12):
+            Book.objects.create(isbn = "19515344%d" % i, title = "Book%d" % i, authors = "Test book author", quantity = 10, price = 10)
+
+    def generate(self, **options):
+        options = dict({'customers': 60, 'reviews_per_book': 4, 'batch_size': 25, 'stdout': StringIO()}, **options)
+        call_command('generate_load_data', **options)
+
+    def snapshot(self):
+        return (
+            list(User.objects.filter(username__startswith = 'load').order_by('username').values_list('username', 'customer__email')),
+            list(CartLine.objects.order_by('order__customer__user__username', 'order_id', 'product_id', 'line_type')
+                 .values_list('order__customer__user__username', 'order__complete', 'product_id', 'line_type', 'quantity')),
+            sorted(ReviewRating.objects.values_list('user__username', 'book_id', 'rate')),
+        )
+
+    def test_generates_customers_orders_and_reviews(self):
+        self.generate(abandonment = 0.5)
+        self.assertEqual(Customer.objects.filter(user__username__startswith = 'load').count(), 60)
+        self.assertEqual(ReviewRating.objects.count(), 48)
+        self.assertFalse(ReviewRating.objects.exclude(user__username__startswith = 'load').exists())
+        self.assertTrue(CartLine.objects.filter(line_type = CartLine.RENT).exists())
+        # a customer never has more than one open cart, and it's their latest order
+        for customer in Customer.objects.all():
+            orders = list(customer.order_set.order_by('id').values_list('complete', flat = True))
+            self.assertNotIn(False, orders[:-1])
+        open_carts = Order.objects.filter(complete = False).count()
+        self.assertTrue(10 < open_carts < 50)
+        # stored rating totals were rebuilt
+        for book in Book.objects.all():
+            self.assertEqual(book.rating_count, book.reviewrating_set.count())
+
+    def test_popularity_is_skewed(self):
+        self.generate(zipf = 1.5)
+        lines = sorted(CartLine.objects.values('product').annotate(lines = Count('id')).values_list('lines', flat = True))
+        self.assertGreater(lines[-1], 4 * lines[len(lines) // 2])
+
+    def test_same_seed_same_rows(self):
+        self.generate(seed = 7)
+        first = self.snapshot()
+        CartLine.objects.all().delete()
+        Order.objects.all().delete()
+        User.objects.filter(username__startswith = 'load').delete()
+        self.generate(seed = 7)
+        self.assertEqual(self.snapshot(), first)
+
+    def test_refuses_to_generate_twice(self):
+        self.generate(customers = 1)
+        with self.assertRaises(CommandError):
+            self.generate(customers = 1)
+
+
+class BenchCheckoutTestCase(TransactionTestCase):
+    """ Test case for the concurrent cart and checkout harness, the worker threads need committed data """
+
+    def setUp(self):
+        self.isbns, self.shoppers = bench_checkout.setup_shop(books = 2, stock = 4, customers = 3)
+        self.stock = {isbn: 4 for isbn in self.isbns}
+
+    def run_shoppers(self, workers = 1):
+        jobs = [(number, user_id, customer_id, self.isbns, 2, 2) for number, (user_id, customer_id) in enumerate(self.shoppers)]
+        return bench_checkout.run_sessions(jobs, workers)[0]
+
+    def test_sessions_add_and_check_out(self):
+        tally = self.run_shoppers()
+        self.assertEqual(tally['adds'], 12)
+        self.assertEqual(len(tally['checkout_ms']), 6)
+        # 8 copies in stock, so some checkouts are turned away and nothing is oversold
+        self.assertGreater(tally['out_of_stock'], 0)
+        self.assertEqual(tally['locked'] + tally['errors'], 0)
+        self.assertEqual(bench_checkout.check_invariants(self.stock, tally['adds']), [])
+
+    def test_concurrent_carts_and_checkouts_on_a_file_database(self):
+        # the in-memory test database locks differently, so the harness runs in its own process on a SQLite file
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        command = [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'bench_checkout', '--json',
+                   '--database', os.path.join(directory, 'bench.sqlite3'), '--customers', '8',
+                   '--sessions-per-customer', '2', '--workers', '8']
+        finished = subprocess.run(command, env = dict(os.environ, CACHE_DIR = directory), capture_output = True, text = True)
+        self.assertEqual(finished.returncode, 0, finished.stderr)
+        results = json.loads(finished.stdout)
+        self.assertEqual(results['locked'] + results['errors'], 0)
+        self.assertEqual(results['adds'], 8 * 2 * 3 * 3) # every session's every add went through
+        self.assertEqual(results['invariant_violations'], [])
+
+    def test_invariants_catch_lost_stock_and_lost_adds(self):
+        tally = self.run_shoppers()
+        Book.objects.filter(isbn = self.isbns[0]).update(quantity = -1)
+        problems = bench_checkout.check_invariants(self.stock, tally['adds'] + 1)
+        self.assertEqual(len(problems), 3)
+        self.assertIn("oversold", problems[0])
+        self.assertIn("cart adds succeeded", problems[2])
+
+
+class FacetIndexTestCase(TestCase):
+    """ Test case for the publisher, decade and price band bitmaps behind the books page filters """
+
+    def setUp(self):
+        publishers = ["Penguin", "Vintage", "Scholastic"]
+        for i in range(30):
+            Book.objects.create(isbn = "%09d" % i, title = "Book%d" % i, authors = "Author", quantity = 1,
+                                publisher = publishers[i % 3], year_public = 1960 + i * 2, price = 5 + i)
+        facets.books_changed() # the index may still hold books from an earlier test
+
+    def matching(self, filters):
+        books, count = facets.filtered_books(filters)
+        isbns = sorted(books.values_list('isbn', flat = True))
+        self.assertEqual(len(isbns), count)
+        return isbns
+
+    def expected(self, condition):
+        return sorted(Book.objects.filter(condition).values_list('isbn', flat = True))
+
+    def test_books_under_page_leaves_the_index_alone(self):
+        caches['pages'].clear()
+        response = self.client.get('/booksunder/')
+        self.assertEqual([book.price for book in response.context['books']], [5, 6, 7, 8, 9])
+        self.assertIsNone(facets._index) # a plain price range, the index isn't built for it
+
+    def test_filters_intersect_facets_and_union_values(self):
+        self.assertEqual(self.matching({'publisher': ['Penguin']}), self.expected(Q(publisher = "Penguin")))
+        self.assertEqual(self.matching({'publisher': ['Penguin', 'Vintage'], 'price': ['10-19']}),
+                         self.expected(Q(publisher__in = ["Penguin", "Vintage"], price__range = (10, 19))))
+        self.assertEqual(self.matching({'decade': [1970, 2000], 'price': ['0-9', '30-49']}),
+                         self.expected((Q(year_public__range = (1970, 1979)) | Q(year_public__range = (2000, 2009)))
+                                       & (Q(price__lte = 9) | Q(price__range = (30, 49)))))
+        self.assertEqual(self.matching({'publisher': ['Nobody']}), [])
+
+    def test_large_matches_use_the_facet_conditions(self):
+        limit = facets.IN_LOOKUP_LIMIT
+        facets.IN_LOOKUP_LIMIT = 1
+        try:
+            self.assertEqual(self.matching({'publisher': ['Scholastic'], 'decade': [1980]}),
+                             self.expected(Q(publisher = "Scholastic", year_public__range = (1980, 1989))))
+        finally:
+            facets.IN_LOOKUP_LIMIT = limit
+
+    def test_counts_leave_out_the_facets_own_filter(self):
+        sidebar = facets.facet_counts({'publisher': ['Penguin']})
+        publishers = {option['value']: option['count'] for option in sidebar['publisher']}
+        self.assertEqual(publishers, {"Penguin": 10, "Scholastic": 10, "Vintage": 10})
+        prices = {option['value']: option['count'] for option in sidebar['price']}
+        self.assertEqual(prices, {'0-9': 2, '10-19': 3, '20-29': 4, '30-49': 1, '50+': 0})
+        penguin = [option for option in sidebar['publisher'] if option['value'] == "Penguin"][0]
+        self.assertTrue(penguin['selected'])
+        self.assertEqual(penguin['query'], "") # choosing it again takes the filter off
+
+    def test_saves_and_deletes_update_the_index_in_place(self):
+        index = facets.facet_index()
+        book = Book.objects.get(isbn = "000000000")
+        book.price = 60
+        book.save()
+        Book.objects.get(isbn = "000000001").delete()
+        self.assertIs(facets.facet_index(), index)
+        self.assertEqual(self.matching({'price': ['50+']}), ["000000000"])
+        self.assertNotIn("000000001", self.matching({'publisher': ['Vintage']}))
+        self.assertEqual(self.matching({'publisher': ['Vintage']}), self.expected(Q(publisher = "Vintage")))
+
+    def test_change_elsewhere_rebuilds(self):
+        index = facets.facet_index()
+        cache.incr(facets.VERSION_KEY) # what another process saving a book looks like from here
+        self.assertIsNot(facets.facet_index(), index)
+
+    def test_books_page_filters(self):
+        response = self.client.get('/books/', {'publisher': 'Penguin', 'decade': '1980', 'sort': 'price_lh'})
+        isbns = [book.isbn for book in response.context['book_page']]
+        self.assertEqual(isbns, list(Book.objects.filter(publisher = "Penguin", year_public__range = (1980, 1989))
+                                     .order_by('price').values_list('isbn', flat = True)))
+        self.assertContains(response, "Products (%d)" % len(isbns))
+        self.assertContains(response, "Vintage (")
+        self.assertContains(response, 'action="/books/?publisher=Penguin&amp;decade=1980"')
+
+
+class ConditionalGetTestCase(TestCase):
+    """ Test case for the ETag and Last-Modified validators on product and listing pages """
+
+    def setUp(self):
+        caches['pages'].clear()
+        self.test_book = Book.objects.create(isbn = "195153448", title = "Classical Mythology", authors = "Mark P. O. Morford",
+                                             quantity = 10, price = 12)
+        self.other_book = Book.objects.create(isbn = "2", title = "Other", authors = "Someone", quantity = 1, price = 5)
+        self.test_user = User.objects.create_user(username = 'testuser', password = 'testpass')
+        # the books above were added a while ago, so the pages get a Last-Modified
+        caches['pages'].set(page_cache.CHANGED_KEY, time.time() - 60, None)
+        self.client.get('/books/') # picks up the CSRF cookie, which is part of every ETag
+
+    def test_unchanged_product_page_is_not_modified(self):
+        response = self.client.get('/product/195153448')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertIn('Last-Modified', response)
+        # answered from the stamp alone, nothing is rendered and no review is read
+        with self.assertNumQueries(0):
+            revalidated = self.client.get('/product/195153448', HTTP_IF_NONE_MATCH = response['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated.content, b"")
+        self.assertEqual(revalidated['ETag'], response['ETag'])
+        since = self.client.get('/product/195153448', HTTP_IF_MODIFIED_SINCE = response['Last-Modified'])
+        self.assertEqual(since.status_code, 304)
+
+    def test_reviews_and_saves_change_only_their_book(self):
+        etag = self.client.get('/product/195153448')['ETag']
+        self.other_book.price = 6
+        self.other_book.save()
+        self.assertEqual(self.client.get('/product/195153448', HTTP_IF_NONE_MATCH = etag).status_code, 304)
+
+        ReviewRating.objects.create(user = self.test_user, book = self.test_book, subject = "Good", review = "Liked it", rate = 4)
+        response = self.client.get('/product/195153448', HTTP_IF_NONE_MATCH = etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_listing_changes_with_the_catalog(self):
+        for path in ['/books/?sort=price_lh', '/newestbooks/', '/booksunder/', '/bookstore/search?searched=mythology']:
+            etag = self.client.get(path)['ETag']
+            self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH = etag).status_code, 304, path)
+        Book.objects.create(isbn = "3", title = "New", authors = "A", quantity = 1, price = 1)
+        self.assertEqual(self.client.get('/newestbooks/', HTTP_IF_NONE_MATCH = etag).status_code, 200)
+
+    def test_no_last_modified_in_the_second_of_a_change(self):
+        since = self.client.get('/product/195153448')['Last-Modified']
+        page_cache.catalog_changed()
+        response = self.client.get('/product/195153448')
+        # a second change within this second couldn't move it, so there's nothing to revalidate against
+        self.assertNotIn('Last-Modified', response)
+        self.assertEqual(self.client.get('/product/195153448', HTTP_IF_MODIFIED_SINCE = since).status_code, 200)
+
+    def test_new_csrf_cookie_gets_a_full_page(self):
+        etag = self.client.get('/product/195153448')['ETag']
+        self.client.cookies[settings.CSRF_COOKIE_NAME] = 'x' * 32
+        self.assertEqual(self.client.get('/product/195153448', HTTP_IF_NONE_MATCH = etag).status_code, 200)
+
+    def test_logged_in_pages_have_no_validators(self):
+        self.client.login(username = 'testuser', password = 'testpass')
+        response = self.client.get('/product/195153448')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+    async def test_async_product_view(self):
+        request = AsyncRequestFactory().get('/product/195153448')
+        request.user = AnonymousUser()
+        response = await views.product_view_async(request, "195153448")
+        request = AsyncRequestFactory().get('/product/195153448')
+        request.META['HTTP_IF_NONE_MATCH'] = response['ETag'] # this Django's factory puts extra arguments in the scope, not the headers
+        request.user = AnonymousUser()
+        self.assertEqual((await views.product_view_async(request, "195153448")).status_code, 304)
@@ -0,0 +1,102 @@
+""" Resized copies of book cover images.
+
+Every cover is saved in a few fixed sizes next to the original, as JPEG and, when
+this Pillow build can write it, WebP. Book.thumbnails records what was made, and
+the book_image template tag turns that into a srcset so browsers only download the
+smallest copy that fills the slot.
+"""
+import os
+from io import BytesIO
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import F
+from PIL import Image, ImageOps, features
+
+# derivative name -> bounding box in pixels, images are never scaled up
+SIZES = {
+    'cart': (80, 120),
+    'grid': (120, 170),
+    'detail': (240, 340), # the product page shows 120px wide, this covers 2x screens
+}
+DERIVATIVE_DIR = "static/images/books/derivatives"
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+
+
+def webp_supported():
+    return features.check('webp')
+
+
+def is_stored_file(name):
+    """ Some books point thumbnail_pic at a remote URL, those have no file to resize """
+    return bool(name) and '://' not in name
+
+
+def derivative_name(source, size, extension):
+    stem = os.path.splitext(os.path.basename(source))[0]
+    return "%s/%s-%s.%s" % (DERIVATIVE_DIR, stem, size, extension)
+
+
+def save_file(name, image, file_format, **options):
+    buffer = BytesIO()
+    image.save(buffer, file_format, **options)
+    # replace rather than let the storage pick a new name, regenerating keeps the same urls
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def make_thumbnails(source):
+    """ Write every derivative of the stored image `source`.
+
+    Returns the value for Book.thumbnails: {'source': name, 'sizes': {size: {'width',
+    'height', 'jpg', 'webp'}}}. Raises OSError if the image can't be read.
+    """
+    with default_storage.open(source) as image_file:
+        original = Image.open(image_file)
+        original.load()
+    original = ImageOps.exif_transpose(original).convert('RGB')
+    with_webp = webp_supported()
+
+    sizes = {}
+    for size, box in SIZES.items():
+        image = original.copy()
+        image.thumbnail(box, Image.LANCZOS)
+        sizes[size] = {
+            'width': image.width,
+            'height': image.height,
+            'jpg': save_file(derivative_name(source, size, 'jpg'), image, 'JPEG',
+                             quality = JPEG_QUALITY, optimize = True, progressive = True),
+            'webp': save_file(derivative_name(source, size, 'webp'), image, 'WEBP',
+                              quality = WEBP_QUALITY, method = 4) if with_webp else None,
+        }
+    return {'source': source, 'sizes': sizes}
+
+
+def needs_thumbnails(book):
+    name = book.thumbnail_pic.name if book.thumbnail_pic else ""
+    return is_stored_file(name) and (book.thumbnails or {}).get('source') != name
+
+
+def update_thumbnails(book):
+    """ Make the derivatives for a book whose cover changed, returns True if any were made """
+    if not needs_thumbnails(book):
+        return False
+    try:
+        thumbnails = make_thumbnails(book.thumbnail_pic.name)
+    except OSError: # missing or unreadable image, the original is still served
+        return False
+    # new image urls, so cached cards and pages showing this book have to change too
+    type(book).objects.filter(pk = book.pk).update(thumbnails = thumbnails, version = F('version') + 1)
+    book.thumbnails = thumbnails
+    book.refresh_from_db(fields = ['version'])
+    return True
+
+
+def srcset(thumbnails, extension):
+    """ "url 80w, url 120w, ..." for one format, smallest first, one entry per width """
+    entries = {}
+    for derivative in (thumbnails or {}).get('sizes', {}).values():
+        if derivative.get(extension):
+            entries.setdefault(derivative['width'], default_storage.url(derivative[extension]))
+    return ", ".join("%s %dw" % (url, width) for width, url in sorted(entries.items()))
@@ -1,6 +1,8 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
 urlpatterns = [
-    path('search', views.search_results, name="search")
-]
\ No newline at end of file
+    path('search', views.search_results_async if settings.ASYNC_VIEWS else views.search_results, name="search"),
+    path('page-cache-stats', views.page_cache_stats, name="page_cache_stats"),
+]
@@ -1,60 +1,81 @@
-import random
-from django.http import HttpResponse
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed
 from django.shortcuts import render, redirect
 from django.contrib.auth import login, logout, authenticate
 from django.views import generic
 from bookstore.models import *
 from .forms import *
+from .search import search_books
+from .catalog import book_count, newest_books, random_books
+from .pagination import InvalidCursor, keyset_page
+from .context_processors import cart_summary
+from .cart import update_cart
+from . import facets, page_cache
+from .page_cache import cache_anonymous_page
+from .conditional import book_stamp, catalog_stamp, conditional_page
+from .checkout import OutOfStock, new_idempotency_key, place_order
 from django.http import JsonResponse
 import json
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.db.models import Q
+from django.db import OperationalError, transaction
 from django.core.paginator import Paginator
 
 GENRE_PRODUCTS_HTML = "genre-products.html"
 SUCCESS_CHECKOUT_HTML = "checkout-success.html"
+BOOKS_PER_PAGE = 20
+RANDOM_PAGE_TIMEOUT = 30 # seconds, so anonymous visitors still get a fresh pick now and then
+
+# book-filterd dropdown values -> keyset ordering, each ending in the isbn tie-breaker
+BOOK_SORTS = {
+    'featured': ('isbn',),
+    'titles_az': ('title', 'isbn'),
+    'authors_az': ('authors', 'isbn'),
+    'price_lh': ('price', 'isbn'),
+    'price_hl': ('-price', 'isbn'),
+}
 
 
 # Create your views here.
+@cache_anonymous_page()
 def home_view(request, *args, **kwargs):
-    """ Function to return home page """
-    if request.user.is_authenticated:
-        customer = request.user.customer
-        buy, created = Order.objects.get_or_create(customer = customer, complete=False) # create object or quere one, if object isnt exist then we will create it
-        items = buy.orderitem_set.all()
-                
-    else: # for user that isnt log in
-        items = [] # empty for now
-        buy = {'get_cart_total':0, 'get_cart_items':0}
-    context = {'items':items, 'buy':buy}
-    return render(request, "home.html", context)
+    """ Function to return home page, the navbar cart count comes from the cart context processor """
+    return render(request, "home.html", {})
 
 
 def successcheckout_view(request, *args, **kwargs):
-    """ Function to display successful order message after checkout """
+    """ Function to place the order and display successful order message after checkout """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    # the checkout form sends a one-off key, so resubmitting it can't place the order twice
+    key = request.POST.get('idempotency_key')
+    if not key:
+        return HttpResponseBadRequest("idempotency_key required")
+    order = None
     if request.user.is_authenticated:
-        customer = request.user.customer
-        order, created = Order.objects.get_or_create(customer = customer, complete=False) # create object or quere one, if object isnt exist then we will create it
-        items_to_purchase = order.orderitem_set.all() # this is for purchase
-        items_to_rent = order.rentitem_set.all() # this is for rent
-
-        for item in items_to_purchase:
-            item.product.decrease_quantity(item.quantity)
-
-        for item in items_to_rent:
-            item.product1.decrease_quantity(item.quantity1)
+        try:
+            order = place_order(request.user, key)
+        except OutOfStock as error:
+            messages.error(request, str(error))
+            return redirect('cart')
+        except OperationalError: # "database is locked" after waiting out the busy timeout
+            messages.error(request, "The shop is busy right now and your order wasn't placed, please try again.")
+            return redirect('cart')
 
-    return render(request, SUCCESS_CHECKOUT_HTML, {})
+    return render(request, SUCCESS_CHECKOUT_HTML, {'order': order})
 
 
+@cache_anonymous_page(timeout=RANDOM_PAGE_TIMEOUT)
 def randombooks_view(request, *args, **kwargs):
     """ Function to return 20 random books """
-    items = list(Book.objects.all())
-    random_items = random.sample(items, 20)
+    random_items = random_books(20)
 
     return render(request, GENRE_PRODUCTS_HTML, {'books': random_items})
 
 
+@conditional_page(catalog_stamp)
+@cache_anonymous_page()
 def booksunder_view(request, *args, **kwargs):
     """ Function to return book under $10 """
     items_under = Book.objects.filter(price__range=(0, 9))
@@ -63,89 +84,65 @@ def booksunder_view(request, *args, **kwargs):
     return render(request, GENRE_PRODUCTS_HTML, {'books': items_under_sorted})
 
 
+@conditional_page(catalog_stamp)
+@cache_anonymous_page()
 def newestbooks_view(request, *args, **kwargs):
     """ Function to return 20 newest book """
-    items_num = len(Book.objects.all())
-    last_twenty = Book.objects.filter().order_by()[items_num-20:]
+    last_twenty = newest_books(20)
 
     return render(request, GENRE_PRODUCTS_HTML, {'books': last_twenty})
 
+def books_context(request):
+    """ One keyset page of the catalog in the requested order and facet filters, shared by the sync and async books views """
+    sort = request.POST.get('book-filterd') or request.GET.get('sort')
+    if sort not in BOOK_SORTS:
+        sort = 'featured'
+    filters = facets.parse_filters(request.GET) # publisher, decade and price band from the sidebar
+    if filters:
+        books, count = facets.filtered_books(filters) # the facet index gives the exact count
+    else:
+        books, count = Book.objects.all(), book_count()
+    try:
+        book_page = keyset_page(books, BOOK_SORTS[sort], BOOKS_PER_PAGE, request.GET.get('cursor'), count)
+    except InvalidCursor: # a mangled link just starts again from the first page
+        book_page = keyset_page(books, BOOK_SORTS[sort], BOOKS_PER_PAGE, None, count)
+    return {'book_count':count, 'book_page':book_page, 'sort':sort,
+            'facets':facets.facet_counts(filters), 'filter_query':facets.filter_query(filters)}
+
+@conditional_page(catalog_stamp)
+@cache_anonymous_page()
 def books_view(request, *args, **kwargs):
     """ Function to return all of our books and also book filter """
-    if request.user.is_authenticated:
-        customer = request.user.customer
-        buy, created = Order.objects.get_or_create(customer = customer, complete=False) # create object or quere one, if object isnt exist then we will create it
-        items = buy.orderitem_set.all() # this is for purchase
-    else: # for user that isnt log in
-        items = [] # empty for now
-        buy = {'get_cart_total':0, 'get_cart_items':0}
-    
-    results = request.POST.get('book-filterd')
-    books = Book.objects.all()
-    p = Paginator(Book.objects.all(), 20)
-    page = request.GET.get('page')
-    book_page = p.get_page(page)   
-        
-    if results == 'titles_az':
-        p = Paginator(Book.objects.all().order_by('title'), 20)
-        book_page = p.get_page(page) 
-        
-    elif results == 'authors_az':
-        p = Paginator(Book.objects.all().order_by('authors'), 20)
-        book_page = p.get_page(page) 
-        
-    elif results == 'price_lh':
-        p = Paginator(Book.objects.all().order_by('price'), 20)
-        book_page = p.get_page(page) 
-        
-    elif results == 'price_hl':
-        p = Paginator(Book.objects.all().order_by('-price'), 20)
-        book_page = p.get_page(page)       
-    context = {'items':items, 'buy':buy, 'books':books, 'book_page':book_page}
-
-    return render(request, "products.html", context)
+    return render(request, "products.html", books_context(request))
 
+@cache_anonymous_page()
 def aboutus_view(request, *args, **kwargs):
     """ Return about us page """
-    if request.user.is_authenticated:
-        customer = request.user.customer
-        buy, created = Order.objects.get_or_create(customer = customer, complete=False) # create object or quere one, if object isnt exist then we will create it
-        items = buy.orderitem_set.all() # this is for purchase
-    else: # for user that isnt log in
-        items = [] # empty for now
-        buy = {'get_cart_total':0, 'get_cart_items':0}
-    context = {'items':items, 'buy':buy}
-    return render(request, "aboutus.html", context)
+    return render(request, "aboutus.html", {})
 
 def checkout_view(request, *args, **kwargs):
     """ Return checkout page """
-    # check if user is authenticated
-    if request.user.is_authenticated:
-        customer = request.user.customer
-        order, created = Order.objects.get_or_create(customer = customer, complete=False) # create object or quere one, if object isnt exist then we will create it
-        items = order.orderitem_set.all() # this is for purchase
-    else: # for user that isnt log in
-        items = [] # empty for now
-        order = {'get_cart_total':0, 'get_cart_items':0}
-    context = {'items':items, 'order':order}
+    summary = cart_summary(request.user) # viewing the checkout page never creates a cart
+    order = summary['order']
+    if order is not None:
+        items, rents = order.cart_lines() # purchase and rent lines, one query
+    else: # no open cart, or user isnt log in
+        items = []
+        rents = []
+    context = {'items':items, 'rents':rents, 'cart_summary':summary, 'idempotency_key':new_idempotency_key()}
     
     return render(request, "checkout.html", context)
 
 def cart_view(request, *args, **kwargs):
     """ Return cart page with 3 sections BUY and Rent and Total """
-    # check if user is authenticated
-    if request.user.is_authenticated:
-        customer = request.user.customer
-        buy, created = Order.objects.get_or_create(customer = customer, complete=False) # create object or quere one, if object isnt exist then we will create it
-        rent, created = Order.objects.get_or_create(customer = customer, complete=False) # create object or quere one, if object isnt exist then we will create it
-        items = buy.orderitem_set.all() # this is for purchase
-        rents = rent.rentitem_set.all() # this is for rent
-    else: # for user that isnt log in
-        items = [] # empty for now
+    summary = cart_summary(request.user) # the cart row is only created by update_item
+    order = summary['order']
+    if order is not None:
+        items, rents = order.cart_lines() # purchase and rent lines, one query
+    else: # no open cart, or user isnt log in
+        items = []
         rents = []
-        buy = {'get_cart_total':0, 'get_cart_items':0}
-        rent = {'get_cart_total':0, 'get_cart_items':0}
-    context = {'items':items, 'rents':rents, 'buy':buy, 'rent':rent}
+    context = {'items':items, 'rents':rents, 'cart_summary':summary}
     return render(request, "cart.html", context)
     
 def loginPage(request):
@@ -193,64 +190,51 @@ def logoutPage(request):
     logout(request)
     return redirect('/')
 
-def product_view(request, isbn):
-    """ Return invididual page for a book with book details """
+def product_context(isbn):
     book = Book.objects.get(isbn = isbn)
-    reviews = ReviewRating.objects.filter(book_id = book.isbn)
-    context = {
+    reviews = ReviewRating.objects.filter(book_id = book.isbn).select_related('user') # the template shows each reviewer's name
+    return {
         'book':book,
         'reviews': reviews,
     }
-    return render(request, "product.html", context)
+
+@conditional_page(book_stamp)
+@cache_anonymous_page()
+def product_view(request, isbn):
+    """ Return invididual page for a book with book details """
+    return render(request, "product.html", product_context(isbn))
 
 def update_item(request):
-    """ Function to add book to Cart to Buy or Rent section depending on which button clicked """
-    data = json.loads(request.body)
-    book_isbn = data['bookIsbn']
-    action = data['action']
-    # print out action and isbn in command prompt just to test
-    print('Action:', action)
-    print('bookIsbn:', book_isbn)
-    
-    customer = request.user.customer
-    product1 = Book.objects.get(isbn=book_isbn)
-    order1, created = Order.objects.get_or_create(customer=customer, complete=False)    
-    
-    rent_item, created = RentItem.objects.get_or_create(order1 = order1, product1=product1)
-    order_item, created = OrderItem.objects.get_or_create(order = order1, product=product1)
-    
-    if action == 'purchase':
-        order_item.quantity = (order_item.quantity + 1)
-    if action == 'add':
-        order_item.quantity = (order_item.quantity + 1)    
-    elif action == 'remove':
-       order_item.quantity = (order_item.quantity - 1)    
-    order_item.save()
-    
-    if action =='rent':
-        rent_item.quantity1 = (rent_item.quantity1 + 1)
-    rent_item.save()
-    
-    
-    if action =='delete':
-        order_item.delete() 
-    if order_item.quantity <= 0:
-        order_item.delete()
-          
-    if action =='deleteRent':
-        rent_item.delete()    
-    if rent_item.quantity1 <= 0:
-        rent_item.delete()
-    return JsonResponse('Item was added', safe=False)
+    """ Apply one or more cart button presses and return the changed lines and cart totals as JSON.
+    Takes {"operations": [{"bookIsbn": ..., "action": ...}, ...]} or a single {"bookIsbn", "action"} """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    customer = Customer.objects.filter(user_id = request.user.pk).first() if request.user.is_authenticated else None
+    if customer is None:
+        return JsonResponse({'error': 'Log in to change your cart'}, status=403)
+    try:
+        data = json.loads(request.body)
+        operations = data['operations'] if isinstance(data, dict) and 'operations' in data else [data]
+        result = update_cart(customer, operations)
+    except (ValueError, TypeError) as error: # bad JSON and InvalidCartOperation
+        return JsonResponse({'error': str(error)}, status=400)
+    except OperationalError: # "database is locked" after waiting out the busy timeout, nothing was changed
+        response = JsonResponse({'error': 'The cart is busy, try again', 'retry': True}, status=503)
+        response['Retry-After'] = '1'
+        return response
+    return JsonResponse(result)
+
+def search_context(request):
+    results = request.POST.get('searched') or request.GET.get('searched')
+    if not results:
+        return {}
+    book_page = search_books(results, request.GET.get('page'))
+    return {'results': results, 'books': book_page, 'book_page': book_page}
 
+@conditional_page(catalog_stamp)
 def search_results(request):
-    """ Function to return search result for books """
-    if request.method == "POST":
-        results = request.POST['searched']
-        books = Book.objects.filter(Q(title__contains = results) | Q(isbn__contains = results) | Q(authors__contains = results) | Q(year_public__contains = results) | Q(publisher__contains = results))
-        return render(request, "search.html", {'results': results, 'books': books})
-    else:
-        return render(request, "search.html", {})
+    """ Function to return search result for books, ranked and paginated """
+    return render(request, "search.html", search_context(request))
     
 
 def submit_review(request, book_isbn):
@@ -260,12 +244,57 @@ def submit_review(request, book_isbn):
     if request.method == 'POST':        
         form = ReviewRatingForm(request.POST)
         if form.is_valid():
+            book = Book.objects.get(isbn = book_isbn)
             data = ReviewRating()
             data.subject = form.cleaned_data['subject']
             data.rate = form.cleaned_data['rate']
             data.review = form.cleaned_data['review']
-            data.book_id = book_isbn
+            data.book = book
             data.user_id = request.user.id
-            data.save()
+            # save the review and its rating totals together so the stored average never drifts
+            with transaction.atomic():
+                data.save()
+                book.add_rating(data.rate)
             messages.success(request, 'Thank you! Your review has been submitted')
             return redirect(url)
+
+@staff_member_required
+def page_cache_stats(request):
+    """ Page cache hit and miss counts as JSON for sizing the cache, POST resets the counters """
+    if request.method == 'POST':
+        page_cache.reset_stats()
+    return JsonResponse(page_cache.stats())
+
+
+# Async versions of the read-mostly catalog views. onestopbooks/urls.py routes to them
+# instead of the sync ones when settings.ASYNC_VIEWS is on, which the ASGI entry point
+# does. Django 4.0 has no async ORM yet, so each view does its queries in one
+# sync_to_async call (what QuerySet.aget() and friends do from 4.1) and renders in another.
+arender = sync_to_async(render)
+
+@conditional_page(book_stamp)
+@cache_anonymous_page()
+async def product_view_async(request, isbn):
+    """ product_view for the ASGI entry point """
+    context = await sync_to_async(product_context)(isbn)
+    return await arender(request, "product.html", context)
+
+@conditional_page(catalog_stamp)
+@cache_anonymous_page()
+async def books_view_async(request, *args, **kwargs):
+    """ books_view for the ASGI entry point """
+    context = await sync_to_async(books_context)(request)
+    return await arender(request, "products.html", context)
+
+@conditional_page(catalog_stamp)
+async def search_results_async(request):
+    """ search_results for the ASGI entry point """
+    context = await sync_to_async(search_context)(request)
+    return await arender(request, "search.html", context)
+
+@conditional_page(catalog_stamp)
+@cache_anonymous_page()
+async def newestbooks_view_async(request, *args, **kwargs):
+    """ newestbooks_view for the ASGI entry point """
+    last_twenty = await sync_to_async(newest_books)(20)
+    return await arender(request, GENRE_PRODUCTS_HTML, {'books': last_twenty})
@@ -0,0 +1,9 @@
+""" Helpers for the process pools the management commands spread CPU bound work over """
+import os
+import django
+
+
+def init_worker():
+    """ Make sure Django is set up in pool workers started with spawn instead of fork """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'onestopbooks.settings')
+    django.setup()
@@ -11,6 +11,8 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
 import os
+import sys
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -28,6 +30,9 @@ SECRET_KEY = TEST_SECRET_KEY
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
+# True while `manage.py test` runs
+TESTING = sys.argv[1:2] == ['test']
+
 ALLOWED_HOSTS = ["127.0.0.1", "production.eba-vjazaffm.us-west-2.elasticbeanstalk.com"]
 
 # Application definition
@@ -43,7 +48,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'bookstore.middleware.QueryInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'bookstore.middleware.StaticAssetsMiddleware',
+    'bookstore.middleware.ReplicaStickinessMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -54,6 +62,10 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'onestopbooks.urls'
 
+# Route the catalog pages to their async views. asgi.py turns this on, under WSGI every
+# async view would need an event loop of its own per request, so the sync ones are used.
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS') == '1'
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -65,6 +77,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'bookstore.context_processors.cart',
             ],
         },
     },
@@ -82,6 +95,64 @@ DATABASES = {
     }
 }
 
+# Catalog reads (books and reviews) go to a read replica when REPLICA_DATABASE names one,
+# everything else and every write stays on default. Locally the replica is a copy of
+# db.sqlite3 kept up to date by `manage.py sync_replica --interval 5`.
+# A visitor who writes reads from default for REPLICA_STICKY_SECONDS afterwards, so they
+# see their own changes before the replica catches up.
+
+REPLICA_DATABASE = os.environ.get('REPLICA_DATABASE')
+REPLICA_ALIAS = None
+REPLICA_STICKY_SECONDS = 10
+
+if REPLICA_DATABASE:
+    REPLICA_ALIAS = 'replica'
+    DATABASES[REPLICA_ALIAS] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': REPLICA_DATABASE,
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['bookstore.routers.ReplicaRouter']
+
+# Caches
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# 'default' holds the catalog-wide values (bookstore/catalog.py, the facet index version) and 'pages'
+# whole rendered pages for anonymous visitors with the generation that retires them (bookstore/page_cache.py).
+# Management commands change the catalog from their own process, so both have to be caches every process
+# shares: files under CACHE_DIR (PAGE_CACHE_DIR for the pages) by default, or memcached/redis in production.
+# Only the tests keep them in memory.
+
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'onestopbooks-cache'))
+PAGE_CACHE_DIR = os.environ.get('PAGE_CACHE_DIR', os.path.join(CACHE_DIR, 'pages'))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    } if TESTING else {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(CACHE_DIR, 'default'),
+    },
+    # the {% cache %} template tag uses this alias, it holds the cached book cards
+    'template_fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'template_fragments',
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+    'pages': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'pages',
+        'OPTIONS': {'MAX_ENTRIES': 2000},
+    } if TESTING else {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': PAGE_CACHE_DIR,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+PAGE_CACHE_ALIAS = 'pages'
+PAGE_CACHE_TIMEOUT = 600 # seconds, pages are retired sooner whenever the catalog changes
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -118,3 +189,46 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
+# collectstatic writes content-hashed copies and their .gz/.br siblings here (bookstore/storage.py),
+# bookstore.middleware.StaticAssetsMiddleware serves them with far-future cache headers
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+STATICFILES_STORAGE = 'bookstore.storage.CompressedManifestStaticFilesStorage'
+
+# Query instrumentation
+# Every request's query count and timings go to the bookstore.queries logger as a JSON line
+# and to a Server-Timing header. The views below, by url name, warn when they run more
+# queries than their budget, and fail while the tests run.
+
+QUERY_BUDGETS = {
+    # catalog pages, none of these should grow with the number of books or reviews shown
+    'home': 3,
+    'aboutus': 3,
+    'books': 6, # one more the first time after a catalog change, to rebuild the facet index
+    'booksunder': 5,
+    'newestbooks': 5,
+    'randombooks': 5, # one range read of the random_key index, two when it wraps around the end
+    'product': 5,
+    'search': 5,
+    # cart and checkout
+    'cart': 4,
+    'checkout': 4,
+    'update_item': 11, # includes the no-op write that takes the lock first
+    'successcheckout': 12,
+    'submit_review': 8, # includes moving the book's version, the product page's ETag
+}
+QUERY_BUDGETS_STRICT = TESTING
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'bookstore.queries': {
+            'handlers': ['console'],
+            'level': os.environ.get('QUERY_LOG_LEVEL', 'WARNING' if TESTING else 'INFO'),
+            'propagate': False,
+        },
+    },
+}
@@ -13,11 +13,17 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path
 from django.urls import include
 from bookstore.views import *
 
+if settings.ASYNC_VIEWS: # served through asgi.py
+    books_view = books_view_async
+    newestbooks_view = newestbooks_view_async
+    product_view = product_view_async
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', home_view, name='home'),
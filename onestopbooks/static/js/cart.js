@@ -6,8 +6,6 @@ for(var i = 0; i < updateBtns.length; i++){
     updateBtns[i].addEventListener('click', function(){ // add type click
         var bookIsbn = this.dataset.product //product here is from data-product
         var action = this.dataset.action // add rent remove
-        console.log('bookIsbn:', bookIsbn, 'action:', action) // will return bookIsbn and action in console browser
-        console.log('USER:', user)
 
         // check if user log in or not
         if(user === 'AnonymousUser'){
@@ -19,8 +17,27 @@ for(var i = 0; i < updateBtns.length; i++){
 }
 
 
+// clicks made close together are sent to the server as one batch
+var pendingOperations = []
+var flushTimer = null
+var FLUSH_DELAY = 150 // ms
+var RETRY_DELAY = 1000 // ms, after the server says the cart is busy
+var MAX_RETRIES = 3
+var retries = 0
+
 function updateUserOrder(bookIsbn, action){
-    console.log('User is logged in, sending data..')
+    pendingOperations.push({'bookIsbn': bookIsbn, 'action': action})
+    clearTimeout(flushTimer)
+    flushTimer = setTimeout(sendOperations, FLUSH_DELAY)
+}
+
+
+function sendOperations(){
+    var operations = pendingOperations
+    pendingOperations = []
+    if(operations.length === 0){
+        return
+    }
 
     var url = '/update_item' // this is where we gonna sent the data to
 
@@ -28,18 +45,63 @@ function updateUserOrder(bookIsbn, action){
         method: 'POST',
         headers:{
             'Content-Type':'application/json',
-            'X-CSRFToken':csrftoken,    
+            'X-CSRFToken':csrftoken,
         },
-        body:JSON.stringify({'bookIsbn': bookIsbn, 'action':action}) // sent as string by using stringify
+        body:JSON.stringify({'operations': operations}) // sent as string by using stringify
     })
-    
+
     // return response
     .then((response) =>{
+        if(response.status === 503 && retries < MAX_RETRIES){
+            // nothing was changed, send the same clicks again ahead of any made since
+            retries++
+            pendingOperations = operations.concat(pendingOperations)
+            clearTimeout(flushTimer)
+            flushTimer = setTimeout(sendOperations, RETRY_DELAY)
+            return null
+        }
+        retries = 0
+        if(!response.ok){
+            throw new Error('Cart update failed: ' + response.status)
+        }
         return response.json()
     })
 
     .then((data) =>{
-        console.log('data:', data)
-        location.reload()
+        if(data !== null){
+            updateCartPage(data)
+        }
+    })
+
+    .catch((error) =>{
+        console.log(error)
     })
 }
+
+
+// patch the numbers on the page instead of reloading it
+function updateCartPage(data){
+    setText(document.getElementById('cart-count'), data.cartItems)
+    setText(document.getElementById('cart-items'), data.cartItems)
+    setText(document.getElementById('cart-total'), '$' + Number(data.cartTotal).toFixed(2))
+
+    data.lines.forEach((line) =>{
+        var row = document.querySelector('[data-line="' + line.type + '-' + line.bookIsbn + '"]')
+        if(row === null){
+            return // the line isn't shown on this page
+        }
+        if(line.quantity === 0){
+            row.remove()
+            return
+        }
+        setText(row.querySelector('.line-quantity'), line.quantity)
+        setText(row.querySelector('.line-total'), '$' + line.total)
+    })
+}
+
+
+function setText(element, value){
+    if(element !== null){
+        element.textContent = value
+    }
+}